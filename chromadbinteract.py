@@ -1,6 +1,6 @@
 import chromadb
 from constants import CHROMA_SETTINGS
-from langchain.embeddings import HuggingFaceEmbeddings
+from ingestion.embedding import create_embeddings
 from dotenv import load_dotenv
 import os
 import pprint
@@ -11,7 +11,7 @@ embeddings_model_name = os.environ.get("EMBEDDINGS_MODEL_NAME")
 
 def main():
   client = chromadb.Client(settings=CHROMA_SETTINGS)
-  embeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name)
+  embeddings = create_embeddings(embeddings_model_name, workers=1)
   collection = client.get_collection("langchain", embedding_function=embeddings.embed_documents)
   queryResults = collection.query(query_texts=["What attributes does the Warrior class start with?"],
                                   n_results=10
@@ -2,15 +2,20 @@
 ### Step 1
 ################################################################################
 
-import requests
 import re
-import urllib.request
-from bs4 import BeautifulSoup
-from collections import deque
-from html.parser import HTMLParser
-from urllib.parse import urlparse
+import asyncio
+import hashlib
+import argparse
+from dotenv import load_dotenv
+from urllib.parse import urljoin, urlparse, urlsplit, urlunsplit
 import os
-import time
+
+from crawling.engine import AsyncCrawler
+from crawling.extract import DEFAULT_PROFILE, SITE_PROFILES, SiteProfile, extract_page, parse_selector, profile_for
+from crawling.state import CrawlState
+from ingestion.dedup import NearDuplicateDetector
+
+load_dotenv()
 
 # Regex pattern to match a URL
 HTTP_URL_PATTERN = r'^http[s]{0,1}://.+$'
@@ -28,82 +33,64 @@ HEADERS = {
 domain = "ign.com"
 ign_wiki_path = 'wikis/elden-ring'
 full_url = f'https://www.ign.com/{ign_wiki_path}'
-
-# Create a class to parse the HTML and get the hyperlinks
-class HyperlinkParser(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        # Create a list to store the hyperlinks
-        self.hyperlinks = []
-
-    # Override the HTMLParser's handle_starttag method to get the hyperlinks
-    def handle_starttag(self, tag, attrs):
-        attrs = dict(attrs)
-
-        # If the tag is an anchor tag and it has an href attribute, add the href attribute to the list of hyperlinks
-        if tag == "a" and "href" in attrs:
-            self.hyperlinks.append(attrs["href"])
+# Requests in flight at once, and requests per second and burst size allowed per host
+crawler_concurrency = int(os.environ.get('CRAWLER_CONCURRENCY', 8))
+crawler_rate = float(os.environ.get('CRAWLER_RATE', 2))
+crawler_burst = int(os.environ.get('CRAWLER_BURST', 4))
+crawler_timeout = float(os.environ.get('CRAWLER_TIMEOUT', 30))
+# URLs found, validators and text hashes of the pages of each domain, kept between crawls
+crawler_state_directory = os.environ.get('CRAWLER_STATE_DIRECTORY', 'crawler_state')
+# Site profile selecting the text of the pages, by default the profile of the domain crawled
+crawler_profile = os.environ.get('CRAWLER_PROFILE', '')
+# Stream the text of the pages into the vectorstores as they are crawled, and whether to also save it to files
+crawler_ingest = os.environ.get('CRAWLER_INGEST', 'False').lower() == 'true'
+crawler_write_files = os.environ.get('CRAWLER_WRITE_FILES', 'True').lower() == 'true'
+# Pages whose text is at least this similar to a page downloaded before in the same run are skipped, 0 keeps them all
+crawler_dedup_threshold = float(os.environ.get('CRAWLER_DEDUP_THRESHOLD', 0))
 
 ################################################################################
 ### Step 2
 ################################################################################
 
-# Function to get the hyperlinks from a URL
-def get_hyperlinks(url):
-    
-    # Try to open the URL and read the HTML
-    try:
-        # Open the URL and read the HTML
-        with urllib.request.urlopen(url) as response:
-
-            # If the response is not HTML, return an empty list
-            if not response.info().get('Content-Type').startswith("text/html"):
-                return []
-            
-            # Decode the HTML
-            html = response.read().decode('utf-8')
-    except Exception as e:
-        print(e)
-        return []
-
-    # Create the HTML Parser and then Parse the HTML to get hyperlinks
-    parser = HyperlinkParser()
-    parser.feed(html)
-
-    return parser.hyperlinks
+# Function to get the hyperlinks from the HTML of a page
+def get_hyperlinks(html):
+    return extract_page(html).links
 
 ################################################################################
 ### Step 3
 ################################################################################
 
-# Function to get the hyperlinks from a URL that are within the same domain
-def get_domain_hyperlinks(local_domain, url):
+# Function to normalize a URL, so the variants of the URL of a page are queued once
+def normalize_url(url):
+    # Fragments, default ports, trailing slashes and the case of the scheme and host do not change the page
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if parts.port is not None and (scheme, parts.port) not in (('http', 80), ('https', 443)):
+        netloc += f':{parts.port}'
+    return urlunsplit((scheme, netloc, parts.path.rstrip('/'), parts.query, ''))
+
+# Function to get the hyperlinks of a page, extracted from its HTML, that are within the same domain
+def get_domain_hyperlinks(local_domain, url, links, wiki_path=ign_wiki_path):
     clean_links = []
-    for link in set(get_hyperlinks(url)):
-        clean_link = None
-
-        # If the link is a URL, check if it is within the same domain
-        if re.search(HTTP_URL_PATTERN, link):
-            # Parse the URL and check if the domain is the same
-            url_obj = urlparse(link)
-            if url_obj.netloc == local_domain and url_obj.path.startswith('/' + ign_wiki_path):
-                clean_link = link
-
-        # If the link is not a URL, check if it is a relative link
-        else:
-            if link.startswith("/"):
-                link = link[1:]
-            elif (
-                link.startswith("#")
-                or link.startswith("mailto:")
-                or link.startswith("tel:")
-            ):
-                continue
-            clean_link = "https://" + local_domain + "/" + link
-
-        if clean_link is not None:
-            if clean_link.endswith("/"):
-                clean_link = clean_link[:-1]
+    for link in set(links):
+        link = link.strip()
+        if (
+            link.startswith("#")
+            or link.startswith("mailto:")
+            or link.startswith("tel:")
+            or link.startswith("javascript:")
+        ):
+            continue
+
+        # Resolve relative links against the page, then check that the URL is within the same domain and path
+        try:
+            clean_link = normalize_url(urljoin(url, link))
+        except ValueError:
+            # Invalid port or address
+            continue
+        url_obj = urlparse(clean_link)
+        if re.search(HTTP_URL_PATTERN, clean_link) and url_obj.netloc == local_domain and url_obj.path.startswith('/' + wiki_path):
             clean_links.append(clean_link)
 
     # Return the list of hyperlinks that are within the same domain
@@ -114,13 +101,6 @@ def get_domain_hyperlinks(local_domain, url):
 ### Step 4
 ################################################################################
 
-def remove_newlines(str):
-    str = str.replace('\n', ' ')
-    str = str.replace('\\n', ' ')
-    str = str.replace('  ', ' ')
-    str = str.replace('  ', ' ')
-    return str
-
 def sanitize_file_name(file_name):
     # Define a regular expression pattern to match invalid characters
     invalid_chars = r'[\/:*?"<>|]'
@@ -130,80 +110,142 @@ def sanitize_file_name(file_name):
 
     return sanitized_name
 
-def crawl(url):
-    # Parse the URL and get the domain
-    local_domain = urlparse(url).netloc
-
-    # Create a queue to store the URLs to crawl
-    queue = deque([url])
+# Function to get the name of the files saved for a page, without their extension
+def page_file_name(url):
+    return sanitize_file_name(url.split('://', 1)[-1].replace("/", "_"))
 
-    # Create a set to store the URLs that have already been seen (no duplicates)
-    seen = set([url])
+def crawl(url, concurrency=crawler_concurrency, rate=crawler_rate, burst=crawler_burst, max_pages=None,
+          incremental=True, restart=False, profile=None, save_html=False, ingest=False, write_files=True,
+          dedup_threshold=crawler_dedup_threshold):
+    # Parse the URL and get the domain, links to other domains or outside of the URL's path are not followed
+    url = normalize_url(url)
+    local_domain = urlparse(url).netloc
+    wiki_path = urlparse(url).path.strip('/')
 
     # Create a directory to store the text files
-    if not os.path.exists("crawler_text/"):
-            os.mkdir("crawler_text/")
-
-    if not os.path.exists("crawler_text/"+local_domain+"/"):
-            os.mkdir("crawler_text/" + local_domain + "/")
-
-    # While the queue is not empty, continue crawling
-    while queue:
-
-        # Get the next URL from the queue
-        url = queue.pop()
-        WIKI_SECTION_TAG_TO_SCRAP = 'section', {'class': 'jsx-1266389546 jsx-380427680 jsx-28683165 wiki-section wiki-html'}
-        TAGS_TO_SCRAPE = ['p','ul','table']
-        print(url) # for debugging and to see the progress
-        try:
-          time.sleep(1) # being nice to the server
-          # Save text from the url to a <url>.txt file
-          with open('crawler_text/'+local_domain+'/'+sanitize_file_name(url[8:].replace("/", "_") + ".txt"), "w", encoding="UTF-8") as f:
-
-            # Get the text from the URL using BeautifulSoup
-            response = requests.get(url, headers=HEADERS)
-            if response.ok:
-                soup = BeautifulSoup(response.text, "html.parser")
-
-                SCRAPED_WIKI_SECTIONS = soup.find_all(WIKI_SECTION_TAG_TO_SCRAP)
-                SCRAPED_WIKI_SECTION_INNER_TAGS = [tag.find_all(TAGS_TO_SCRAPE) for tag in SCRAPED_WIKI_SECTIONS] 
-                
-                for items in SCRAPED_WIKI_SECTION_INNER_TAGS:
-                    for item in items:
-                        if item.tag == 'table':
-                            # Extract the rows
-                            rows = item.find_all('tr')
-
-                            for i in range(0, len(rows), 2):  # loop over rows, assuming each pair of rows is a header-data pair
-                                if i + 1 < len(rows):  # Check if there is a second row
-                                    # Extract the headers from the first row and the data from the second row
-                                    headers = [th.text for th in rows[i].find_all('th')]
-                                    data = [td.text for td in rows[i+1].find_all('td')]
-
-                                    # Combine the headers and data to create a dictionary for the row
-                                    row_data = dict(zip(headers, data))
-
-                                    # Write the row data to the file
-                                    for header, cell in row_data.items():
-                                        f.write(f'{header}: {remove_newlines(cell)}\n')
-                                    
-                                    # Write a blank line to separate rows
-                                    f.write('\n')
-                                else:  # If there is no second row, write the data from the first row
-                                    data = [td.text for td in rows[i].find_all('td')]
-                                    f.write('\n'.join(map(remove_newlines, data)) + '\n')
-                        else:
-                            f.write(remove_newlines(item.text) + '\n')
-            else:
-                print(f'Unable to scrape url: {url}')
-
-          # Get the hyperlinks from the URL and add them to the queue
-          for link in get_domain_hyperlinks(local_domain, url):
-              if link not in seen:
-                  queue.append(link)
-                  seen.add(link)
-        except Exception as error:
-            print(f'Exception occured scraping url: {url}\n Exception: {error}')
-
-crawl(full_url)
-
+    if write_files:
+        os.makedirs("crawler_text/" + local_domain + "/", exist_ok=True)
+    if save_html:
+        os.makedirs("crawler_html/" + local_domain + "/", exist_ok=True)
+    profile = profile or profile_for(url)
+    print(f"Extracting the text of the pages with the {profile.name} site profile")
+    state = CrawlState(os.path.join(crawler_state_directory, local_domain + '.sqlite')) if incremental else None
+    unchanged = []
+    dedup = NearDuplicateDetector(dedup_threshold) if dedup_threshold > 0 else None
+    if state is not None and write_files:
+        # Pages whose text file is missing, such as pages dropped as near-duplicates, are downloaded and checked again
+        missing = [page_url for page_url in state.text_hashes() if not os.path.exists('crawler_text/'+local_domain+'/'+page_file_name(page_url)+'.txt')]
+        if missing:
+            state.forget_validators(missing)
+            print(f"{len(missing)} known pages have no text file and will be downloaded again")
+
+    ingestor = None
+    if ingest:
+        # Imported here so crawling alone does not need the embeddings and vectorstore packages
+        from ingestion.stream import create_streaming_ingestor
+        ingestor = create_streaming_ingestor(on_persisted=state.set_ingested if state is not None else None)
+        if state is not None:
+            # Pages whose text never reached the vectorstores must be downloaded, not reported as not modified
+            missing = state.forget_uningested(ingestor.key_prefix)
+            if missing:
+                print(f"{missing} known pages are not in the vectorstores yet and will be downloaded again")
+        ingestor.start()
+
+    def handle_page(page_url, html):
+        # Text and links come from a single pass over the HTML
+        text, links = extract_page(html, profile)
+        text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        # Save text from the url to a <url>.txt file, unless the page changed but not its text, so
+        # ingest.py does not re-embed it
+        file_name = page_file_name(page_url)
+        file_path = 'crawler_text/'+local_domain+'/'+file_name+'.txt'
+        if save_html:
+            # Saved pages are the input of extract_benchmark.py
+            with open('crawler_html/'+local_domain+'/'+file_name+'.html', "w", encoding="UTF-8") as f:
+                f.write(html)
+        if dedup is not None and text.strip() and dedup.check(page_url, text) is not None:
+            # Same article under another URL, or a navigation page listing the same links: neither saved nor
+            # ingested, and what was saved or streamed from an earlier version of the page is removed
+            if write_files and os.path.exists(file_path):
+                os.remove(file_path)
+            if ingestor is not None and (state is None or state.ingested(page_url)):
+                ingestor.remove(page_url)
+            if state is not None:
+                state.set_text_hash(page_url, text_hash)
+            return get_domain_hyperlinks(local_domain, page_url, links, wiki_path)
+        changed = state is None or state.text_hash(page_url) != text_hash
+        if write_files and (changed or not os.path.exists(file_path)):
+            with open(file_path, "w", encoding="UTF-8") as f:
+                f.write(text)
+        if ingestor is not None and (changed or state.ingested(page_url) != ingestor.page_key(text_hash)):
+            # Embedded and added to the vectorstores by the ingestion thread while the crawl goes on
+            ingestor.add(page_url, text, text_hash)
+        elif not changed:
+            unchanged.append(page_url)
+        if changed and state is not None:
+            state.set_text_hash(page_url, text_hash)
+
+        # Get the hyperlinks from the same HTML to add them to the queue
+        return get_domain_hyperlinks(local_domain, page_url, links, wiki_path)
+
+    # Each page is fetched once, its text and its links are extracted from the same download
+    crawler = AsyncCrawler(handle_page, concurrency=concurrency, rate=rate, burst=burst, timeout=crawler_timeout,
+                           headers=HEADERS, max_pages=max_pages, state=state, restart=restart)
+    try:
+        asyncio.run(crawler.run([url]))
+    finally:
+        if ingestor is not None:
+            print("Ingesting the last pages...")
+            ingestor.close()
+            print(ingestor.report())
+            print(ingestor.embeddings.throughput_report())
+            ingestor.embeddings.close()
+        if state is not None:
+            state.close()
+    if state is not None:
+        print(f"{len(unchanged)} pages downloaded again had the same text and were left as they were")
+    if dedup is not None:
+        print(dedup.report('pages'))
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Crawl a wiki and save the text of its pages to crawler_text/<domain>/.')
+    parser.add_argument("url", nargs='?', default=full_url,
+                        help='Page to start crawling from. Defaults to the Elden Ring wiki on IGN.')
+    parser.add_argument("--concurrency", type=int, default=crawler_concurrency,
+                        help='Number of requests in flight at once. Defaults to CRAWLER_CONCURRENCY or 8.')
+    parser.add_argument("--rate", type=float, default=crawler_rate,
+                        help='Requests per second allowed per host, 0 for no limit. Defaults to CRAWLER_RATE or 2.')
+    parser.add_argument("--burst", type=int, default=crawler_burst,
+                        help='Requests allowed at once per host before the rate applies. Defaults to CRAWLER_BURST or 4.')
+    parser.add_argument("--max-pages", type=int,
+                        help='Request at most this many pages in this run, the next run resumes with the pages left.')
+    parser.add_argument("--full", action='store_true',
+                        help=f'Crawl from scratch, without the state of the previous crawls in {crawler_state_directory}/.')
+    parser.add_argument("--restart", action='store_true',
+                        help='Start a new crawl instead of resuming an interrupted one.')
+    parser.add_argument("--profile", default=crawler_profile,
+                        help=f"Site profile selecting the text of the pages, among {', '.join(profile.name for profile in SITE_PROFILES.values())} "
+                             f"and {DEFAULT_PROFILE.name}. Defaults to CRAWLER_PROFILE or the profile of the domain crawled.")
+    parser.add_argument("--selector",
+                        help='Comma separated selectors of the sections to extract, such as "div.article-body", instead of a site profile.')
+    parser.add_argument("--save-html", action='store_true',
+                        help='Also save the HTML of the pages to crawler_html/<domain>/.')
+    parser.add_argument("--ingest", action=argparse.BooleanOptionalAction, default=crawler_ingest,
+                        help='Split, embed and add the text of the pages to the vectorstores as they are crawled. Defaults to CRAWLER_INGEST or False.')
+    parser.add_argument("--files", action=argparse.BooleanOptionalAction, default=crawler_write_files,
+                        help='Save the text of the pages to crawler_text/<domain>/. Defaults to CRAWLER_WRITE_FILES or True.')
+    parser.add_argument("--dedup-threshold", type=float, default=crawler_dedup_threshold,
+                        help='Skip pages whose text is at least this similar to a page downloaded before in this run, 0 to keep them all. '
+                             'Pages not modified since the last crawl are not downloaded, so they are never matched. '
+                             'Defaults to CRAWLER_DEDUP_THRESHOLD or 0.')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.selector:
+        profile = SiteProfile('custom', tuple(parse_selector(selector) for selector in args.selector.split(',')))
+    else:
+        profile = profile_for(args.url, args.profile)
+    crawl(args.url, concurrency=args.concurrency, rate=args.rate, burst=args.burst, max_pages=args.max_pages,
+          incremental=not args.full, restart=args.restart, profile=profile, save_html=args.save_html,
+          ingest=args.ingest, write_files=args.files, dedup_threshold=args.dedup_threshold)
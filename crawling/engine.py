@@ -0,0 +1,135 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+import aiohttp
+
+from crawling.ratelimit import HostRateLimiter
+from crawling.state import CrawlState
+
+
+class AsyncCrawler:
+    """
+    Crawls pages concurrently on an asyncio loop with a pool of keep-alive connections.
+
+    Every page is downloaded once and its HTML handed to handle_page(url, html) on a thread, so
+    parsing never stalls the downloads of other pages. handle_page extracts whatever it needs
+    from the page and returns the links to follow, which are queued unless already seen.
+    At most concurrency requests are in flight, and each host gets at most rate requests per
+    second, with bursts of burst requests.
+
+    With a CrawlState, the crawl starts from the frontier of the state instead of the start URLs
+    alone, every URL found is recorded in it, and pages are requested with the validators of
+    their last response: a page the server reports as not modified is neither downloaded nor
+    handled again. The run is only marked finished once its queue is empty.
+
+    max_pages bounds the pages requested by this run. The URLs found beyond it are still recorded
+    in the state, and the run is left unfinished so that resuming it visits them.
+    """
+
+    def __init__(self, handle_page: Callable[[str, str], List[str]], concurrency: int = 8, rate: float = 2.0,
+                 burst: int = 4, timeout: float = 30, headers: Optional[Dict[str, str]] = None,
+                 max_pages: Optional[int] = None, state: Optional[CrawlState] = None, restart: bool = False):
+        self.handle_page = handle_page
+        self.concurrency = concurrency
+        self.limiter = HostRateLimiter(rate, burst)
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.max_pages = max_pages
+        self.state = state
+        self.restart = restart
+        self.seen: Set[str] = set()
+        # URLs queued by this run, and URLs found once max_pages of them were queued
+        self.queued = 0
+        self.held_back = 0
+        self.queue: Optional[asyncio.Queue] = None
+        self.executor = ThreadPoolExecutor(max_workers=max(1, min(4, concurrency)), thread_name_prefix='parse')
+        self.pages = 0
+        self.failures = 0
+        self.not_modified = 0
+        self.bytes = 0
+
+    def enqueue(self, urls: Iterable[str]):
+        new_urls = []
+        for url in urls:
+            if url in self.seen:
+                continue
+            self.seen.add(url)
+            new_urls.append(url)
+            if self.max_pages is not None and self.queued >= self.max_pages:
+                self.held_back += 1
+                continue
+            self.queued += 1
+            self.queue.put_nowait(url)
+        if self.state is not None and new_urls:
+            self.state.add(new_urls)
+
+    async def fetch(self, session: aiohttp.ClientSession, url: str) -> Tuple[int, Mapping[str, str], Optional[str]]:
+        """
+        Returns the status and headers of the response for a page, with its HTML, or None when the
+        page is not HTML, was not modified or could not be fetched
+        """
+        await self.limiter.acquire(urlparse(url).netloc)
+        headers = self.state.validators(url) if self.state is not None else {}
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304:
+                self.not_modified += 1
+                return response.status, response.headers, None
+            if response.status != 200:
+                print(f'Unable to scrape url: {url} (HTTP {response.status})')
+                self.failures += 1
+                return response.status, response.headers, None
+            if not response.headers.get('Content-Type', '').startswith('text/html'):
+                return response.status, response.headers, None
+            body = await response.read()
+            self.bytes += len(body)
+            return response.status, response.headers, body.decode(response.charset or 'utf-8', errors='replace')
+
+    async def worker(self, session: aiohttp.ClientSession):
+        loop = asyncio.get_running_loop()
+        while True:
+            url = await self.queue.get()
+            try:
+                print(url)  # for debugging and to see the progress
+                status, headers, html = await self.fetch(session, url)
+                if html is not None:
+                    self.pages += 1
+                    self.enqueue(await loop.run_in_executor(self.executor, self.handle_page, url, html))
+                if self.state is not None:
+                    self.state.visited(url, status, headers.get('ETag'), headers.get('Last-Modified'))
+            except Exception as error:
+                self.failures += 1
+                print(f'Exception occured scraping url: {url}\n Exception: {error!r}')
+            finally:
+                self.queue.task_done()
+
+    async def run(self, start_urls: Iterable[str]):
+        start = time.time()
+        self.queue = asyncio.Queue()
+        if self.state is not None:
+            frontier = self.state.begin(start_urls, self.restart)
+            print(f"{'Resuming' if self.state.resumed else 'Starting'} crawl {self.state.run_id} with {len(frontier)} pages to visit")
+            self.seen = self.state.known_urls() - set(frontier)
+            start_urls = frontier
+        self.enqueue(start_urls)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.headers) as session:
+            workers = [asyncio.ensure_future(self.worker(session)) for _ in range(self.concurrency)]
+            await self.queue.join()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        self.executor.shutdown()
+        if self.held_back:
+            print(f"Stopped after {self.max_pages} pages, {self.held_back} pages found were not visited"
+                  + (", resume the crawl to visit them" if self.state is not None else ""))
+        elif self.state is not None:
+            self.state.finish()
+        print(self.report(time.time() - start))
+
+    def report(self, seconds: float) -> str:
+        return (f"Crawled {self.pages} pages ({round(self.bytes / 2 ** 20, 1)} MB) in {round(seconds, 1)} s, "
+                f"{round(self.pages / seconds, 2) if seconds else 0} pages/s, {self.not_modified} not modified, {self.failures} failed")
@@ -0,0 +1,203 @@
+import re
+from html.parser import HTMLParser
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+
+# Newlines, escaped newlines left in the text of some pages, and runs of spaces become one space
+WHITESPACE = re.compile(r'(?:\s|\\n)+')
+# Tags whose text is never part of a page's text
+SKIPPED_TAGS = {'script', 'style', 'noscript', 'template'}
+# Tags separating words inside an item, so "<li>a</li><li>b</li>" does not read "ab"
+SEPARATOR_TAGS = {'br', 'li', 'dt', 'dd', 'div', 'td', 'th'}
+# Tags an unclosed <p> ends at, as browsers do
+PARAGRAPH_CLOSERS = {'p', 'ul', 'ol', 'table', 'div', 'section', 'article', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+                     'blockquote', 'pre', 'dl', 'figure', 'form', 'hr'}
+
+
+class Selector(NamedTuple):
+    """
+    Elements of a tag, or of any tag when empty, carrying all the given classes
+    """
+    tag: str
+    classes: FrozenSet[str]
+
+    def matches(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> bool:
+        if self.tag and tag != self.tag:
+            return False
+        if not self.classes:
+            return True
+        for name, value in attrs:
+            if name == 'class' and value:
+                return self.classes.issubset(value.split())
+        return False
+
+
+def parse_selector(selector: str) -> Selector:
+    """
+    Parses a simple CSS selector such as "section.wiki-section.wiki-html" or ".content"
+    """
+    tag, *classes = selector.strip().split('.')
+    return Selector(tag.lower(), frozenset(name for name in classes if name))
+
+
+class SiteProfile(NamedTuple):
+    """
+    What to extract from the pages of a site: the text of the item tags found within the sections
+    matching one of the selectors, or within the whole page when there are none
+    """
+    name: str
+    sections: Tuple[Selector, ...]
+    items: FrozenSet[str] = frozenset({'p', 'ul', 'ol', 'table'})
+
+
+DEFAULT_PROFILE = SiteProfile('default', ())
+# Profiles by domain, also used for its subdomains
+SITE_PROFILES: Dict[str, SiteProfile] = {
+    # The wiki sections also carry generated jsx-* classes, which change with every release of the site
+    'ign.com': SiteProfile('ign', (parse_selector('section.wiki-section.wiki-html'),), frozenset({'p', 'ul', 'table'})),
+    'fandom.com': SiteProfile('fandom', (parse_selector('div.mw-parser-output'),)),
+}
+
+
+def register_profile(domain: str, profile: SiteProfile):
+    SITE_PROFILES[domain] = profile
+
+
+def profile_for(url: str, name: Optional[str] = None) -> SiteProfile:
+    """
+    Profile called name, or else the profile of the domain of url, or the default profile
+    """
+    if name:
+        for profile in list(SITE_PROFILES.values()) + [DEFAULT_PROFILE]:
+            if profile.name == name:
+                return profile
+        raise Exception(f"No site profile named {name}. Please choose one of the following: "
+                        f"{', '.join(profile.name for profile in SITE_PROFILES.values())}, {DEFAULT_PROFILE.name}")
+    host = urlparse(url).hostname or ''
+    for domain, profile in SITE_PROFILES.items():
+        if host == domain or host.endswith('.' + domain):
+            return profile
+    return DEFAULT_PROFILE
+
+
+class ExtractedPage(NamedTuple):
+    text: str
+    links: List[str]
+
+
+class PageExtractor(HTMLParser):
+    """
+    Collects the links of a page and the text of its items in a single pass over the parser's
+    events, without building a tree. Each item becomes a line of text; each row of a table
+    becomes a line of its cells separated by " | ". HTML can be fed in pieces as it arrives.
+    """
+
+    def __init__(self, profile: SiteProfile):
+        super().__init__(convert_charrefs=True)
+        self.profile = profile
+        self.links: List[str] = []
+        self.lines: List[str] = []
+        self.section_tag: Optional[str] = None
+        self.section_depth = 0
+        self.item_tag: Optional[str] = None
+        self.item_depth = 0
+        self.skipped_depth = 0
+        # Text pieces of the current item, or of the current cell of a table
+        self.parts: List[str] = []
+        self.row: List[str] = []
+
+    def in_section(self) -> bool:
+        return not self.profile.sections or self.section_depth > 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            for name, value in attrs:
+                if name == 'href' and value:
+                    self.links.append(value)
+                    break
+        if tag in SKIPPED_TAGS:
+            self.skipped_depth += 1
+            return
+        if self.section_depth:
+            if tag == self.section_tag:
+                self.section_depth += 1
+        elif self.profile.sections and any(selector.matches(tag, attrs) for selector in self.profile.sections):
+            self.section_tag, self.section_depth = tag, 1
+            return
+        if not self.in_section():
+            return
+
+        if self.item_tag == 'p' and tag in PARAGRAPH_CLOSERS:
+            self.end_item()
+        if self.item_tag is None:
+            if tag in self.profile.items:
+                self.item_tag, self.item_depth = tag, 1
+            return
+        if tag == self.item_tag:
+            self.item_depth += 1
+        elif self.item_tag == 'table' and tag == 'tr':
+            self.end_row()
+        elif self.item_tag == 'table' and tag in ('td', 'th'):
+            self.end_cell()
+        elif tag in SEPARATOR_TAGS:
+            self.parts.append(' ')
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skipped_depth = max(0, self.skipped_depth - 1)
+            return
+        if self.item_tag is not None:
+            if tag == self.item_tag:
+                self.item_depth -= 1
+                if self.item_depth == 0:
+                    self.end_item()
+            elif self.item_tag == 'table' and tag == 'tr':
+                self.end_row()
+        if self.section_depth and tag == self.section_tag:
+            self.section_depth -= 1
+            if self.section_depth == 0:
+                self.end_item()
+                self.section_tag = None
+
+    def handle_data(self, data):
+        if self.item_tag is not None and not self.skipped_depth:
+            self.parts.append(data)
+
+    def end_cell(self):
+        cell = WHITESPACE.sub(' ', ''.join(self.parts)).strip()
+        if cell:
+            self.row.append(cell)
+        self.parts.clear()
+
+    def end_row(self):
+        self.end_cell()
+        if self.row:
+            self.lines.append(' | '.join(self.row))
+        self.row.clear()
+
+    def end_item(self):
+        if self.item_tag == 'table':
+            self.end_row()
+        else:
+            text = WHITESPACE.sub(' ', ''.join(self.parts)).strip()
+            if text:
+                self.lines.append(text)
+        self.parts.clear()
+        self.item_tag, self.item_depth = None, 0
+
+    def close(self):
+        super().close()
+        self.end_item()
+
+    def page(self) -> ExtractedPage:
+        return ExtractedPage(''.join(line + '\n' for line in self.lines), self.links)
+
+
+def extract_page(html: str, profile: SiteProfile = DEFAULT_PROFILE) -> ExtractedPage:
+    """
+    Text of the items of a page, one per line, and the href of every link of the page
+    """
+    extractor = PageExtractor(profile)
+    extractor.feed(html)
+    extractor.close()
+    return extractor.page()
@@ -0,0 +1,137 @@
+import os
+import time
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+class CrawlState:
+    """
+    Persistent state of the crawls of a site, in an SQLite file: every URL found so far, the
+    validators (ETag, Last-Modified) its server sent and the hash of the text extracted from it.
+
+    A crawl is a run over every known URL. URLs are marked as visited by the current run as they
+    are processed, so an interrupted run is resumed with the URLs it did not visit yet, and a new
+    run revisits every known URL with conditional requests.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript('''
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, started REAL NOT NULL, finished REAL);
+            CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, text_hash TEXT,
+                                              status INTEGER, visited_run INTEGER, fetched REAL);
+            CREATE INDEX IF NOT EXISTS pages_visited_run ON pages (visited_run);
+        ''')
+        # Key of the version of the page whose chunks are in the vectorstores, when streamed into them
+        if 'ingested' not in {column[1] for column in self._conn.execute('PRAGMA table_info(pages)')}:
+            self._conn.execute('ALTER TABLE pages ADD COLUMN ingested TEXT')
+        self.run_id = None
+        self.resumed = False
+
+    def begin(self, start_urls: Iterable[str], restart: bool = False) -> List[str]:
+        """
+        Resumes the last run if it did not finish, unless restart is set, or starts a new one, and
+        returns its frontier: the known URLs it did not visit yet
+        """
+        with self._lock:
+            last = self._conn.execute('SELECT id, finished FROM runs ORDER BY id DESC LIMIT 1').fetchone()
+            if last is not None and last[1] is None and not restart:
+                self.run_id, self.resumed = last[0], True
+            else:
+                self.run_id = self._conn.execute('INSERT INTO runs (started) VALUES (?)', (time.time(),)).lastrowid
+            self._conn.executemany('INSERT OR IGNORE INTO pages (url) VALUES (?)', [(url,) for url in start_urls])
+            self._conn.commit()
+            return [url for url, in self._conn.execute('SELECT url FROM pages WHERE visited_run IS NULL OR visited_run != ?',
+                                                       (self.run_id,))]
+
+    def known_urls(self) -> Set[str]:
+        with self._lock:
+            return {url for url, in self._conn.execute('SELECT url FROM pages')}
+
+    def add(self, urls: List[str]):
+        with self._lock:
+            self._conn.executemany('INSERT OR IGNORE INTO pages (url) VALUES (?)', [(url,) for url in urls])
+
+    def validators(self, url: str) -> Dict[str, str]:
+        """
+        Conditional request headers for a URL, from the validators of its last response
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT etag, last_modified FROM pages WHERE url = ?', (url,)).fetchone()
+        headers = {}
+        if row is not None and row[0]:
+            headers['If-None-Match'] = row[0]
+        if row is not None and row[1]:
+            headers['If-Modified-Since'] = row[1]
+        return headers
+
+    def text_hash(self, url: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute('SELECT text_hash FROM pages WHERE url = ?', (url,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_text_hash(self, url: str, text_hash: str):
+        with self._lock:
+            self._conn.execute('UPDATE pages SET text_hash = ? WHERE url = ?', (text_hash, url))
+
+    def ingested(self, url: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute('SELECT ingested FROM pages WHERE url = ?', (url,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_ingested(self, pages: List[Tuple[str, str]]):
+        with self._lock:
+            self._conn.executemany('UPDATE pages SET ingested = ? WHERE url = ?', [(key, url) for url, key in pages])
+            self._conn.commit()
+
+    def forget_uningested(self, key_prefix: str) -> int:
+        """
+        Drops the validators of the pages whose current text was not streamed into the vectorstores
+        with key_prefix, so they are downloaded again instead of being reported as not modified.
+        Returns the number of pages.
+        """
+        with self._lock:
+            count = self._conn.execute("UPDATE pages SET etag = NULL, last_modified = NULL WHERE text_hash IS NOT NULL "
+                                       "AND (ingested IS NULL OR ingested != ? || ':' || text_hash)", (key_prefix,)).rowcount
+            self._conn.commit()
+        return count
+
+    def forget_validators(self, urls: List[str]):
+        """
+        Drops the validators of the given pages, so they are downloaded again instead of being
+        reported as not modified
+        """
+        with self._lock:
+            self._conn.executemany('UPDATE pages SET etag = NULL, last_modified = NULL WHERE url = ?', [(url,) for url in urls])
+            self._conn.commit()
+
+    def text_hashes(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._conn.execute('SELECT url, text_hash FROM pages WHERE text_hash IS NOT NULL'))
+
+    def visited(self, url: str, status: int, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        """
+        Marks a URL as visited by the current run. A 304 keeps the validators and text hash of the
+        previous response.
+        """
+        with self._lock:
+            if status == 304:
+                self._conn.execute('UPDATE pages SET visited_run = ?, fetched = ? WHERE url = ?', (self.run_id, time.time(), url))
+            else:
+                self._conn.execute('UPDATE pages SET etag = ?, last_modified = ?, status = ?, visited_run = ?, fetched = ? WHERE url = ?',
+                                   (etag, last_modified, status, self.run_id, time.time(), url))
+            self._conn.commit()
+
+    def finish(self):
+        with self._lock:
+            self._conn.execute('UPDATE runs SET finished = ? WHERE id = ?', (time.time(), self.run_id))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import os
+import glob
+import time
+import argparse
+import tracemalloc
+from html.parser import HTMLParser
+from typing import Callable, List, Tuple
+
+from tabulate import tabulate
+
+from crawling.extract import DEFAULT_PROFILE, SITE_PROFILES, SiteProfile, extract_page, profile_for
+
+
+class HyperlinkParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.hyperlinks = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "a" and "href" in attrs:
+            self.hyperlinks.append(attrs["href"])
+
+
+def soup_extract(html: str, profile: SiteProfile) -> Tuple[str, List[str]]:
+    """
+    The extraction crawler.py used to do: a BeautifulSoup tree searched for the sections and
+    their items, newlines removed from each item, and a second parse of the HTML for the links
+    """
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, "html.parser")
+    sections = [soup.find_all(selector.tag or True, class_=lambda value, selector=selector: value is not None and selector.classes.issubset(value.split()))
+                for selector in profile.sections] or [[soup]]
+    lines = []
+    for section in (section for found in sections for section in found):
+        for item in section.find_all(list(profile.items)):
+            text = item.text.replace('\n', ' ').replace('\\n', ' ').replace('  ', ' ').replace('  ', ' ')
+            lines.append(text + '\n')
+    parser = HyperlinkParser()
+    parser.feed(html)
+    return ''.join(lines), parser.hyperlinks
+
+
+def measure(extract: Callable[[str, SiteProfile], Tuple[str, List[str]]], pages: List[str], profile: SiteProfile,
+            repeat: int) -> Tuple[float, int]:
+    """
+    Best time over repeat runs to extract every page, and the peak memory allocated by the
+    extraction of the largest page
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for html in pages:
+            extract(html, profile)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    extract(max(pages, key=len), profile)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    args = parse_arguments()
+    paths = sorted(glob.glob(os.path.join(args.directory, '**', '*.html'), recursive=True))
+    if not paths:
+        print(f"No saved pages found in {args.directory}. Crawl with --save-html to save them.")
+        return
+    pages = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            pages.append(f.read())
+    megabytes = sum(len(html.encode('utf-8')) for html in pages) / 2 ** 20
+    profile = profile_for(args.url or '', args.profile)
+    print(f"Extracting {len(pages)} pages ({round(megabytes, 2)} MB) with the {profile.name} site profile, best of {args.repeat} runs")
+
+    methods = [('single pass', lambda html, profile: extract_page(html, profile))]
+    try:
+        import bs4  # noqa: F401
+        methods.append(('BeautifulSoup + links pass', soup_extract))
+    except ImportError:
+        print("Install beautifulsoup4 to compare with the extraction crawler.py used before")
+
+    rows = []
+    for name, extract in methods:
+        seconds, peak = measure(extract, pages, profile, args.repeat)
+        rows.append([name, round(seconds, 3), round(megabytes / seconds, 2), round(len(pages) / seconds, 1),
+                     round(1000 * seconds / len(pages), 2), round(peak / 2 ** 20, 2)])
+    print(tabulate(rows, headers=['extraction', 'seconds', 'MB/s', 'pages/s', 'ms/page', 'peak MB (largest page)']))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Measure the throughput of the extraction of the text and links of saved pages.')
+    parser.add_argument("directory", nargs='?', default='crawler_html',
+                        help='Folder of the pages saved by crawler.py --save-html. Defaults to crawler_html.')
+    parser.add_argument("--profile",
+                        help=f"Site profile to extract the pages with, among {', '.join(profile.name for profile in SITE_PROFILES.values())} "
+                             f"and {DEFAULT_PROFILE.name}.")
+    parser.add_argument("--url",
+                        help='URL of the site the pages come from, to use the profile of its domain.')
+    parser.add_argument("--repeat", type=int, default=3,
+                        help='Number of runs over the pages, the best one is reported. Defaults to 3.')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
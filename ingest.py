@@ -1,166 +1,95 @@
 #!/usr/bin/env python3
 import os
-import glob
-from typing import List
+import argparse
 from dotenv import load_dotenv
-from multiprocessing import Pool
-from tqdm import tqdm
-
-from langchain.document_loaders import (
-    CSVLoader,
-    EverNoteLoader,
-    PyMuPDFLoader,
-    TextLoader,
-    UnstructuredEmailLoader,
-    UnstructuredEPubLoader,
-    UnstructuredHTMLLoader,
-    UnstructuredMarkdownLoader,
-    UnstructuredODTLoader,
-    UnstructuredPowerPointLoader,
-    UnstructuredWordDocumentLoader,
-)
-
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import Chroma
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.docstore.document import Document
-from constants import CHROMA_SETTINGS
+
+from ingestion.dedup import create_dedup_detector
+from ingestion.discovery import SYMLINK_POLICIES
+from ingestion.embedding import create_embeddings
+from ingestion.pipeline import IngestionPipeline
+from ingestion.sinks import SINK_TYPES, create_sink
 
 
 load_dotenv()
 
 
-# Load environment variables
-persist_directory = os.environ.get('PERSIST_DIRECTORY')
+# Load environment variables
 source_directory = os.environ.get('SOURCE_DIRECTORY', 'source_documents')
 embeddings_model_name = os.environ.get('EMBEDDINGS_MODEL_NAME')
-chunk_size = 500
-chunk_overlap = 50
-
-
-# Custom document loaders
-class MyElmLoader(UnstructuredEmailLoader):
-    """Wrapper to fallback to text/plain when default does not work"""
-
-    def load(self) -> List[Document]:
-        """Wrapper adding fallback for elm without html"""
-        try:
-            try:
-                doc = UnstructuredEmailLoader.load(self)
-            except ValueError as e:
-                if 'text/html content not found in email' in str(e):
-                    # Try plain text
-                    self.unstructured_kwargs["content_source"]="text/plain"
-                    doc = UnstructuredEmailLoader.load(self)
-                else:
-                    raise
-        except Exception as e:
-            # Add file_path to exception message
-            raise type(e)(f"{self.file_path}: {e}") from e
-
-        return doc
-
-
-# Map file extensions to document loaders and their arguments
-LOADER_MAPPING = {
-    ".csv": (CSVLoader, {}),
-    # ".docx": (Docx2txtLoader, {}),
-    ".doc": (UnstructuredWordDocumentLoader, {}),
-    ".docx": (UnstructuredWordDocumentLoader, {}),
-    ".enex": (EverNoteLoader, {}),
-    ".eml": (MyElmLoader, {}),
-    ".epub": (UnstructuredEPubLoader, {}),
-    ".html": (UnstructuredHTMLLoader, {}),
-    ".md": (UnstructuredMarkdownLoader, {}),
-    ".odt": (UnstructuredODTLoader, {}),
-    ".pdf": (PyMuPDFLoader, {}),
-    ".ppt": (UnstructuredPowerPointLoader, {}),
-    ".pptx": (UnstructuredPowerPointLoader, {}),
-    ".txt": (TextLoader, {"encoding": "utf8"}),
-    # Add more mappings for other file extensions and loaders as needed
-}
-
-
-def load_single_document(file_path: str) -> List[Document]:
-    ext = "." + file_path.rsplit(".", 1)[-1]
-    if ext in LOADER_MAPPING:
-        loader_class, loader_args = LOADER_MAPPING[ext]
-        loader = loader_class(file_path, **loader_args)
-        return loader.load()
-
-    raise ValueError(f"Unsupported file extension '{ext}'")
-
-def load_documents(source_dir: str, ignored_files: List[str] = []) -> List[Document]:
-    """
-    Loads all documents from the source documents directory, ignoring specified files
-    """
-    all_files = []
-    for ext in LOADER_MAPPING:
-        all_files.extend(
-            glob.glob(os.path.join(source_dir, f"**/*{ext}"), recursive=True)
-        )
-    filtered_files = [file_path for file_path in all_files if file_path not in ignored_files]
-
-    with Pool(processes=os.cpu_count()) as pool:
-        results = []
-        with tqdm(total=len(filtered_files), desc='Loading new documents', ncols=80) as pbar:
-            for i, docs in enumerate(pool.imap_unordered(load_single_document, filtered_files)):
-                results.extend(docs)
-                pbar.update()
-
-    return results
-
-def process_documents(ignored_files: List[str] = []) -> List[Document]:
-    """
-    Load documents and split in chunks
-    """
-    print(f"Loading documents from {source_directory}")
-    documents = load_documents(source_directory, ignored_files)
-    if not documents:
-        print("No new documents to load")
-        exit(0)
-    print(f"Loaded {len(documents)} new documents from {source_directory}")
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    texts = text_splitter.split_documents(documents)
-    print(f"Split into {len(texts)} chunks of text (max. {chunk_size} tokens each)")
-    return texts
-
-def does_vectorstore_exist(persist_directory: str) -> bool:
-    """
-    Checks if vectorstore exists
-    """
-    if os.path.exists(os.path.join(persist_directory, 'index')):
-        if os.path.exists(os.path.join(persist_directory, 'chroma-collections.parquet')) and os.path.exists(os.path.join(persist_directory, 'chroma-embeddings.parquet')):
-            list_index_files = glob.glob(os.path.join(persist_directory, 'index/*.bin'))
-            list_index_files += glob.glob(os.path.join(persist_directory, 'index/*.pkl'))
-            # At least 3 documents are needed in a working vectorstore
-            if len(list_index_files) > 3:
-                return True
-    return False
-
-def main():
+# Vectorstores written to when --vectorstore is not given, comma separated
+ingest_vectorstores = os.environ.get('INGEST_VECTORSTORES', 'chroma,keyword')
+# Number of chunks embedded and added to the vectorstore at a time
+ingest_batch_size = int(os.environ.get('INGEST_BATCH_SIZE', 256))
+# Persist the vectorstore and the manifest every N batches
+ingest_persist_every = int(os.environ.get('INGEST_PERSIST_EVERY', 10))
+# File discovery: comma separated glob patterns relative to the source directory, symlink policy and depth limit
+ingest_include = os.environ.get('INGEST_INCLUDE', '')
+ingest_exclude = os.environ.get('INGEST_EXCLUDE', '')
+ingest_symlinks = os.environ.get('INGEST_SYMLINKS', 'follow')
+ingest_max_depth = os.environ.get('INGEST_MAX_DEPTH')
+# Loader fault isolation: per file timeout in seconds, worker recycling after N files or past an RSS limit in MB
+ingest_file_timeout = float(os.environ.get('INGEST_FILE_TIMEOUT', 600))
+ingest_max_tasks_per_worker = int(os.environ.get('INGEST_MAX_TASKS_PER_WORKER', 200))
+ingest_worker_max_rss_mb = int(os.environ.get('INGEST_WORKER_MAX_RSS_MB', 2048))
+# Split large PDFs into ranges of this many pages loaded in parallel, 0 to load every PDF in one task
+ingest_pdf_pages_per_task = int(os.environ.get('INGEST_PDF_PAGES_PER_TASK', 50))
+# Only re-embed the pages whose text changed when a PDF is edited
+ingest_skip_unchanged_pages = os.environ.get('INGEST_SKIP_UNCHANGED_PAGES', 'True').lower() == 'true'
+
+
+def main(argv=None):
+    # Parse the command line arguments
+    args = parse_arguments(argv)
+    sinks = [create_sink(sink_type) for sink_type in dict.fromkeys(args.vectorstore)]
     # Create embeddings
-    embeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name)
-    print(f'Loaded embeddings model: {embeddings_model_name}')
-    if does_vectorstore_exist(persist_directory):
-        # Update and store locally vectorstore
-        print(f"Appending to existing vectorstore at {persist_directory}")
-        db = Chroma(persist_directory=persist_directory, embedding_function=embeddings, client_settings=CHROMA_SETTINGS)
-        collection = db.get()
-        texts = process_documents([metadata['source'] for metadata in collection['metadatas']])
-        print(f"Creating embeddings. May take some minutes...")
-        db.add_documents(texts)
-    else:
-        # Create and store locally vectorstore
-        print("Creating new vectorstore")
-        texts = process_documents()
-        print(f"Creating embeddings. May take some minutes...")
-        db = Chroma.from_documents(texts, embeddings, persist_directory=persist_directory, client_settings=CHROMA_SETTINGS)
-    db.persist()
-    db = None
+    embeddings = create_embeddings(embeddings_model_name)
+    print(f'Loaded embeddings model: {embeddings_model_name} (batch size {embeddings.batch_size}, {embeddings.workers} worker(s))')
+
+    pipeline = IngestionPipeline(sinks, embeddings, source_directory,
+                                 batch_size=ingest_batch_size,
+                                 persist_every=ingest_persist_every,
+                                 include=args.include,
+                                 exclude=args.exclude,
+                                 symlinks=args.symlinks,
+                                 max_depth=args.max_depth,
+                                 file_timeout=ingest_file_timeout,
+                                 max_tasks_per_worker=ingest_max_tasks_per_worker,
+                                 max_worker_rss_mb=ingest_worker_max_rss_mb,
+                                 retry_failed=args.retry_failed,
+                                 pdf_pages_per_task=ingest_pdf_pages_per_task,
+                                 skip_unchanged_pages=ingest_skip_unchanged_pages,
+                                 dedup=create_dedup_detector('INGEST_DEDUP_THRESHOLD', 0))
+    pipeline.run()
+
+    print(embeddings.throughput_report())
+    embeddings.close()
 
     print(f"Ingestion complete! You can now run privateGPT.py to query your documents")
 
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Ingest the documents of the source directory into one or more local vectorstores. '
+                                                 'Each document is loaded and embedded once, whatever the number of vectorstores.')
+    parser.add_argument("--vectorstore", "-V", nargs='+', choices=SINK_TYPES,
+                        default=ingest_vectorstores.split(','),
+                        help='Vectorstores to write to, keyword being the keyword index of hybrid search. Defaults to INGEST_VECTORSTORES or chroma keyword.')
+
+    parser.add_argument("--include", nargs='+', default=[p for p in ingest_include.split(',') if p],
+                        help='Only ingest files whose path relative to the source directory matches one of these glob patterns.')
+
+    parser.add_argument("--exclude", nargs='+', default=[p for p in ingest_exclude.split(',') if p],
+                        help='Skip files and directories whose path relative to the source directory matches one of these glob patterns.')
+
+    parser.add_argument("--symlinks", choices=SYMLINK_POLICIES, default=ingest_symlinks,
+                        help='skip: ignore symlinks, files: follow links to files only, follow: follow links to files and directories.')
+
+    parser.add_argument("--max-depth", type=int, default=int(ingest_max_depth) if ingest_max_depth else None,
+                        help='Maximum number of directory levels below the source directory to visit.')
+
+    parser.add_argument("--retry-failed", action='store_true',
+                        help='Retry the quarantined documents that failed to load in a previous run, even if they did not change.')
+
+    return parser.parse_args(argv)
+
 
 if __name__ == "__main__":
     main()
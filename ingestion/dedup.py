@@ -0,0 +1,127 @@
+import os
+import re
+import zlib
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Prime modulus of the MinHash permutations, shingle hashes are reduced below it
+MERSENNE_PRIME = (1 << 31) - 1
+# Duplicates listed by a report
+REPORT_EXAMPLES = 10
+
+
+def shingle_hashes(text: str, size: int = 3) -> np.ndarray:
+    """
+    Hashes of the word size-grams of a text, the whole text for shorter ones
+    """
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= size:
+        shingles = {' '.join(words)}
+    else:
+        shingles = {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    return np.fromiter((zlib.crc32(shingle.encode('utf-8')) & MERSENNE_PRIME for shingle in shingles), dtype=np.uint64)
+
+
+def lsh_bands(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """
+    Number of bands and rows per band splitting the signatures, chosen so that texts a little
+    less similar than threshold already share a bucket with high probability
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        # Similarity at which two texts share a bucket with a probability of about one half
+        if (1 / bands) ** (1 / rows) <= threshold * 0.9:
+            best = (bands, rows)
+    return best
+
+
+class NearDuplicateDetector:
+    """
+    Finds texts whose word 3-grams are near-identical to those of a text seen before, with
+    MinHash signatures banded into LSH buckets: a text is only compared with the texts sharing
+    one of its buckets, and is a duplicate when the share of equal values of their signatures,
+    an estimate of the Jaccard similarity of their 3-grams, reaches threshold.
+
+    Texts that are not duplicates are added to the index. Detection is kept in memory, over the
+    texts of a single run or until reset, and is safe to use from several threads.
+    """
+
+    def __init__(self, threshold: float = 0.9, num_perm: int = 64, shingle_size: int = 3, seed: int = 1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.bands, self.rows = lsh_bands(num_perm, threshold)
+        self.buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(self.bands)]
+        self.signatures: List[np.ndarray] = []
+        self.keys: List[str] = []
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.checked_chars = 0
+        self.dropped = 0
+        self.dropped_chars = 0
+        self.examples: List[Tuple[str, str, float]] = []
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = shingle_hashes(text, self.shingle_size)
+        # Products stay below 2 ** 62, so the permutations never overflow 64 bits
+        return ((np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME).min(axis=0).astype(np.uint32)
+
+    def check(self, key: str, text: str) -> Optional[str]:
+        """
+        Returns the key of a text seen before that text is a near-duplicate of, or indexes text
+        under key and returns None
+        """
+        signature = self.signature(text)
+        band_keys = [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+        with self._lock:
+            self.checked += 1
+            self.checked_chars += len(text)
+            candidates = {candidate for band, band_key in enumerate(band_keys) for candidate in self.buckets[band].get(band_key, ())}
+            for candidate in sorted(candidates):
+                similarity = float(np.mean(self.signatures[candidate] == signature))
+                if similarity >= self.threshold:
+                    self.dropped += 1
+                    self.dropped_chars += len(text)
+                    if len(self.examples) < REPORT_EXAMPLES and all((key, self.keys[candidate]) != example[:2] for example in self.examples):
+                        self.examples.append((key, self.keys[candidate], similarity))
+                    return self.keys[candidate]
+            position = len(self.signatures)
+            self.signatures.append(signature)
+            self.keys.append(key)
+            for band, band_key in enumerate(band_keys):
+                self.buckets[band].setdefault(band_key, []).append(position)
+        return None
+
+    def reset(self):
+        """
+        Empties the index, keeping the counts of the report
+        """
+        with self._lock:
+            self.buckets = [{} for _ in range(self.bands)]
+            self.signatures.clear()
+            self.keys.clear()
+
+    def report(self, items: str) -> str:
+        share = round(100 * self.dropped / self.checked, 1) if self.checked else 0.0
+        lines = [f"Near-duplicates: dropped {self.dropped} of {self.checked} {items} ({share}%, "
+                 f"{round(self.dropped_chars / 2 ** 20, 2)} of {round(self.checked_chars / 2 ** 20, 2)} MB of text) "
+                 f"at a similarity of {self.threshold} or more"]
+        lines += [f"  {key} ~ {original} ({round(similarity, 2)})" for key, original, similarity in self.examples]
+        return '\n'.join(lines)
+
+
+def create_dedup_detector(variable: str, default: float) -> Optional[NearDuplicateDetector]:
+    """
+    Builds a detector with the threshold read from the given environment variable, or returns
+    None when the threshold is 0
+    """
+    threshold = float(os.environ.get(variable, default))
+    return NearDuplicateDetector(threshold) if threshold > 0 else None
@@ -0,0 +1,75 @@
+import os
+from fnmatch import fnmatch
+from typing import Iterable, List, Optional
+
+# skip: ignore every symlink, files: follow links to files only, follow: follow links to files and directories
+SYMLINK_POLICIES = ['skip', 'files', 'follow']
+
+
+def _matches(relative_path: str, patterns: Optional[List[str]]) -> bool:
+    return any(fnmatch(relative_path, pattern) for pattern in patterns or [])
+
+
+def discover_files(source_dir: str, extensions: Iterable[str], include: Optional[List[str]] = None,
+                   exclude: Optional[List[str]] = None, symlinks: str = 'follow',
+                   max_depth: Optional[int] = None) -> List[str]:
+    """
+    Walks the source directory once with os.scandir and returns the files whose lowercased
+    extension is in extensions.
+
+    include and exclude are glob patterns matched against the path relative to source_dir,
+    with forward slashes. A file must match at least one include pattern when any are given,
+    and must not match an exclude pattern. Excluded directories are not descended into.
+    max_depth limits how many directory levels below source_dir are visited (0 means only
+    source_dir itself). When following directory symlinks, every directory is visited once
+    by its real path, so link loops terminate.
+    """
+    if symlinks not in SYMLINK_POLICIES:
+        raise ValueError(f"Unsupported symlink policy '{symlinks}'. Please choose one of the following: {', '.join(SYMLINK_POLICIES)}")
+    extensions = {ext.lower() for ext in extensions}
+    follow_dirs = symlinks == 'follow'
+    visited = {os.path.realpath(source_dir)} if follow_dirs else set()
+
+    found = []
+    stack = [(source_dir, 0)]
+    while stack:
+        directory, depth = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            print(f"Unable to read directory {directory}: {e}")
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_symlink() and symlinks == 'skip':
+                        continue
+                    relative_path = os.path.relpath(entry.path, source_dir).replace(os.sep, '/')
+                    if entry.is_dir(follow_symlinks=follow_dirs):
+                        if max_depth is not None and depth >= max_depth:
+                            continue
+                        if _matches(relative_path, exclude):
+                            continue
+                        if follow_dirs:
+                            real_path = os.path.realpath(entry.path)
+                            if real_path in visited:
+                                continue
+                            visited.add(real_path)
+                        stack.append((entry.path, depth + 1))
+                        continue
+                    if not entry.is_file():
+                        # Broken links, sockets, ...
+                        continue
+                except OSError:
+                    continue
+
+                if os.path.splitext(entry.name)[1].lower() not in extensions:
+                    continue
+                if include and not _matches(relative_path, include):
+                    continue
+                if _matches(relative_path, exclude):
+                    continue
+                found.append(entry.path)
+
+    found.sort()
+    return found
@@ -0,0 +1,141 @@
+import os
+import time
+import multiprocessing
+from typing import List, Optional, Tuple
+
+from langchain.embeddings.base import Embeddings
+from langchain.embeddings import HuggingFaceEmbeddings
+
+from ingestion.embedding_cache import CachedEmbeddings, open_embedding_cache
+
+# Model held by each embedding worker process
+_worker_model = None
+
+
+def _init_worker(model_name: str, threads_per_worker: int):
+    global _worker_model
+    try:
+        import torch
+        # Keep the workers from oversubscribing the cores between them
+        torch.set_num_threads(threads_per_worker)
+    except ImportError:
+        pass
+    _worker_model = HuggingFaceEmbeddings(model_name=model_name)
+
+
+def _embed_batch_in_worker(texts: List[str]) -> Tuple[List[List[float]], int]:
+    return embed_batch(_worker_model, texts)
+
+
+def _embed_query_in_worker(text: str) -> List[float]:
+    return _worker_model.embed_query(text)
+
+
+def count_tokens(model: HuggingFaceEmbeddings, texts: List[str]) -> int:
+    """
+    Counts the tokens the model actually sees for the given texts, after truncation
+    """
+    client = model.client
+    encoded = client.tokenizer(texts, truncation=True, max_length=client.max_seq_length)
+    return sum(len(input_ids) for input_ids in encoded['input_ids'])
+
+
+def embed_batch(model: HuggingFaceEmbeddings, texts: List[str]) -> Tuple[List[List[float]], int]:
+    """
+    Embeds texts as a single model batch, returning the vectors and the number of tokens processed
+    """
+    return model.embed_documents(texts), count_tokens(model, texts)
+
+
+class EmbeddingEngine(Embeddings):
+    """
+    Embeddings implementation that splits texts into fixed size batches and spreads them
+    over a pool of worker processes, each holding its own copy of the model.
+
+    With sort_by_length the texts are ordered by length before batching, so every batch
+    holds texts of similar length and little compute is wasted on padding. Vectors are
+    always returned in the order of the input texts.
+    """
+
+    def __init__(self, model_name: str, batch_size: int = 32, workers: int = 1, sort_by_length: bool = True):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.workers = max(1, workers)
+        self.sort_by_length = sort_by_length
+        self.chunks_embedded = 0
+        self.tokens_embedded = 0
+        self.seconds_embedding = 0.0
+        self._model: Optional[HuggingFaceEmbeddings] = None
+        self._pool = None
+
+    def _local_model(self) -> HuggingFaceEmbeddings:
+        if self._model is None:
+            self._model = HuggingFaceEmbeddings(model_name=self.model_name)
+        return self._model
+
+    def _worker_pool(self):
+        if self._pool is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // self.workers)
+            # Spawn rather than fork so workers never inherit an initialised torch runtime
+            context = multiprocessing.get_context('spawn')
+            self._pool = context.Pool(processes=self.workers,
+                                      initializer=_init_worker,
+                                      initargs=(self.model_name, threads_per_worker))
+        return self._pool
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        start = time.time()
+        order = list(range(len(texts)))
+        if self.sort_by_length:
+            order.sort(key=lambda i: len(texts[i]), reverse=True)
+        batches = [[texts[i] for i in order[pos:pos + self.batch_size]]
+                   for pos in range(0, len(order), self.batch_size)]
+
+        if self.workers > 1:
+            results = self._worker_pool().imap(_embed_batch_in_worker, batches)
+        else:
+            model = self._local_model()
+            results = (embed_batch(model, batch) for batch in batches)
+
+        vectors: List[Optional[List[float]]] = [None] * len(texts)
+        pos = 0
+        for batch_vectors, batch_tokens in results:
+            for vector in batch_vectors:
+                vectors[order[pos]] = vector
+                pos += 1
+            self.tokens_embedded += batch_tokens
+
+        self.chunks_embedded += len(texts)
+        self.seconds_embedding += time.time() - start
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.workers > 1:
+            return self._worker_pool().apply(_embed_query_in_worker, (text,))
+        return self._local_model().embed_query(text)
+
+    def throughput_report(self) -> str:
+        seconds = max(self.seconds_embedding, 1e-9)
+        return (f"Embedded {self.chunks_embedded} chunks ({self.tokens_embedded} tokens) in {round(self.seconds_embedding, 2)} s. "
+                f"({round(self.chunks_embedded / seconds, 1)} chunks/s, {round(self.tokens_embedded / seconds, 1)} tokens/s)")
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def create_embeddings(model_name: str, workers: Optional[int] = None) -> Embeddings:
+    """
+    Builds the embedding engine configured through the EMBEDDINGS_* environment variables,
+    behind the on-disk embeddings cache unless it is disabled
+    """
+    engine = EmbeddingEngine(model_name,
+                             batch_size=int(os.environ.get('EMBEDDINGS_BATCH_SIZE', 32)),
+                             workers=workers or int(os.environ.get('EMBEDDINGS_WORKERS', 1)),
+                             sort_by_length=os.environ.get('EMBEDDINGS_SORT_BY_LENGTH', 'True').lower() == 'true')
+    cache = open_embedding_cache(model_name)
+    return engine if cache is None else CachedEmbeddings(engine, cache)
@@ -0,0 +1,168 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from typing import Dict, List, Optional
+
+from langchain.embeddings.base import Embeddings
+
+CACHE_FILE_NAME = 'embeddings_cache.sqlite'
+# SQLite limits the number of host parameters in a single statement
+SQL_BATCH_SIZE = 500
+# Lookups whose last use is kept in memory before being written, when no vectors are added meanwhile
+MAX_PENDING_TOUCHES = 10000
+
+
+def normalize_text(text: str) -> str:
+    """
+    Collapses whitespace runs, which the embedding tokenizer ignores anyway,
+    so chunks that only differ in line breaks or indentation share a cache entry
+    """
+    return ' '.join(text.split())
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of embedding vectors keyed by (model name, normalized text hash).
+
+    Vectors are stored as packed float32 blobs in a SQLite file. Once the stored vectors
+    exceed max_bytes, the least recently used entries are evicted. Lookups only note when
+    entries were used, the notes are written with the next vectors added or when closing.
+    """
+
+    def __init__(self, cache_directory: str, model_name: str, max_bytes: int):
+        os.makedirs(cache_directory, exist_ok=True)
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # Last use of the entries found since the last write
+        self._touched: Dict[str, float] = {}
+        self._conn = sqlite3.connect(os.path.join(cache_directory, CACHE_FILE_NAME), check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self._size = self._conn.execute('SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings').fetchone()[0]
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f'{self.model_name}\0{normalize_text(text)}'.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        now = time.time()
+        with self._lock:
+            for pos in range(0, len(keys), SQL_BATCH_SIZE):
+                batch = keys[pos:pos + SQL_BATCH_SIZE]
+                placeholders = ','.join('?' * len(batch))
+                rows = self._conn.execute(f'SELECT key, vector FROM embeddings WHERE key IN ({placeholders})', batch).fetchall()
+                for key, blob in rows:
+                    found[key] = array('f', blob).tolist()
+                    self._touched[key] = now
+            if len(self._touched) >= MAX_PENDING_TOUCHES:
+                self._write_touches()
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]):
+        now = time.time()
+        rows = [(key, array('f', vector).tobytes(), now) for key, vector in items.items()]
+        with self._lock:
+            # Written first, so eviction sees the entries used since the last write
+            self._write_touches()
+            # Another process may have added some of the keys already, with the same vectors
+            cursor = self._conn.executemany('INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)', rows)
+            # Vectors of one model all have the same size
+            self._size += cursor.rowcount * len(rows[0][1]) if rows else 0
+            if rows and self._size > self.max_bytes:
+                self._evict(len(rows[0][1]))
+            self._conn.commit()
+
+    def _write_touches(self):
+        if self._touched:
+            self._conn.executemany('UPDATE embeddings SET last_used = ? WHERE key = ?',
+                                   [(last_used, key) for key, last_used in self._touched.items()])
+            self._touched.clear()
+
+    def _evict(self, vector_bytes: int):
+        """
+        Drops the least recently used entries until the cache is back under 90% of its budget
+        """
+        excess = self._size - int(self.max_bytes * 0.9)
+        count = excess // max(vector_bytes, 1) + 1
+        cursor = self._conn.execute('DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)', (count,))
+        self.evictions += cursor.rowcount
+        self._size = self._conn.execute('SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings').fetchone()[0]
+
+    def stats_report(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = round(100 * self.hits / lookups, 1) if lookups else 0.0
+        return (f"Embeddings cache: {self.hits} hits, {self.misses} misses ({hit_rate}% hit rate), "
+                f"{self.evictions} evicted, {round(self._size / (1024 * 1024), 1)} MB stored")
+
+    def close(self):
+        with self._lock:
+            self._write_touches()
+            self._conn.commit()
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that serves vectors from an EmbeddingCache and only sends
+    the texts it has never seen to the wrapped embeddings
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def __getattr__(self, name):
+        # Expose the wrapped engine's settings and reports
+        if name in ('embeddings', 'cache'):
+            raise AttributeError(name)
+        return getattr(self.embeddings, name)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.cache.key(text) for text in texts]
+        vectors = self.cache.get_many(list(dict.fromkeys(keys)))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            computed = dict(zip(missing, self.embeddings.embed_documents(list(missing.values()))))
+            self.cache.put_many(computed)
+            vectors.update(computed)
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self.cache.key(text)
+        vector = self.cache.get_many([key]).get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put_many({key: vector})
+        return vector
+
+    def throughput_report(self) -> str:
+        return f"{self.embeddings.throughput_report()}\n{self.cache.stats_report()}"
+
+    def close(self):
+        self.embeddings.close()
+        self.cache.close()
+
+
+def open_embedding_cache(model_name: str) -> Optional[EmbeddingCache]:
+    """
+    Opens the cache configured through EMBEDDINGS_CACHE_DIRECTORY and EMBEDDINGS_CACHE_MAX_MB.
+    Setting EMBEDDINGS_CACHE_DIRECTORY to an empty value disables the cache.
+    """
+    cache_directory = os.environ.get('EMBEDDINGS_CACHE_DIRECTORY', 'embeddings_cache')
+    if not cache_directory:
+        return None
+    max_bytes = int(os.environ.get('EMBEDDINGS_CACHE_MAX_MB', 1024)) * 1024 * 1024
+    return EmbeddingCache(cache_directory, model_name, max_bytes)
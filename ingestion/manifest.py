@@ -0,0 +1,182 @@
+import os
+import json
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+MANIFEST_FILE_NAME = 'ingest_manifest.json'
+# Version of every page streamed into the store by the crawler, keyed by URL
+STREAMED_SOURCES_FILE_NAME = 'streamed_sources.json'
+# Files whose chunks may be partially in the store, written before their chunks are added
+IN_PROGRESS_FILE_SUFFIX = '.inprogress'
+MANIFEST_VERSION = 1
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def hash_file(file_path: str) -> str:
+    """
+    Returns the sha256 hex digest of a file's content, read in fixed size blocks
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint_file(file_path: str, sha256: Optional[str] = None) -> dict:
+    """
+    Builds the manifest entry (size, mtime and content hash) for a file
+    """
+    stat = os.stat(file_path)
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha256': sha256 or hash_file(file_path),
+    }
+
+
+def read_streamed_versions(persist_directory: str) -> Dict[str, str]:
+    try:
+        with open(os.path.join(persist_directory, STREAMED_SOURCES_FILE_NAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_streamed_versions(persist_directory: str, versions: Dict[str, str]):
+    IngestionManifest._write_json(os.path.join(persist_directory, STREAMED_SOURCES_FILE_NAME), versions)
+
+
+class IngestionManifest:
+    """
+    On-disk record of every ingested file keyed by path, with its size, mtime and content hash.
+
+    The size/mtime pair is the fast path: a file whose stat matches its entry is unchanged
+    without being read. Only files whose stat differs are hashed to tell a real edit from a touch.
+
+    Files that failed to load are kept in a quarantine with their error and are skipped until
+    they change on disk. A small in-progress journal lists the files that may have chunks in
+    the store without being recorded yet, so an interrupted run can clean them up on resume.
+
+    The settings of the text splitter the files were chunked with are recorded too, so a change of
+    tokenizer or chunk size gets every file chunked again instead of mixing chunk boundaries.
+    """
+
+    def __init__(self, manifest_path: str, entries: Optional[Dict[str, dict]] = None,
+                 quarantine: Optional[Dict[str, dict]] = None, in_progress: Optional[List[str]] = None,
+                 splitter: Optional[str] = None):
+        self.manifest_path = manifest_path
+        self.entries = entries if entries is not None else {}
+        self.quarantine = quarantine if quarantine is not None else {}
+        self.in_progress = set(in_progress or [])
+        self.splitter = splitter
+
+    @classmethod
+    def load(cls, persist_directory: str) -> 'IngestionManifest':
+        manifest_path = os.path.join(persist_directory, MANIFEST_FILE_NAME)
+        try:
+            with open(manifest_path + IN_PROGRESS_FILE_SUFFIX, 'r', encoding='utf-8') as f:
+                in_progress = json.load(f)
+        except FileNotFoundError:
+            in_progress = []
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cls(manifest_path, in_progress=in_progress)
+        return cls(manifest_path, data.get('files', {}), data.get('quarantine', {}), in_progress, data.get('splitter'))
+
+    @staticmethod
+    def _write_json(path: str, data):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def save(self):
+        """
+        Writes the manifest atomically so a crash never leaves a truncated file behind
+        """
+        self._write_json(self.manifest_path, {'version': MANIFEST_VERSION, 'splitter': self.splitter,
+                                              'files': self.entries, 'quarantine': self.quarantine})
+        self.save_in_progress()
+
+    def save_in_progress(self):
+        self._write_json(self.manifest_path + IN_PROGRESS_FILE_SUFFIX, sorted(self.in_progress))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, file_path: str) -> bool:
+        return file_path in self.entries
+
+    def record(self, file_path: str, entry: Optional[dict] = None):
+        self.entries[file_path] = entry or fingerprint_file(file_path)
+        self.quarantine.pop(file_path, None)
+        self.in_progress.discard(file_path)
+
+    def quarantine_file(self, file_path: str, error: str):
+        stat = os.stat(file_path)
+        self.quarantine[file_path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'error': error}
+        self.entries.pop(file_path, None)
+        self.in_progress.discard(file_path)
+
+    def is_quarantined(self, file_path: str) -> bool:
+        """
+        A quarantined file is retried as soon as it changes on disk
+        """
+        entry = self.quarantine.get(file_path)
+        if entry is None:
+            return False
+        stat = os.stat(file_path)
+        return stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']
+
+    def use_splitter(self, splitter: str) -> bool:
+        """
+        Records the splitter settings of this run. When they differ from the ones the recorded
+        files were chunked with, every file is marked in progress so it is replaced on this run.
+        Returns whether the files have to be chunked again.
+        """
+        rechunk = bool(self.entries) and self.splitter != splitter
+        if rechunk:
+            self.in_progress.update(self.entries)
+        self.splitter = splitter
+        return rechunk
+
+    def remove(self, file_path: str):
+        self.entries.pop(file_path, None)
+        self.in_progress.discard(file_path)
+
+    def diff(self, file_paths: List[str]) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Compares the files currently on disk against the manifest.
+        Returns (new_files, changed_files, deleted_files). Entries of touched but
+        unmodified files get their stat refreshed so they take the fast path next time.
+        Unchanged quarantined files are left out, files of an interrupted run count as changed.
+        """
+        new_files, changed_files = [], []
+        for file_path in file_paths:
+            if file_path in self.in_progress:
+                changed_files.append(file_path)
+                continue
+            entry = self.entries.get(file_path)
+            if entry is None:
+                if not self.is_quarantined(file_path):
+                    new_files.append(file_path)
+                continue
+            stat = os.stat(file_path)
+            if stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']:
+                continue
+            sha256 = hash_file(file_path) if stat.st_size == entry['size'] else None
+            if sha256 == entry['sha256']:
+                entry['mtime'] = stat.st_mtime
+            else:
+                changed_files.append(file_path)
+
+        on_disk = set(file_paths)
+        deleted_files = [file_path for file_path in self.entries if file_path not in on_disk]
+        deleted_files += [file_path for file_path in self.in_progress if file_path not in on_disk and file_path not in self.entries]
+        for file_path in [file_path for file_path in self.quarantine if file_path not in on_disk]:
+            del self.quarantine[file_path]
+        return new_files, changed_files, deleted_files
@@ -0,0 +1,73 @@
+import os
+import re
+import hashlib
+from typing import Dict
+from urllib.parse import urlparse
+
+# Substring of a document's path -> title of the game it covers, used when PARTITION_TITLES is not set
+DEFAULT_TITLE_RULES = {'elden-ring': 'elden-ring', 'diablo-ii': 'diablo-ii'}
+# Title of documents that match no rule and are not in a subdirectory of the source directory
+DEFAULT_TITLE = 'general'
+HOST_PATTERN = re.compile(r'^[a-z0-9-]+(\.[a-z0-9-]+)+$')
+
+
+def slugify(text: str) -> str:
+    return re.sub(r'[^a-z0-9.]+', '-', text.lower()).strip('-')
+
+
+def title_rules() -> Dict[str, str]:
+    """
+    Reads the title rules from PARTITION_TITLES, comma separated pattern=title pairs
+    """
+    rules = os.environ.get('PARTITION_TITLES', '')
+    if not rules:
+        return DEFAULT_TITLE_RULES
+    return {slugify(pattern): slugify(title) for pattern, _, title in (rule.partition('=') for rule in rules.split(',')) if title}
+
+
+def partition_rules_id() -> str:
+    """
+    Short fingerprint of the title rules, so documents get their metadata again when the rules change
+    """
+    rules = ','.join(f'{pattern}={title}' for pattern, title in sorted(title_rules().items()))
+    return hashlib.sha1(rules.encode('utf-8')).hexdigest()[:8]
+
+
+def source_domain(relative_path: str) -> str:
+    """
+    Host a crawled page came from, read from its crawler_text/<domain>/ folder or from the URL
+    its file is named after, or 'local' for other documents
+    """
+    *directories, file_name = relative_path.lower().split(os.sep)
+    # crawler.py names files after the URL without its scheme, with _ instead of /
+    candidates = directories + ([file_name.split('_')[0]] if '_' in file_name else [])
+    for candidate in candidates:
+        if HOST_PATTERN.match(candidate):
+            return candidate[4:] if candidate.startswith('www.') else candidate
+    return 'local'
+
+
+def source_metadata(file_path: str, source_directory: str, rules: Dict[str, str]) -> Dict[str, str]:
+    """
+    Partition metadata of every chunk of a document: the game it covers (title), where it
+    comes from (domain) and its file type (doc_type)
+    """
+    relative_path = os.path.relpath(file_path, source_directory)
+    slug = slugify(relative_path)
+    title = next((title for pattern, title in rules.items() if pattern in slug), None)
+    if title is None:
+        directories = os.path.dirname(relative_path).split(os.sep)
+        title = slugify(directories[0]) if directories[0] else DEFAULT_TITLE
+    return {'title': title, 'domain': source_domain(relative_path),
+            'doc_type': os.path.splitext(file_path)[1].lower().lstrip('.')}
+
+
+def page_metadata(url: str, rules: Dict[str, str]) -> Dict[str, str]:
+    """
+    Partition metadata of the chunks of a page streamed from the crawler, read from its URL as
+    it is from the path of a document, with html as its doc_type
+    """
+    slug = slugify(url.split('://', 1)[-1])
+    title = next((title for pattern, title in rules.items() if pattern in slug), DEFAULT_TITLE)
+    host = (urlparse(url).hostname or '').lower()
+    return {'title': title, 'domain': host[4:] if host.startswith('www.') else host or 'local', 'doc_type': 'html'}
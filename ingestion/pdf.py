@@ -0,0 +1,38 @@
+import hashlib
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import fitz
+from langchain.docstore.document import Document
+
+from ingestion.splitter import TokenTextSplitter
+
+
+def hash_page_text(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def extract_pdf_chunks(file_path: str, text_splitter: TokenTextSplitter, pages: Optional[Tuple[int, int]] = None,
+                       known_page_hashes: Optional[Sequence[str]] = None) -> Tuple[List[Document], Dict[int, str]]:
+    """
+    Extracts a page range of a PDF (the whole file when pages is None) and splits the text of all
+    its pages in a single tokenizer batch, without building an intermediate Document per page.
+
+    MuPDF only reads the objects of the requested pages, so workers extracting different ranges of the
+    same file share its pages through the OS cache. Pages whose text hash matches known_page_hashes
+    were already ingested and produce no chunks. Returns the chunks, carrying the same metadata as
+    PyMuPDFLoader, and the text hash of every page in the range.
+    """
+    texts, metadatas, page_hashes = [], [], {}
+    with fitz.open(file_path) as doc:
+        metadata = {k: doc.metadata[k] for k in doc.metadata if type(doc.metadata[k]) in [str, int]}
+        first, last = pages or (0, doc.page_count)
+        for page in doc.pages(first, last):
+            text = page.get_text()
+            page_hash = hash_page_text(text)
+            page_hashes[page.number] = page_hash
+            if known_page_hashes is not None and page.number < len(known_page_hashes) and known_page_hashes[page.number] == page_hash:
+                continue
+            page_metadata = dict({"source": file_path, "file_path": file_path, "page": page.number, "total_pages": len(doc)}, **metadata)
+            texts.append(text)
+            metadatas.append(page_metadata)
+    return text_splitter.create_documents(texts, metadatas), page_hashes
@@ -0,0 +1,336 @@
+import os
+import time
+from collections import Counter
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from tqdm import tqdm
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+
+from ingestion.dedup import NearDuplicateDetector
+from ingestion.discovery import discover_files
+from ingestion.loaders import LOADER_MAPPING, LoadResult, load_task
+from ingestion.manifest import fingerprint_file
+from ingestion.partitions import source_metadata, title_rules
+from ingestion.scheduler import LoadTask, plan_tasks
+from ingestion.sinks import VectorStoreSink
+from ingestion.splitter import splitter_id, splitter_settings
+from ingestion.workers import LoaderPool
+
+
+def iter_documents(tasks: List[LoadTask], pool: LoaderPool) -> Iterator[Tuple[LoadTask, Optional[LoadResult], Optional[str]]]:
+    """
+    Loads the given tasks in parallel and yields (task, result, error) as they are ready.
+    Each worker holds a single task at a time, so loaders never run far ahead of the consumer.
+    """
+    with tqdm(total=len(tasks), desc='Loading new documents', ncols=80) as pbar:
+        for task, result, error in pool.imap_unordered(tasks):
+            pbar.update()
+            yield task, result, error
+
+
+class IngestionPipeline:
+    """
+    Streams documents through load -> split -> embed -> persist in fixed size batches of chunks.
+
+    Every document is loaded, split and embedded once, whatever the number of sinks. Each sink
+    only receives the chunks of the files its own manifest reports as new or changed.
+
+    Changed PDFs whose previous version has page hashes in every target manifest are updated page
+    by page: unchanged pages are skipped by the extractor and only the chunks of changed pages are replaced.
+
+    With a NearDuplicateDetector, chunks nearly identical to a chunk seen earlier in the run, such
+    as the navigation and tables repeated across the pages of a wiki, are dropped before embedding.
+    The manifest entry of a file records the files its dropped chunks duplicate, and the file is
+    ingested again as soon as one of them changes, is deleted or fails to load.
+
+    A file that fails, hangs or crashes its loader is quarantined instead of stopping the run.
+    Every checkpoint persists the sinks and records the finished files, and the files whose chunks
+    are being added are journaled first, so an interrupted run resumes where it stopped.
+    """
+
+    def __init__(self, sinks: List[VectorStoreSink], embeddings: Embeddings, source_directory: str,
+                 batch_size: int = 256, persist_every: int = 10, include: Optional[List[str]] = None,
+                 exclude: Optional[List[str]] = None, symlinks: str = 'follow', max_depth: Optional[int] = None,
+                 file_timeout: Optional[float] = None, max_tasks_per_worker: Optional[int] = None,
+                 max_worker_rss_mb: Optional[int] = None, retry_failed: bool = False, pdf_pages_per_task: int = 50,
+                 skip_unchanged_pages: bool = True, dedup: Optional[NearDuplicateDetector] = None):
+        self.sinks = sinks
+        self.embeddings = embeddings
+        self.source_directory = source_directory
+        self.batch_size = batch_size
+        self.persist_every = persist_every
+        self.include = include
+        self.exclude = exclude
+        self.symlinks = symlinks
+        self.max_depth = max_depth
+        self.retry_failed = retry_failed
+        self.pdf_pages_per_task = pdf_pages_per_task
+        self.skip_unchanged_pages = skip_unchanged_pages
+        self.dedup = dedup
+        self.targets: Dict[str, List[VectorStoreSink]] = {}
+        # Previous page hashes of the PDFs updated page by page, and the page hashes of the files being loaded
+        self.known_page_hashes: Dict[str, Sequence[str]] = {}
+        self.page_hashes: Dict[str, Dict[int, str]] = {}
+        # Files whose chunks were dropped as near-duplicates -> files holding the chunks they duplicate
+        self.duplicate_sources: Dict[str, Set[str]] = {}
+        # Unchanged files ingested again because a file they duplicate changed, never updated page by page
+        self.reingested: Set[str] = set()
+        self.splitter_id = splitter_id()
+        self.title_rules = title_rules()
+        # Every loader worker tokenizes on its own, tokenizer threads would only compete with the other workers
+        os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+        self.pool = LoaderPool(load_task, os.cpu_count(),
+                               task_timeout=file_timeout,
+                               max_tasks_per_worker=max_tasks_per_worker,
+                               max_rss_bytes=max_worker_rss_mb * 1024 * 1024 if max_worker_rss_mb else None)
+
+    def discover(self) -> List[str]:
+        start = time.time()
+        file_paths = discover_files(self.source_directory, LOADER_MAPPING, include=self.include, exclude=self.exclude,
+                                    symlinks=self.symlinks, max_depth=self.max_depth)
+        print(f"Discovered {len(file_paths)} documents in {self.source_directory} in {round(time.time() - start, 2)} s.")
+        return file_paths
+
+    def open_sinks(self):
+        for sink in self.sinks:
+            if sink.exists():
+                print(f"Appending to existing {sink.name} vectorstore at {sink.persist_directory}")
+                sink.open(self.embeddings)
+                if not len(sink.manifest):
+                    # Seed the manifest of a store created before manifests existed
+                    print(f"No ingestion manifest found, building it from the existing {sink.name} vectorstore")
+                    for source in sink.known_sources():
+                        if os.path.exists(source):
+                            sink.manifest.record(source)
+            else:
+                print(f"Creating new {sink.name} vectorstore at {sink.persist_directory}")
+                sink.open(self.embeddings)
+                # A manifest without its vectorstore describes chunks that no longer exist
+                sink.manifest.entries.clear()
+
+    def plan(self, file_paths: List[str]):
+        """
+        Diffs every sink's manifest against the files on disk, drops the chunks of changed and
+        deleted files, and works out the sinks each file has to be ingested into
+        """
+        diffs = []
+        for sink in self.sinks:
+            if self.retry_failed:
+                sink.manifest.quarantine.clear()
+            elif sink.manifest.quarantine:
+                print(f"[{sink.name}] Skipping {len(sink.manifest.quarantine)} quarantined documents until they change, use --retry-failed to retry them now")
+            if sink.manifest.use_splitter(self.splitter_id):
+                print(f"[{sink.name}] Documents were split with different settings, every document will be split again with {self.splitter_id}")
+            new_files, changed_files, deleted_files = sink.manifest.diff(file_paths)
+            changed_files += self.dependent_files(sink, new_files, changed_files, deleted_files)
+            print(f"[{sink.name}] Found {len(new_files)} new, {len(changed_files)} changed and {len(deleted_files)} deleted documents")
+            diffs.append((sink, changed_files, deleted_files))
+            for file_path in new_files + changed_files:
+                self.targets.setdefault(file_path, []).append(sink)
+
+        for file_path, sinks in self.targets.items():
+            page_hashes = self.previous_page_hashes(file_path, sinks)
+            if page_hashes is not None:
+                self.known_page_hashes[file_path] = page_hashes
+
+        for sink, changed_files, deleted_files in diffs:
+            # Drop stale chunks so edited documents are replaced instead of duplicated
+            sink.delete_sources([file_path for file_path in changed_files if file_path not in self.known_page_hashes] + deleted_files)
+            for file_path in deleted_files:
+                sink.manifest.remove(file_path)
+
+    def dependent_files(self, sink: VectorStoreSink, new_files: List[str], changed_files: List[str],
+                        deleted_files: List[str]) -> List[str]:
+        """
+        Unchanged files with chunks dropped as near-duplicates of a file that changed, was deleted
+        or is not fully ingested, which must be ingested again to get those chunks back
+        """
+        stale = set(changed_files) | set(deleted_files)
+        targets = set(new_files) | stale
+        dependents = []
+        for file_path, entry in sink.manifest.entries.items():
+            originals = entry.get('duplicates_of')
+            if file_path in targets or not originals:
+                continue
+            if any(original in stale or original not in sink.manifest.entries for original in originals):
+                dependents.append(file_path)
+                self.reingested.add(file_path)
+        if dependents:
+            print(f"[{sink.name}] {len(dependents)} documents with chunks duplicating changed documents will be ingested again")
+        return dependents
+
+    def previous_page_hashes(self, file_path: str, sinks: List[VectorStoreSink]) -> Optional[Sequence[str]]:
+        """
+        Page hashes of the ingested version of a changed PDF, when every target sink holds that same
+        version completely, which is what allows updating it page by page
+        """
+        if not self.skip_unchanged_pages or os.path.splitext(file_path)[1].lower() != ".pdf" or file_path in self.reingested:
+            return None
+        versions = []
+        for sink in sinks:
+            if file_path in sink.manifest.in_progress:
+                return None
+            versions.append(sink.manifest.entries.get(file_path, {}).get('page_hashes'))
+        if versions[0] is None or any(version != versions[0] for version in versions):
+            return None
+        return versions[0]
+
+    def iter_chunk_batches(self, failures: List[Tuple[str, str]]) -> Iterator[Tuple[List[Document], List[str], List[str]]]:
+        """
+        Collects the chunks of documents as the loader workers load and split them, and yields (chunks, chunk_files, completed_files) in batches
+        of batch_size chunks. chunk_files holds the file each chunk came from and completed_files lists
+        the files whose chunks are all contained in this batch or an earlier one.
+        Files with a task that failed to load are appended to failures with their error instead,
+        and their remaining chunks are dropped.
+        """
+        tasks = plan_tasks(list(self.targets), self.pdf_pages_per_task, self.known_page_hashes)
+        remaining_tasks = Counter(task.file_path for task in tasks)
+        failed_files = set()
+        batch, batch_files, completed_files = [], [], []
+        metadata = {}
+        for task, result, error in iter_documents(tasks, self.pool):
+            file_path = task.file_path
+            if file_path in failed_files:
+                continue
+            if error is not None:
+                print(f"\nFailed to load {task}: {error}")
+                failures.append((file_path, error))
+                failed_files.add(file_path)
+                kept = [i for i, chunk_file in enumerate(batch_files) if chunk_file != file_path]
+                batch, batch_files = [batch[i] for i in kept], [batch_files[i] for i in kept]
+                continue
+            if result.page_hashes is not None:
+                self.page_hashes.setdefault(file_path, {}).update(result.page_hashes)
+                if file_path in self.known_page_hashes:
+                    self.replace_pages(file_path, result.page_hashes)
+            if file_path not in metadata:
+                metadata[file_path] = source_metadata(file_path, self.source_directory, self.title_rules)
+            for chunk in result.documents:
+                original = self.dedup.check(file_path, chunk.page_content) if self.dedup is not None else None
+                if original is not None:
+                    if original != file_path:
+                        self.duplicate_sources.setdefault(file_path, set()).add(original)
+                    continue
+                chunk.metadata.update(metadata[file_path])
+                batch.append(chunk)
+                batch_files.append(file_path)
+                if len(batch) == self.batch_size:
+                    yield batch, batch_files, completed_files
+                    batch, batch_files, completed_files = [], [], []
+            remaining_tasks[file_path] -= 1
+            if not remaining_tasks[file_path]:
+                if file_path in self.known_page_hashes:
+                    # Pages past the end of the new version
+                    removed_pages = list(range(len(self.page_hashes[file_path]), len(self.known_page_hashes[file_path])))
+                    self.delete_pages(file_path, removed_pages)
+                completed_files.append(file_path)
+        if batch or completed_files:
+            yield batch, batch_files, completed_files
+
+    def replace_pages(self, file_path: str, page_hashes: Dict[int, str]):
+        """
+        Deletes the previous chunks of the pages whose text changed, before their new chunks are added
+        """
+        known_page_hashes = self.known_page_hashes[file_path]
+        changed_pages = [page for page, page_hash in page_hashes.items()
+                         if page >= len(known_page_hashes) or known_page_hashes[page] != page_hash]
+        self.delete_pages(file_path, changed_pages)
+
+    def delete_pages(self, file_path: str, pages: List[int]):
+        if not pages:
+            return
+        for sink in self.targets[file_path]:
+            self.journal(sink, [file_path])
+            sink.delete_pages(file_path, pages)
+
+    def journal(self, sink: VectorStoreSink, file_paths: List[str]):
+        """
+        Marks files as in progress on disk before any of their chunks reach the sink
+        """
+        new_files = set(file_paths) - sink.manifest.in_progress
+        if new_files:
+            sink.manifest.in_progress.update(new_files)
+            sink.manifest.save_in_progress()
+
+    def checkpoint(self, completed_files: List[str], failures: List[Tuple[str, str]]):
+        """
+        Persists every sink, then records the files whose chunks are now on disk and quarantines the failed ones
+        """
+        for sink in self.sinks:
+            sink.persist()
+        for file_path in completed_files:
+            if not os.path.exists(file_path):
+                # Removed while it was being ingested, the next run deletes its chunks
+                continue
+            entry = fingerprint_file(file_path)
+            if file_path in self.page_hashes:
+                page_hashes = self.page_hashes.pop(file_path)
+                entry['page_hashes'] = [page_hashes[page] for page in range(len(page_hashes))]
+            if file_path in self.duplicate_sources:
+                entry['duplicates_of'] = sorted(self.duplicate_sources.pop(file_path))
+            for sink in self.targets[file_path]:
+                sink.manifest.record(file_path, dict(entry))
+        for file_path, error in failures:
+            for sink in self.targets[file_path]:
+                if file_path in sink.manifest.in_progress or file_path in self.known_page_hashes:
+                    # Other page ranges, or the previous version of the file, may still be in the store
+                    sink.delete_sources([file_path])
+                if os.path.exists(file_path):
+                    sink.manifest.quarantine_file(file_path, error)
+                else:
+                    sink.manifest.in_progress.discard(file_path)
+        for sink in self.sinks:
+            sink.manifest.save()
+        completed_files.clear()
+
+    def run(self):
+        self.open_sinks()
+        print(f"Loading documents from {self.source_directory}")
+        self.plan(self.discover())
+        if not self.targets:
+            print("No new documents to load")
+        else:
+            print(f"Creating embeddings in batches of {self.batch_size} chunks. May take some minutes...")
+
+        total_chunks, completed_files, failures = 0, [], []
+        batches = self.iter_chunk_batches(failures)
+        try:
+            for batch_number, (batch, batch_files, batch_completed) in enumerate(batches, start=1):
+                if batch:
+                    texts = [chunk.page_content for chunk in batch]
+                    metadatas = [chunk.metadata for chunk in batch]
+                    # Only embed the chunks a vectorstore needs, a keyword index alone does not
+                    embedded = [i for i, file_path in enumerate(batch_files)
+                                if any(sink.needs_vectors for sink in self.targets[file_path])]
+                    vectors = [None] * len(batch)
+                    for i, vector in zip(embedded, self.embeddings.embed_documents([texts[i] for i in embedded])):
+                        vectors[i] = vector
+                    for sink in self.sinks:
+                        selected = [i for i, file_path in enumerate(batch_files) if sink in self.targets[file_path]]
+                        if selected:
+                            self.journal(sink, [batch_files[i] for i in selected])
+                            sink.add([texts[i] for i in selected], [vectors[i] for i in selected], [metadatas[i] for i in selected])
+                total_chunks += len(batch)
+                completed_files.extend(batch_completed)
+                if batch_number % self.persist_every == 0:
+                    self.checkpoint(completed_files, failures)
+        except KeyboardInterrupt:
+            print("\nInterrupted, saving a checkpoint. Run the ingestion again to resume.")
+            raise
+        finally:
+            batches.close()
+            self.checkpoint(completed_files, failures)
+            for sink in self.sinks:
+                sink.close()
+
+        if self.targets:
+            print(f"Loaded {len(self.targets) - len(failures)} new documents from {self.source_directory}")
+            print(f"Split into {total_chunks} chunks of text (max. {splitter_settings()[1]} tokens each)")
+            if self.dedup is not None:
+                print(self.dedup.report('chunks'))
+            print(self.pool.utilization_report())
+        if failures:
+            print(f"{len(failures)} documents failed to load and were quarantined:")
+            for file_path, error in failures:
+                print(f"  {file_path}: {error}")
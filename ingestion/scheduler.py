@@ -0,0 +1,73 @@
+import os
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import fitz
+
+# Relative cost of loading one byte of each file type, used to start the slowest files first
+LOADER_COST = {
+    ".csv": 0.3,
+    ".doc": 2.0,
+    ".docx": 1.5,
+    ".enex": 1.0,
+    ".eml": 1.0,
+    ".epub": 2.0,
+    ".html": 1.0,
+    ".md": 0.5,
+    ".odt": 1.5,
+    ".pdf": 1.0,
+    ".ppt": 3.0,
+    ".pptx": 3.0,
+    ".txt": 0.2,
+}
+# PDFs smaller than this are never split, counting their pages is not worth it
+PDF_SPLIT_MIN_BYTES = 1024 * 1024
+
+
+class LoadTask(NamedTuple):
+    file_path: str
+    # Half-open [first, last) page range for PDFs split across workers, None to load the whole file
+    pages: Optional[Tuple[int, int]]
+    cost: float
+    # Page text hashes of the previously ingested version of a PDF, its unchanged pages are skipped
+    known_page_hashes: Optional[Sequence[str]] = None
+
+    def __str__(self) -> str:
+        if self.pages is None:
+            return self.file_path
+        return f"{self.file_path} (pages {self.pages[0] + 1}-{self.pages[1]})"
+
+
+def count_pdf_pages(file_path: str) -> int:
+    with fitz.open(file_path) as doc:
+        return doc.page_count
+
+
+def plan_tasks(file_paths: List[str], pdf_pages_per_task: int = 50,
+               known_page_hashes: Optional[Dict[str, Sequence[str]]] = None) -> List[LoadTask]:
+    """
+    Turns files into load tasks ordered longest first by estimated cost (size times type cost),
+    so the big files start early instead of leaving a single worker busy at the end.
+    Large PDFs are split into ranges of pdf_pages_per_task pages that load in parallel.
+    """
+    known_page_hashes = known_page_hashes or {}
+    tasks = []
+    for file_path in file_paths:
+        page_hashes = known_page_hashes.get(file_path)
+        ext = os.path.splitext(file_path)[1].lower()
+        size = os.path.getsize(file_path)
+        cost = size * LOADER_COST.get(ext, 1.0)
+        if ext == ".pdf" and pdf_pages_per_task and size >= PDF_SPLIT_MIN_BYTES:
+            try:
+                page_count = count_pdf_pages(file_path)
+            except Exception:
+                # Let the loader report the broken file
+                page_count = 0
+            if page_count > pdf_pages_per_task:
+                for first in range(0, page_count, pdf_pages_per_task):
+                    last = min(first + pdf_pages_per_task, page_count)
+                    tasks.append(LoadTask(file_path, (first, last), cost * (last - first) / page_count, page_hashes))
+                continue
+        tasks.append(LoadTask(file_path, None, cost, page_hashes))
+
+    tasks.sort(key=lambda task: task.cost, reverse=True)
+    return tasks
@@ -0,0 +1,272 @@
+import os
+import glob
+import uuid
+from abc import ABC, abstractmethod
+from typing import List, Set
+
+import qdrant_client
+from qdrant_client.http import models as rest
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores import Chroma
+
+from constants import CHROMA_SETTINGS
+from ingestion.manifest import IngestionManifest
+from retrieval.keyword_index import INDEX_FILE_NAME, KeywordIndex
+from retrieval.localstore import LocalVectorStore
+
+
+class VectorStoreSink(ABC):
+    """
+    Destination of the ingestion pipeline. Chunks reach a sink already embedded, so several
+    sinks can be fed from a single pass over the documents. Every sink keeps its own
+    ingestion manifest next to its store. A sink missing one of the abstract methods cannot be created.
+    """
+
+    name = ''
+    # Whether add() uses the vectors, chunks only going to sinks that do not are never embedded
+    needs_vectors = True
+
+    def __init__(self, persist_directory: str):
+        self.persist_directory = persist_directory
+        self.manifest = IngestionManifest.load(persist_directory)
+
+    @abstractmethod
+    def exists(self) -> bool:
+        """
+        Checks if the vectorstore already exists on disk
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def open(self, embeddings: Embeddings):
+        raise NotImplementedError
+
+    @abstractmethod
+    def known_sources(self) -> Set[str]:
+        """
+        Returns the source of every chunk in the store. Only used to seed a missing manifest.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def add(self, texts: List[str], vectors: List[List[float]], metadatas: List[dict]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_sources(self, sources: List[str]):
+        """
+        Removes every chunk that was ingested from the given sources
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_pages(self, source: str, pages: List[int]):
+        """
+        Removes the chunks of the given pages of a PDF
+        """
+        raise NotImplementedError
+
+    def persist(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ChromaSink(VectorStoreSink):
+    name = 'chroma'
+
+    def exists(self) -> bool:
+        if os.path.exists(os.path.join(self.persist_directory, 'index')):
+            if os.path.exists(os.path.join(self.persist_directory, 'chroma-collections.parquet')) and os.path.exists(os.path.join(self.persist_directory, 'chroma-embeddings.parquet')):
+                list_index_files = glob.glob(os.path.join(self.persist_directory, 'index/*.bin'))
+                list_index_files += glob.glob(os.path.join(self.persist_directory, 'index/*.pkl'))
+                # At least 3 documents are needed in a working vectorstore
+                if len(list_index_files) > 3:
+                    return True
+        return False
+
+    def open(self, embeddings: Embeddings):
+        self.db = Chroma(persist_directory=self.persist_directory, embedding_function=embeddings, client_settings=CHROMA_SETTINGS)
+
+    def known_sources(self) -> Set[str]:
+        collection = self.db._collection.get(include=["metadatas"])
+        return {metadata['source'] for metadata in collection['metadatas']}
+
+    def add(self, texts: List[str], vectors: List[List[float]], metadatas: List[dict]):
+        ids = [str(uuid.uuid1()) for _ in texts]
+        self.db._collection.add(ids=ids, embeddings=vectors, metadatas=metadatas, documents=texts)
+
+    def delete_sources(self, sources: List[str]):
+        for source in sources:
+            self.db._collection.delete(where={"source": source})
+
+    def delete_pages(self, source: str, pages: List[int]):
+        for page in pages:
+            self.db._collection.delete(where={"$and": [{"source": source}, {"page": page}]})
+
+    def persist(self):
+        self.db.persist()
+
+    def close(self):
+        self.db = None
+
+
+class QdrantSink(VectorStoreSink):
+    name = 'qdrant'
+    # Payload layout used by langchain.vectorstores.Qdrant, so the collection stays queryable through it
+    CONTENT_KEY = 'page_content'
+    METADATA_KEY = 'metadata'
+
+    def __init__(self, persist_directory: str, collection_name: str):
+        super().__init__(persist_directory)
+        self.collection_name = collection_name
+
+    def exists(self) -> bool:
+        qadrant_path = os.path.join(self.persist_directory, 'collection')
+        if os.path.exists(qadrant_path):
+            if os.path.exists(os.path.join(qadrant_path, '.lock')) and os.path.exists(os.path.join(self.persist_directory, 'meta.json')):
+                if os.path.exists(os.path.join(qadrant_path, self.collection_name)):
+                    list_index_files = glob.glob(os.path.join(qadrant_path, f'{self.collection_name}/*.sqlite'))
+                    # At least 1 sqlite db is needed in a working vectorstore
+                    if len(list_index_files) > 0:
+                        return True
+        return False
+
+    def open(self, embeddings: Embeddings):
+        self.client = qdrant_client.QdrantClient(path=self.persist_directory, prefer_grpc=True)
+        collections = self.client.get_collections().collections
+        self.has_collection = any(collection.name == self.collection_name for collection in collections)
+
+    def known_sources(self) -> Set[str]:
+        sources, offset = set(), None
+        while self.has_collection:
+            points, offset = self.client.scroll(self.collection_name, limit=1000, offset=offset,
+                                                with_payload=[f'{self.METADATA_KEY}.source'], with_vectors=False)
+            sources.update(point.payload[self.METADATA_KEY]['source'] for point in points)
+            if offset is None:
+                break
+        return sources
+
+    def add(self, texts: List[str], vectors: List[List[float]], metadatas: List[dict]):
+        if not self.has_collection:
+            self.client.recreate_collection(
+                collection_name=self.collection_name,
+                vectors_config=rest.VectorParams(size=len(vectors[0]), distance=rest.Distance.COSINE),
+            )
+            self.has_collection = True
+        payloads = [{self.CONTENT_KEY: text, self.METADATA_KEY: metadata} for text, metadata in zip(texts, metadatas)]
+        self.client.upsert(
+            collection_name=self.collection_name,
+            points=rest.Batch(ids=[uuid.uuid4().hex for _ in texts], vectors=vectors, payloads=payloads),
+        )
+
+    def delete_sources(self, sources: List[str]):
+        if not self.has_collection:
+            return
+        for source in sources:
+            source_filter = rest.Filter(must=[rest.FieldCondition(key=f'{self.METADATA_KEY}.source', match=rest.MatchValue(value=source))])
+            self.client.delete(collection_name=self.collection_name, points_selector=rest.FilterSelector(filter=source_filter))
+
+    def delete_pages(self, source: str, pages: List[int]):
+        if not self.has_collection or not pages:
+            return
+        page_filter = rest.Filter(must=[rest.FieldCondition(key=f'{self.METADATA_KEY}.source', match=rest.MatchValue(value=source)),
+                                        rest.FieldCondition(key=f'{self.METADATA_KEY}.page', match=rest.MatchAny(any=pages))])
+        self.client.delete(collection_name=self.collection_name, points_selector=rest.FilterSelector(filter=page_filter))
+
+    def close(self):
+        self.client.close()
+
+
+class KeywordSink(VectorStoreSink):
+    """
+    Keyword inverted index used by hybrid search, kept up to date alongside the vectorstores
+    """
+
+    name = 'keyword'
+    needs_vectors = False
+
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join(self.persist_directory, INDEX_FILE_NAME))
+
+    def open(self, embeddings: Embeddings):
+        self.index = KeywordIndex(self.persist_directory)
+
+    def known_sources(self) -> Set[str]:
+        return self.index.sources()
+
+    def add(self, texts: List[str], vectors: List[List[float]], metadatas: List[dict]):
+        self.index.add(texts, metadatas)
+
+    def delete_sources(self, sources: List[str]):
+        self.index.delete_sources(sources)
+
+    def delete_pages(self, source: str, pages: List[int]):
+        self.index.delete_pages(source, pages)
+
+    def persist(self):
+        self.index.commit()
+
+    def close(self):
+        self.index.close()
+
+
+class LocalSink(VectorStoreSink):
+    """
+    In-process store of embeddings in a memory-mapped matrix, searched without a database server
+    """
+
+    name = 'local'
+
+    def __init__(self, persist_directory: str, ivf_min_rows: int, quantization: str = 'none', pca_dimensions: int = 0):
+        super().__init__(persist_directory)
+        self.ivf_min_rows = ivf_min_rows
+        self.quantization = quantization
+        self.pca_dimensions = pca_dimensions
+
+    def exists(self) -> bool:
+        return LocalVectorStore.exists(self.persist_directory)
+
+    def open(self, embeddings: Embeddings):
+        self.store = LocalVectorStore(self.persist_directory, embeddings)
+
+    def known_sources(self) -> Set[str]:
+        return self.store.sources()
+
+    def add(self, texts: List[str], vectors: List[List[float]], metadatas: List[dict]):
+        self.store.add_vectors(texts, vectors, metadatas)
+
+    def delete_sources(self, sources: List[str]):
+        self.store.delete_sources(sources)
+
+    def delete_pages(self, source: str, pages: List[int]):
+        self.store.delete_pages(source, pages)
+
+    def persist(self):
+        self.store.persist(ivf_min_rows=self.ivf_min_rows, quantization=self.quantization, pca_dimensions=self.pca_dimensions)
+
+    def close(self):
+        self.store.close()
+
+
+SINK_TYPES = ['chroma', 'qdrant', 'keyword', 'local']
+
+
+def create_sink(sink_type: str) -> VectorStoreSink:
+    """
+    Builds a sink from the environment configuration of its vectorstore
+    """
+    match sink_type:
+        case "chroma":
+            return ChromaSink(os.environ.get('PERSIST_DIRECTORY'))
+        case "qdrant":
+            return QdrantSink(os.environ.get('PERSIST_DIRECTORY_QDRANT'), os.environ.get('QDRANT_COLLECTION_NAME'))
+        case "keyword":
+            return KeywordSink(os.environ.get('KEYWORD_INDEX_DIRECTORY', 'keyword_index'))
+        case "local":
+            return LocalSink(os.environ.get('LOCAL_STORE_DIRECTORY', 'localdb'), int(os.environ.get('LOCAL_STORE_IVF_MIN_ROWS', 50000)),
+                             quantization=os.environ.get('LOCAL_STORE_QUANTIZATION', 'none'),
+                             pca_dimensions=int(os.environ.get('LOCAL_STORE_PCA_DIMENSIONS', 0)))
+        case _default:
+            raise Exception(f"Vectorstore {sink_type} is not supported. Please choose one of the following: {', '.join(SINK_TYPES)}")
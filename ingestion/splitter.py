@@ -0,0 +1,130 @@
+import os
+from typing import List, Optional, Tuple
+
+from langchain.docstore.document import Document
+from langchain.text_splitter import TextSplitter
+from transformers import AutoTokenizer
+
+from ingestion.partitions import partition_rules_id
+
+# Splitter of the current process, built on first use so every loader worker loads the tokenizer once
+_text_splitter = None
+
+
+def splitter_settings() -> Tuple[str, int, int]:
+    """
+    Returns (tokenizer model name, chunk size, chunk overlap) from the environment, sizes in tokens
+    """
+    return (os.environ.get('EMBEDDINGS_MODEL_NAME'),
+            int(os.environ.get('CHUNK_SIZE_TOKENS', 128)),
+            int(os.environ.get('CHUNK_OVERLAP_TOKENS', 12)))
+
+
+def splitter_id() -> str:
+    """
+    Identifies how chunks are cut and labelled: the splitter settings and the title rules of
+    their partition metadata. Changing either gets every document split again.
+    """
+    return ':'.join(str(setting) for setting in splitter_settings() + (partition_rules_id(),))
+
+
+def load_tokenizer(model_name: str):
+    try:
+        return AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    except OSError:
+        # Short SentenceTransformers names such as all-MiniLM-L6-v2
+        return AutoTokenizer.from_pretrained(f"sentence-transformers/{model_name}", use_fast=True)
+
+
+def break_strength(text: str, offsets: List[Tuple[int, int]], i: int) -> int:
+    """
+    How good a chunk boundary the start of token i is: 3 between paragraphs, 2 between lines or
+    sentences, 1 between words and 0 inside a word
+    """
+    if i == 0:
+        return 3
+    previous_end, start = offsets[i - 1][1], offsets[i][0]
+    gap = text[previous_end:start]
+    if '\n\n' in gap:
+        return 3
+    if '\n' in gap or (gap and text[previous_end - 1] in '.!?'):
+        return 2
+    return 1 if gap else 0
+
+
+class TokenTextSplitter(TextSplitter):
+    """
+    Splits text into chunks of at most chunk_size tokens of the embedding model's tokenizer.
+
+    Every text is tokenized once, all texts of a call in a single batch, and the chunks are cut
+    from the token offsets: a chunk ends at the best paragraph, sentence or word boundary in its
+    second half, and the next one starts chunk_overlap tokens earlier on a word boundary, so the
+    overlap never needs the text to be tokenized again. Documents carry the character offsets of
+    their chunk in the source text as start_index and end_index.
+    """
+
+    def __init__(self, model_name: str, chunk_size: int = 128, chunk_overlap: int = 12, tokenizer=None):
+        super().__init__(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self.model_name = model_name
+        self.tokenizer = tokenizer or load_tokenizer(model_name)
+
+    def token_offsets(self, texts: List[str]) -> List[List[Tuple[int, int]]]:
+        if not texts:
+            return []
+        encoded = self.tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True,
+                                 return_attention_mask=False, return_token_type_ids=False, verbose=False)
+        return [[tuple(offset) for offset in offsets] for offsets in encoded['offset_mapping']]
+
+    def chunk_spans(self, text: str, offsets: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        """
+        Returns the (start, end) character span of every chunk of text from its token offsets
+        """
+        size, overlap = self._chunk_size, self._chunk_overlap
+        spans = []
+        start, count = 0, len(offsets)
+        while start < count:
+            end = min(start + size, count)
+            if end < count:
+                best, best_strength = end, break_strength(text, offsets, end)
+                for i in range(end - 1, start + size // 2, -1):
+                    strength = break_strength(text, offsets, i)
+                    if strength > best_strength:
+                        best, best_strength = i, strength
+                        if strength == 3:
+                            break
+                end = best
+            spans.append((offsets[start][0], offsets[end - 1][1]))
+            if end == count:
+                break
+            next_start = max(end - overlap, start + 1)
+            for i in range(next_start, end):
+                if break_strength(text, offsets, i):
+                    next_start = i
+                    break
+            else:
+                next_start = end
+            start = next_start
+        return spans
+
+    def split_text(self, text: str) -> List[str]:
+        return [text[start:end] for start, end in self.chunk_spans(text, self.token_offsets([text])[0])]
+
+    def create_documents(self, texts: List[str], metadatas: Optional[List[dict]] = None) -> List[Document]:
+        metadatas = metadatas or [{}] * len(texts)
+        documents = []
+        for text, metadata, offsets in zip(texts, metadatas, self.token_offsets(texts)):
+            for start, end in self.chunk_spans(text, offsets):
+                documents.append(Document(page_content=text[start:end],
+                                          metadata=dict(metadata, start_index=start, end_index=end)))
+        return documents
+
+
+def get_text_splitter() -> TokenTextSplitter:
+    """
+    Returns the splitter shared by every ingestion path and the SQuAD dataset generator,
+    so chunk boundaries never depend on where a document was split
+    """
+    global _text_splitter
+    if _text_splitter is None:
+        _text_splitter = TokenTextSplitter(*splitter_settings())
+    return _text_splitter
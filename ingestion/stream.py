@@ -0,0 +1,205 @@
+import os
+import time
+import queue
+import threading
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from langchain.embeddings.base import Embeddings
+
+from ingestion.dedup import NearDuplicateDetector, create_dedup_detector
+from ingestion.embedding import create_embeddings
+from ingestion.manifest import read_streamed_versions, write_streamed_versions
+from ingestion.partitions import page_metadata, title_rules
+from ingestion.sinks import VectorStoreSink, create_sink
+from ingestion.splitter import get_text_splitter, splitter_id
+
+# Pages waiting for the ingestion thread, producers block beyond it
+MAX_QUEUED_PAGES = 1000
+
+
+class StreamedPage(NamedTuple):
+    source: str
+    text: str
+    metadata: Dict[str, str]
+    # Recorded by on_persisted once the chunks of the page are on disk
+    key: str
+
+
+class StreamingIngestor:
+    """
+    Splits, embeds and adds pages to the sinks as they are produced, on a thread of its own, so
+    crawling, embedding and indexing overlap.
+
+    Pages are gathered until they make batch_size chunks or the oldest one has waited max_wait
+    seconds, then split and embedded in one call. The chunks of a page replace those of its
+    previous version, found by source. The sinks are persisted every persist_interval seconds,
+    making the pages of the last interval visible to processes opening the stores, and
+    on_persisted is called with the (source, key) of those pages. With a NearDuplicateDetector,
+    chunks nearly identical to another chunk of the same page are dropped before embedding. Pages
+    are not compared with each other, as re-crawling a page replaces all of its chunks.
+
+    Sources are URLs rather than files, so the ingestion manifests never list them and ingest.py
+    leaves their chunks alone. The key of every persisted page is recorded next to each store
+    instead, as the version the answer cache checks its answers against.
+    """
+
+    def __init__(self, sinks: List[VectorStoreSink], embeddings: Embeddings, batch_size: int = 256,
+                 max_wait: float = 2.0, persist_interval: float = 10.0,
+                 on_persisted: Optional[Callable[[List[Tuple[str, str]]], None]] = None,
+                 dedup: Optional[NearDuplicateDetector] = None):
+        self.sinks = sinks
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.persist_interval = persist_interval
+        self.on_persisted = on_persisted
+        self.dedup = dedup
+        self.key_prefix = splitter_id()
+        self.title_rules = title_rules()
+        self.queue: queue.Queue = queue.Queue(maxsize=MAX_QUEUED_PAGES)
+        self.thread = threading.Thread(target=self.run, name='ingest', daemon=True)
+        self.error: Optional[BaseException] = None
+        # Pages added to the sinks since they were last persisted
+        self.unpersisted: List[Tuple[str, str]] = []
+        # Key of every page persisted to each sink, by persist directory
+        self.versions: Dict[str, Dict[str, str]] = {}
+        self.last_persist = time.time()
+        self.pages = 0
+        self.chunks = 0
+        self.lag = 0.0
+
+    def start(self):
+        for sink in self.sinks:
+            print(f"{'Appending to existing' if sink.exists() else 'Creating new'} {sink.name} vectorstore at {sink.persist_directory}")
+            sink.open(self.embeddings)
+            self.versions[sink.persist_directory] = read_streamed_versions(sink.persist_directory)
+        self.thread.start()
+
+    def page_key(self, text_hash: str) -> str:
+        """
+        Key of a version of a page's text chunked with the current settings
+        """
+        return f'{self.key_prefix}:{text_hash}'
+
+    def add(self, url: str, text: str, text_hash: str):
+        """
+        Queues the text of a page, replacing what was ingested from the same URL before
+        """
+        self.put(StreamedPage(url, text, page_metadata(url, self.title_rules), self.page_key(text_hash)))
+
+    def remove(self, url: str):
+        """
+        Queues the removal of what was ingested from a URL, recorded with an empty key
+        """
+        self.put(StreamedPage(url, '', {}, ''))
+
+    def put(self, page: StreamedPage):
+        item = (time.time(), page)
+        while True:
+            if self.error is not None:
+                raise Exception(f"Streaming ingestion stopped: {self.error!r}")
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def run(self):
+        pending: List[Tuple[float, StreamedPage]] = []
+        pending_chunks, closing = 0, False
+        while not closing or pending:
+            timeout = None if not pending else max(0.0, pending[0][0] + self.max_wait - time.time())
+            if self.unpersisted:
+                timeout = min(timeout if timeout is not None else self.persist_interval,
+                              max(0.0, self.last_persist + self.persist_interval - time.time()))
+            try:
+                item = self.queue.get(timeout=timeout) if not closing else None
+            except queue.Empty:
+                item = None
+            if item is not None and item[1] is None:
+                closing = True
+            elif item is not None:
+                pending.append(item)
+                # Roughly the number of chunks, without tokenizing the text twice
+                pending_chunks += 1 + len(item[1].text) // 500
+            try:
+                if pending and (closing or pending_chunks >= self.batch_size or time.time() - pending[0][0] >= self.max_wait):
+                    self.ingest(pending)
+                    pending, pending_chunks = [], 0
+                if self.unpersisted and (closing or time.time() - self.last_persist >= self.persist_interval):
+                    self.persist()
+            except Exception as error:
+                print(f"Streaming ingestion failed: {error!r}")
+                self.error = error
+                return
+
+    def ingest(self, pending: List[Tuple[float, StreamedPage]]):
+        pages = [page for _, page in pending]
+        chunks = get_text_splitter().create_documents([page.text for page in pages],
+                                                      [dict(page.metadata, source=page.source) for page in pages])
+        if self.dedup is not None:
+            kept, source = [], None
+            for chunk in chunks:
+                if chunk.metadata['source'] != source:
+                    source = chunk.metadata['source']
+                    self.dedup.reset()
+                if self.dedup.check(source, chunk.page_content) is None:
+                    kept.append(chunk)
+            chunks = kept
+        texts = [chunk.page_content for chunk in chunks]
+        metadatas = [chunk.metadata for chunk in chunks]
+        vectors = [None] * len(chunks)
+        if chunks and any(sink.needs_vectors for sink in self.sinks):
+            vectors = self.embeddings.embed_documents(texts)
+        sources = [page.source for page in pages]
+        for sink in self.sinks:
+            sink.delete_sources(sources)
+            if chunks:
+                sink.add(texts, vectors, metadatas)
+        self.unpersisted.extend((page.source, page.key) for page in pages)
+        self.pages += len(pages)
+        self.chunks += len(chunks)
+        self.lag = max(self.lag, time.time() - pending[0][0])
+
+    def persist(self):
+        for sink in self.sinks:
+            sink.persist()
+            versions = self.versions[sink.persist_directory]
+            versions.update(self.unpersisted)
+            write_streamed_versions(sink.persist_directory, versions)
+        if self.on_persisted is not None:
+            self.on_persisted(self.unpersisted)
+        self.unpersisted = []
+        self.last_persist = time.time()
+
+    def close(self):
+        """
+        Ingests and persists the queued pages, then closes the sinks
+        """
+        if self.thread.is_alive():
+            self.queue.put((time.time(), None))
+            self.thread.join()
+        for sink in self.sinks:
+            sink.close()
+        if self.error is not None:
+            print(f"Streaming ingestion stopped early, {len(self.unpersisted)} pages were not persisted")
+
+    def report(self) -> str:
+        report = (f"Streamed {self.pages} pages into {self.chunks} chunks of {', '.join(sink.name for sink in self.sinks)}, "
+                  f"added at most {round(self.lag, 1)} s after their extraction and persisted every {self.persist_interval} s")
+        return report if self.dedup is None else report + '\n' + self.dedup.report('chunks')
+
+
+def create_streaming_ingestor(on_persisted: Optional[Callable[[List[Tuple[str, str]]], None]] = None) -> StreamingIngestor:
+    """
+    Builds the streaming ingestor configured through the environment, writing to the
+    CRAWLER_INGEST_VECTORSTORES sinks, INGEST_VECTORSTORES by default
+    """
+    sink_types = os.environ.get('CRAWLER_INGEST_VECTORSTORES') or os.environ.get('INGEST_VECTORSTORES', 'chroma,keyword')
+    sinks = [create_sink(sink_type) for sink_type in dict.fromkeys(sink_types.split(','))]
+    return StreamingIngestor(sinks, create_embeddings(os.environ.get('EMBEDDINGS_MODEL_NAME')),
+                             batch_size=int(os.environ.get('INGEST_BATCH_SIZE', 256)),
+                             max_wait=float(os.environ.get('CRAWLER_INGEST_MAX_WAIT', 2)),
+                             persist_interval=float(os.environ.get('CRAWLER_INGEST_PERSIST_SECONDS', 10)),
+                             on_persisted=on_persisted,
+                             dedup=create_dedup_detector('INGEST_DEDUP_THRESHOLD', 0))
@@ -0,0 +1,200 @@
+import os
+import sys
+import time
+import pickle
+import multiprocessing
+from multiprocessing.connection import wait
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+# How often the supervisor wakes up to check deadlines when no result arrives
+POLL_INTERVAL = 0.5
+
+
+def current_rss() -> Optional[int]:
+    """
+    Resident set size of the current process in bytes, or None when it cannot be measured
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Peak rather than current RSS, which only makes recycling happen sooner
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _worker_main(conn, func: Callable):
+    """
+    Worker loop: runs one task at a time and never lets an exception escape, so a failing
+    file only fails its own task
+    """
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        task_id, arg = task
+        try:
+            payload = pickle.dumps((task_id, func(arg), None, current_rss()))
+        except Exception as e:
+            payload = pickle.dumps((task_id, None, f"{type(e).__name__}: {e}", current_rss()))
+        conn.send_bytes(payload)
+    conn.close()
+
+
+class _Worker:
+    def __init__(self, context, func: Callable):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, func), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.started = 0.0
+        self.tasks_done = 0
+
+    def submit(self, task_id: int, arg: Any):
+        self.task = (task_id, arg)
+        self.started = time.time()
+        self.conn.send(self.task)
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class LoaderPool:
+    """
+    Process pool for document loaders that survives misbehaving files.
+
+    Each worker runs a single task at a time over its own pipe, so the supervisor always
+    knows which file a worker is busy with. A task that runs past task_timeout gets its
+    worker killed and replaced, a worker that dies takes only its own task down, and
+    workers are recycled after max_tasks_per_worker tasks or once their RSS grows past
+    max_rss_bytes. Failures are reported as results instead of exceptions.
+    """
+
+    def __init__(self, func: Callable, processes: int, task_timeout: Optional[float] = None,
+                 max_tasks_per_worker: Optional[int] = None, max_rss_bytes: Optional[int] = None):
+        self.func = func
+        self.processes = max(1, processes)
+        self.task_timeout = task_timeout
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.max_rss_bytes = max_rss_bytes
+        self.context = multiprocessing.get_context()
+        self.workers = []
+        # Per worker slot statistics, a recycled worker keeps the slot of the worker it replaces
+        self.busy_seconds = [0.0] * self.processes
+        self.tasks_done = [0] * self.processes
+        self.slowest_tasks = []
+        self.wall_seconds = 0.0
+        self.tail_seconds = 0.0
+
+    def _finish(self, slot: int, arg: Any):
+        worker = self.workers[slot]
+        seconds = time.time() - worker.started
+        self.busy_seconds[slot] += seconds
+        self.tasks_done[slot] += 1
+        self.slowest_tasks = sorted(self.slowest_tasks + [(seconds, arg)], key=lambda item: item[0], reverse=True)[:5]
+        worker.task = None
+
+    def _needs_recycling(self, worker: _Worker, rss: Optional[int]) -> bool:
+        if self.max_tasks_per_worker and worker.tasks_done >= self.max_tasks_per_worker:
+            return True
+        return bool(self.max_rss_bytes and rss and rss > self.max_rss_bytes)
+
+    def _replace(self, slot: int, kill: bool):
+        if kill:
+            self.workers[slot].kill()
+        else:
+            self.workers[slot].stop()
+        self.workers[slot] = _Worker(self.context, self.func)
+
+    def imap_unordered(self, args: Iterable) -> Iterator[Tuple[Any, Any, Optional[str]]]:
+        """
+        Runs func over args and yields (arg, result, error) as tasks finish. error is None on success.
+        """
+        pending = enumerate(args)
+        exhausted = False
+        start = time.time()
+        idle_since = None
+        self.workers = [_Worker(self.context, self.func) for _ in range(self.processes)]
+        try:
+            while True:
+                for worker in self.workers:
+                    if worker.task is None and not exhausted:
+                        task = next(pending, None)
+                        if task is None:
+                            exhausted = True
+                        else:
+                            worker.submit(*task)
+                busy = [slot for slot, worker in enumerate(self.workers) if worker.task is not None]
+                if not busy:
+                    break
+                if exhausted and idle_since is None and len(busy) < self.processes:
+                    # From here on the run is limited by its slowest files
+                    idle_since = time.time()
+
+                ready = wait([self.workers[slot].conn for slot in busy], timeout=POLL_INTERVAL)
+                for slot in busy:
+                    worker = self.workers[slot]
+                    task_id, arg = worker.task
+                    if worker.conn in ready:
+                        try:
+                            _, result, error, rss = pickle.loads(worker.conn.recv_bytes())
+                        except (EOFError, OSError):
+                            self._finish(slot, arg)
+                            exitcode = worker.process.exitcode
+                            self._replace(slot, kill=True)
+                            yield arg, None, f"Worker process died (exit code {exitcode})"
+                            continue
+                        self._finish(slot, arg)
+                        worker.tasks_done += 1
+                        if self._needs_recycling(worker, rss):
+                            self._replace(slot, kill=False)
+                        yield arg, result, error
+                    elif self.task_timeout and time.time() - worker.started > self.task_timeout:
+                        self._finish(slot, arg)
+                        self._replace(slot, kill=True)
+                        yield arg, None, f"Timed out after {self.task_timeout} s."
+        finally:
+            for worker in self.workers:
+                if worker.task is not None:
+                    worker.kill()
+                else:
+                    worker.stop()
+            self.workers = []
+            self.wall_seconds = time.time() - start
+            self.tail_seconds = time.time() - idle_since if idle_since else 0.0
+
+    def utilization_report(self) -> str:
+        """
+        Describes how busy each worker was, and how long the run waited on its slowest files
+        """
+        wall_seconds = max(self.wall_seconds, 1e-9)
+        utilization = [busy / wall_seconds for busy in self.busy_seconds]
+        lines = [f"Loader workers were {round(100 * sum(utilization) / len(utilization))}% busy on average over {round(self.wall_seconds, 2)} s."]
+        for slot, (share, tasks) in enumerate(zip(utilization, self.tasks_done)):
+            lines.append(f"  worker {slot}: {round(100 * share)}% busy, {tasks} tasks")
+        if self.tail_seconds:
+            lines.append(f"  the last {round(self.tail_seconds, 2)} s. ran with idle workers waiting for the slowest tasks")
+        for seconds, arg in self.slowest_tasks:
+            lines.append(f"  slowest: {arg} took {round(seconds, 2)} s.")
+        return "\n".join(lines)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import os
+import time
+import argparse
+from dotenv import load_dotenv
+from tabulate import tabulate
+
+import numpy as np
+
+from retrieval.localstore import LocalVectorStore, top_k
+from retrieval.quantization import QUANTIZATION_TYPES, Quantizer
+
+
+load_dotenv()
+
+local_store_directory = os.environ.get('LOCAL_STORE_DIRECTORY', 'localdb')
+
+
+def exact_neighbours(store: LocalVectorStore, queries: np.ndarray, k: int) -> list:
+    """
+    Exact k nearest live rows of every query row, the query row itself left out
+    """
+    neighbours = []
+    matrix = store.matrix()
+    for row in queries:
+        scores = np.asarray(matrix @ matrix[row])
+        scores[~store.alive] = -np.inf
+        scores[row] = -np.inf
+        neighbours.append(set(top_k(scores, k).tolist()))
+    return neighbours
+
+
+def measure(store: LocalVectorStore, queries: np.ndarray, truth: list, k: int) -> tuple:
+    recalls, latencies = [], []
+    matrix = store.matrix()
+    for row, expected in zip(queries, truth):
+        query = np.array(matrix[row])
+        start = time.perf_counter()
+        rows, _ = store.search_rows(query, k + 1)
+        latencies.append(1000 * (time.perf_counter() - start))
+        found = [found_row for found_row in rows.tolist() if found_row != row][:k]
+        recalls.append(len(expected.intersection(found)) / k)
+    return float(np.mean(recalls)), float(np.mean(latencies)), float(np.percentile(latencies, 95))
+
+
+def main():
+    args = parse_arguments()
+    if not LocalVectorStore.exists(args.directory):
+        print(f"No local vectorstore found in {args.directory}. Ingest with --vectorstore local to build it.")
+        return
+    store = LocalVectorStore(args.directory)
+    live = np.flatnonzero(store.alive)
+    rng = np.random.default_rng(42)
+    queries = np.sort(rng.choice(live, min(args.queries, len(live)), replace=False))
+    print(f"Computing the exact {args.k} nearest neighbours of {len(queries)} stored chunks among {len(live)}...")
+    truth = exact_neighbours(store, queries, args.k)
+
+    # Every setting is evaluated in memory, the codes of the store on disk are left untouched
+    full_bytes = store.rows * store.dim * 4
+    ivf = store.ivf_centroids, store.ivf_assignment
+    table = []
+    for nprobe in args.nprobe or [None]:
+        if nprobe is None:
+            store.ivf_centroids = None
+        else:
+            store.ivf_centroids, store.ivf_assignment = ivf
+            store.nprobe = nprobe
+        for quantization in args.quantization:
+            for dimensions in (args.pca_dimensions if quantization != 'none' else [0]):
+                if quantization == 'none':
+                    store.quantizer, store._codes = None, None
+                else:
+                    store.quantizer = Quantizer.fit(store.sample(), quantization, dimensions)
+                    store._codes = np.concatenate(list(store.quantizer.encode_blocks(store.matrix())))
+                index_bytes = full_bytes if store.quantizer is None else store._codes.nbytes
+                for rescore in (args.rescore if quantization != 'none' else [0]):
+                    store.rescore = rescore
+                    recall, mean_ms, p95_ms = measure(store, queries, truth, args.k)
+                    table.append([quantization, dimensions or store.dim, rescore or '-', nprobe or 'exact',
+                                  round(recall, 3), round(mean_ms, 2), round(p95_ms, 2),
+                                  round(index_bytes / 2 ** 20, 2), round(full_bytes / index_bytes, 1)])
+    print(tabulate(table, headers=['quantization', 'dimensions', 'rescore', 'nprobe', f'recall@{args.k}', 'mean ms', 'p95 ms',
+                                   'searched MB', 'compression']))
+    store.close()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Reports the recall and latency of the local vectorstore for every combination of '
+                                                 'quantization, PCA dimensions, rescoring and IVF settings, using stored chunks as queries.')
+    parser.add_argument("--directory", default=local_store_directory,
+                        help='Folder of the local vectorstore. Defaults to LOCAL_STORE_DIRECTORY or localdb.')
+    parser.add_argument("--queries", type=int, default=200, help='Number of stored chunks used as queries.')
+    parser.add_argument("--k", type=int, default=4, help='Number of neighbours retrieved per query.')
+    parser.add_argument("--quantization", nargs='+', choices=QUANTIZATION_TYPES, default=QUANTIZATION_TYPES,
+                        help='Quantization modes to compare.')
+    parser.add_argument("--pca-dimensions", nargs='+', type=int, default=[0, 192, 96],
+                        help='PCA dimensions to compare for quantized codes, 0 keeping every dimension.')
+    parser.add_argument("--rescore", nargs='+', type=int, default=[0, 2, 4, 8],
+                        help='Multiples of k rescored with the float32 vectors to compare, 0 returning the code scores.')
+    parser.add_argument("--nprobe", nargs='+', type=int,
+                        help='IVF lists scanned per query to compare, when the store has an IVF index. Exact search when not given.')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,28 @@
 import os
 from dotenv import load_dotenv
-from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.indexes.vectorstore import VectorStoreIndexWrapper
-from langchain.vectorstores import Chroma
 import argparse
 import time
-from constants import CHROMA_SETTINGS
-from prompts import get_chain
+from ingestion.embedding import create_embeddings
+from retrieval.answer_cache import create_answer_cache
+from retrieval.filters import filter_scope, parse_partition
+from retrieval.keyword_index import HybridRetriever, open_keyword_index
+from retrieval.rerank import create_reranker
+from retrieval.vectorstores import open_vectorstore
+from prompts import get_chain, get_query_pipeline
 from datetime import datetime
 
 load_dotenv()
 
 embeddings_model_name = os.environ.get("EMBEDDINGS_MODEL_NAME")
-persist_directory = os.environ.get('PERSIST_DIRECTORY')
+# Query server: address, number of concurrent ChatGPT calls and number of queries waiting for one
+server_host = os.environ.get('SERVER_HOST', '127.0.0.1')
+server_port = int(os.environ.get('SERVER_PORT', 8000))
+server_llm_instances = int(os.environ.get('SERVER_LLM_INSTANCES', 1))
+server_max_queued = int(os.environ.get('SERVER_MAX_QUEUED', 32))
+server_queue_timeout = float(os.environ.get('SERVER_QUEUE_TIMEOUT', 300))
+# Partition searched when --partition is not given, such as a game title, empty to search every document
+query_partition = os.environ.get('QUERY_PARTITION', '')
 
 def save_chat_history(chat_history):
     # Get the current date
@@ -40,12 +50,36 @@ def save_chat_history(chat_history):
 def main():
     # Parse the command line arguments
     args = parse_arguments()
-    embeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name)
-    db = Chroma(persist_directory=persist_directory, embedding_function=embeddings, client_settings=CHROMA_SETTINGS)
+    # Query embeddings go through the same on-disk cache as ingestion
+    embeddings = create_embeddings(embeddings_model_name, workers=1)
+    db, persist_directory = open_vectorstore(embeddings)
+    # Only search the chunks of one partition, a game for instance, when one is given
+    search_filter = parse_partition(args.partition)
     index = VectorStoreIndexWrapper(vectorstore=db)
+    # Answers to questions similar to earlier ones, dropped when their sources are re-ingested
+    answer_cache = create_answer_cache(persist_directory)
+    # Fuse keyword hits with the vector hits when the keyword index was built during ingestion
+    keyword_index = open_keyword_index()
+    # With re-ranking, a wider set of candidates is re-scored by a cross-encoder and only the best few reach ChatGPT
+    reranker = create_reranker(4)
+    search_k = reranker.candidates if reranker is not None else 10
+
+    if args.serve:
+        from retrieval.server import serve
+        serve(get_query_pipeline(db, embeddings, search_k, server_llm_instances, answer_cache, keyword_index, reranker), args.host, args.port,
+              max_queued=server_max_queued, queue_timeout=server_queue_timeout, default_partition=args.partition)
+        return
+
     # similarity search kwordargs search_kwargs = {'k': 10}
     # similarity score threshold search_type="similarity_score_threshold", search_kwargs={"score_threshold": .7, "k": 10}
-    chain = get_chain(index.vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 10})) 
+    if keyword_index is not None:
+        retriever = HybridRetriever(vectorstore=index.vectorstore, keyword_index=keyword_index, k=search_k, filter=search_filter)
+    else:
+        search_kwargs = {"k": search_k}
+        if search_filter:
+            search_kwargs["filter"] = search_filter
+        retriever = index.vectorstore.as_retriever(search_type="similarity", search_kwargs=search_kwargs)
+    chain = get_chain(retriever, reranker)
 
     # Interactive questions and answers
     chat_history = []
@@ -53,14 +87,31 @@ def main():
         query = input("\nEnter a query: ")
         if query == "exit":
             save_chat_history(chat_history)
+            if answer_cache is not None:
+                print(answer_cache.stats_report())
+            if reranker is not None:
+                print(reranker.stats_report())
             break
         if query.strip() == "":
             continue
 
         # Get the answer from the chain
         start = time.time()
-        res = chain({"question": query, "chat_history": chat_history})
-        answer, docs = res['answer'], [] if args.hide_source else res['source_documents']
+        # Follow up questions depend on the conversation, only standalone ones go through the answer cache
+        cached = None
+        use_cache = answer_cache is not None and not chat_history
+        if use_cache:
+            query_vector = embeddings.embed_query(query)
+            cached = answer_cache.lookup(query_vector, filter_scope(search_filter))
+        if cached is not None:
+            answer, docs = cached.answer, cached.source_documents
+        else:
+            res = chain({"question": query, "chat_history": chat_history})
+            answer, docs = res['answer'], res['source_documents']
+            if use_cache:
+                answer_cache.store(query_vector, answer, docs, filter_scope(search_filter))
+        if args.hide_source:
+            docs = []
         end = time.time()
         chat_history.append((query, answer))
         # Print the relevant sources used for the answer
@@ -74,7 +125,8 @@ def main():
         # Print the result
         print("\n\n> Question:")
         print(query)
-        print(f"\n> Answer (took {round(end - start, 2)} s.):")
+        reranked = f", re-ranking {round(1000 * reranker.last_seconds)} ms" if reranker is not None and cached is None else ''
+        print(f"\n> Answer (took {round(end - start, 2)} s.{', cached' if cached is not None else ''}{reranked}):")
         print(answer)
 
 def parse_arguments():
@@ -87,6 +139,19 @@ def parse_arguments():
                         action='store_true',
                         help='Use this flag to disable the streaming StdOut callback for LLMs.')
 
+    parser.add_argument("--partition", default=query_partition,
+                        help='Only search the documents of a partition: a title such as elden-ring, or field=value pairs '
+                             'among title, domain and doc_type, comma separated. Defaults to QUERY_PARTITION or every document.')
+
+    parser.add_argument("--serve", action='store_true',
+                        help='Answer queries over HTTP instead of interactively. The chat history is sent with each query.')
+
+    parser.add_argument("--host", default=server_host,
+                        help='Address the query server listens on. Defaults to SERVER_HOST or 127.0.0.1.')
+
+    parser.add_argument("--port", type=int, default=server_port,
+                        help='Port the query server listens on. Defaults to SERVER_PORT or 8000.')
+
     return parser.parse_args()
 
 
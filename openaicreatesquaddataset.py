@@ -5,7 +5,7 @@ from pydantic_classes.squadclasses import SquadDataItem
 from langchain.output_parsers import PydanticOutputParser, OutputFixingParser, RetryWithErrorOutputParser
 from dotenv import load_dotenv
 import os
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from ingestion.splitter import get_text_splitter
 from langchain.docstore.document import Document
 from typing import List
 import pickle
@@ -22,8 +22,6 @@ post_processed_directory = os.environ.get('POST_PROCESSED_DATASET_DIR', 'process
 number_of_files_to_process = int(os.environ.get('NUMBER_OF_FILES_TO_CONVERT_TO_DATASET', 1))
 open_api_key = openai_api_key= os.environ.get('PROJECT_OPENAI_API_KEY', '')
 files_processed = 0
-CHUNK_SIZE = 500
-CHUNK_OVERLAP = 50
 print(f"Loading documents from {source_directory}")
 SOURCE_FILES = os.listdir(source_directory)
 # Sort files in lexicographical order (alphabetical order)
@@ -96,9 +94,10 @@ def process_document(processed_files_list) -> List[str]:
         print("Exiting due to no document content found")
         exit(1)
     
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    # Same chunk boundaries as ingest.py, sized in tokens of the embeddings model
+    text_splitter = get_text_splitter()
     texts = text_splitter.split_text(document_contents)
-    print(f"Split into {len(texts)} chunks of text (max. {CHUNK_SIZE} tokens each)")
+    print(f"Split into {len(texts)} chunks of text (max. {text_splitter._chunk_size} tokens each)")
     return texts
 
 def create_ai_gpt3_5_structured_output_chain(): 
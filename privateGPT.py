@@ -1,9 +1,7 @@
 #!/usr/bin/env python3
 from dotenv import load_dotenv
 from langchain.chains import RetrievalQA
-from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain.vectorstores import Chroma
 from langchain.llms import GPT4All, LlamaCpp
 from langchain import PromptTemplate
 import os
@@ -21,60 +19,131 @@ tempalte = """HUMAN: <prompt>Use the following context to answer the question at
               ASSISTANT: <response>"""
 
 embeddings_model_name = os.environ.get("EMBEDDINGS_MODEL_NAME")
-persist_directory = os.environ.get('PERSIST_DIRECTORY')
 
 model_type = os.environ.get('MODEL_TYPE')
 model_path = os.environ.get('MODEL_PATH')
-model_n_ctx = os.environ.get('MODEL_N_CTX')
+model_n_ctx = int(os.environ.get('MODEL_N_CTX', 1000))
 model_n_batch = int(os.environ.get('MODEL_N_BATCH',8))
 target_source_chunks = int(os.environ.get('TARGET_SOURCE_CHUNKS',4))
+# Query server: address, number of LLM instances generating at once and number of queries waiting for one
+server_host = os.environ.get('SERVER_HOST', '127.0.0.1')
+server_port = int(os.environ.get('SERVER_PORT', 8000))
+server_llm_instances = int(os.environ.get('SERVER_LLM_INSTANCES', 1))
+server_max_queued = int(os.environ.get('SERVER_MAX_QUEUED', 32))
+server_queue_timeout = float(os.environ.get('SERVER_QUEUE_TIMEOUT', 300))
+# Partition searched when --partition is not given, such as a game title, empty to search every document
+query_partition = os.environ.get('QUERY_PARTITION', '')
 
-from constants import CHROMA_SETTINGS
+from ingestion.embedding import create_embeddings
+from retrieval.answer_cache import create_answer_cache
+from retrieval.context import PackingRetriever, create_context_packer
+from retrieval.filters import filter_scope, parse_partition
+from retrieval.keyword_index import HybridRetriever, open_keyword_index
+from retrieval.rerank import RerankingRetriever, create_reranker
+from retrieval.vectorstores import open_vectorstore
 
-def main():
-    # Parse the command line arguments
-    args = parse_arguments()
-    embeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name)
-    db = Chroma(persist_directory=persist_directory, embedding_function=embeddings, client_settings=CHROMA_SETTINGS)
-    retriever = db.as_retriever(search_kwargs={"k": target_source_chunks})
-    # activate/deactivate the streaming StdOut callback for LLMs
-    callbacks = [] if args.mute_stream else [StreamingStdOutCallbackHandler()]
-    # Prepare the LLM
+prompt = PromptTemplate(template=tempalte, input_variables=["context", "question"])
+
+def create_llm(callbacks):
     match model_type:
         case "LlamaCpp":
-            llm = LlamaCpp(model_path=model_path, n_ctx=model_n_ctx, n_batch=model_n_batch, callbacks=callbacks, verbose=False)
+            return LlamaCpp(model_path=model_path, n_ctx=model_n_ctx, n_batch=model_n_batch, callbacks=callbacks, verbose=False)
         case "GPT4All":
-            llm = GPT4All(model=model_path, n_ctx=model_n_ctx, n_threads=8, backend='gptj', n_batch=model_n_batch, callbacks=callbacks, verbose=False,  seed=42)
+            return GPT4All(model=model_path, n_ctx=model_n_ctx, n_threads=8, backend='gptj', n_batch=model_n_batch, callbacks=callbacks, verbose=False,  seed=42)
         case _default:
             # raise exception if model_type is not supported
             raise Exception(f"Model type {model_type} is not supported. Please choose one of the following: LlamaCpp, GPT4All")
-        
-    qa = RetrievalQA.from_chain_type(llm=llm, 
-                                     chain_type="stuff", 
-                                     retriever=retriever, 
-                                     return_source_documents= not args.hide_source,
-                                     chain_type_kwargs={"prompt": PromptTemplate(
-                                       template=tempalte,
-                                       input_variables=["context", "question"]
-                                    )})
+
+def create_qa(llm, retriever, return_source_documents):
+    return RetrievalQA.from_chain_type(llm=llm, 
+                                       chain_type="stuff", 
+                                       retriever=retriever, 
+                                       return_source_documents=return_source_documents,
+                                       chain_type_kwargs={"prompt": prompt})
+
+def main():
+    # Parse the command line arguments
+    args = parse_arguments()
+    # Query embeddings go through the same on-disk cache as ingestion
+    embeddings = create_embeddings(embeddings_model_name, workers=1)
+    db, persist_directory = open_vectorstore(embeddings)
+    # Only search the chunks of one partition, a game for instance, when one is given
+    search_filter = parse_partition(args.partition)
+    # Re-rank a wider set of candidates with a cross-encoder and keep the best TARGET_SOURCE_CHUNKS
+    reranker = create_reranker(target_source_chunks)
+    search_k = reranker.candidates if reranker is not None else target_source_chunks
+    # Fuse keyword hits with the vector hits when the keyword index was built during ingestion
+    keyword_index = open_keyword_index()
+    if keyword_index is not None:
+        retriever = HybridRetriever(vectorstore=db, keyword_index=keyword_index, k=search_k, filter=search_filter)
+    else:
+        search_kwargs = {"k": search_k}
+        if search_filter:
+            search_kwargs["filter"] = search_filter
+        retriever = db.as_retriever(search_kwargs=search_kwargs)
+    # Answers to questions similar to earlier ones, dropped when their sources are re-ingested
+    answer_cache = create_answer_cache(persist_directory)
+
+    if args.serve:
+        from retrieval.pipeline import create_query_pipeline
+        from retrieval.server import serve
+        # One LLM per concurrent generation, the models are not safe to share between threads
+        llms = [create_llm([]) for _ in range(server_llm_instances)]
+        combine_chains = [create_qa(llm, retriever, True).combine_documents_chain for llm in llms]
+        # Fit the retrieved chunks in the context window of the model
+        packer = create_context_packer(llms[0].get_num_tokens, prompt, model_n_ctx)
+        pipeline = create_query_pipeline(db, embeddings, combine_chains, target_source_chunks, answer_cache=answer_cache,
+                                         context_packer=packer, keyword_index=keyword_index, reranker=reranker)
+        serve(pipeline, args.host, args.port, max_queued=server_max_queued, queue_timeout=server_queue_timeout,
+              default_partition=args.partition)
+        return
+
+    # activate/deactivate the streaming StdOut callback for LLMs
+    callbacks = [] if args.mute_stream else [StreamingStdOutCallbackHandler()]
+    # Prepare the LLM
+    llm = create_llm(callbacks)
+    # Fit the retrieved chunks in the context window of the model
+    packer = create_context_packer(llm.get_num_tokens, prompt, model_n_ctx)
+    if reranker is not None:
+        retriever = RerankingRetriever(retriever=retriever, reranker=reranker)
+    if packer is not None:
+        retriever = PackingRetriever(retriever=retriever, packer=packer)
+    # Sources are always returned, the answer cache needs them
+    qa = create_qa(llm, retriever, True)
     # Interactive questions and answers
     while True:
         query = input("\nEnter a query: ")
         if query == "exit":
+            if answer_cache is not None:
+                print(answer_cache.stats_report())
+            if reranker is not None:
+                print(reranker.stats_report())
             break
         if query.strip() == "":
             continue
 
         # Get the answer from the chain
         start = time.time()
-        res = qa(query)
-        answer, docs = res['result'], [] if args.hide_source else res['source_documents']
+        cached = None
+        if answer_cache is not None:
+            query_vector = embeddings.embed_query(query)
+            cached = answer_cache.lookup(query_vector, filter_scope(search_filter))
+        if cached is not None:
+            answer, docs = cached.answer, cached.source_documents
+        else:
+            res = qa(query)
+            answer, docs = res['result'], res['source_documents']
+            if answer_cache is not None:
+                answer_cache.store(query_vector, answer, docs, filter_scope(search_filter))
+        if args.hide_source:
+            docs = []
         end = time.time()
 
         # Print the result
         print("\n\n> Question:")
         print(query)
-        print(f"\n> Answer (took {round(end - start, 2)} s.):")
+        reranked = f", re-ranking {round(1000 * reranker.last_seconds)} ms" if reranker is not None and cached is None else ''
+        print(f"\n> Answer (took {round(end - start, 2)} s.{', cached' if cached is not None else ''}{reranked}):")
         print(answer)
 
         # Print the relevant sources used for the answer
@@ -95,6 +164,19 @@ def parse_arguments():
                         action='store_true',
                         help='Use this flag to disable the streaming StdOut callback for LLMs.')
 
+    parser.add_argument("--partition", default=query_partition,
+                        help='Only search the documents of a partition: a title such as elden-ring, or field=value pairs '
+                             'among title, domain and doc_type, comma separated. Defaults to QUERY_PARTITION or every document.')
+
+    parser.add_argument("--serve", action='store_true',
+                        help='Load the models once and answer queries over HTTP instead of interactively.')
+
+    parser.add_argument("--host", default=server_host,
+                        help='Address the query server listens on. Defaults to SERVER_HOST or 127.0.0.1.')
+
+    parser.add_argument("--port", type=int, default=server_port,
+                        help='Port the query server listens on. Defaults to SERVER_PORT or 8000.')
+
     return parser.parse_args()
 
 
@@ -4,7 +4,13 @@ from langchain.chains.llm import LLMChain
 from langchain.chains import ConversationalRetrievalChain
 from langchain.chains.question_answering import load_qa_chain
 from dotenv import load_dotenv
+from collections import OrderedDict
+from typing import Any, Dict, Optional
 import os
+import re
+
+from retrieval.context import PackingRetriever, create_context_packer
+from retrieval.rerank import RerankingRetriever
 
 _template = """Given the following conversation and a follow up question, rephrase the follow up question to be a standalone question.
 You can assume the question is about a video game.
@@ -29,25 +35,133 @@ Answer:
 """
 QA_PROMPT = PromptTemplate(template=template, input_variables=["question", "context"])
 
+# Words that refer back to the conversation, a question containing one needs condensing
+_REFERRING_WORDS = {"it", "its", "it's", "they", "them", "their", "theirs", "this", "that", "these", "those",
+                    "he", "him", "his", "she", "her", "hers", "there", "then", "one", "ones", "else",
+                    "other", "another", "same", "former", "latter", "above", "previous"}
+_CONTINUATIONS = ("and ", "but ", "also ", "so ", "or ", "what about", "how about")
+
+
+def is_standalone(question):
+    """
+    Cheap check for questions that can be searched as they are. Short questions, questions
+    that continue the previous one or contain a word referring back to it are not standalone.
+    """
+    text = question.strip().lower()
+    words = re.findall(r"[a-z']+", text)
+    if len(words) < 4 or text.startswith(_CONTINUATIONS):
+        return False
+    return not any(word in _REFERRING_WORDS for word in words)
+
+
+def budgeted_chat_history(llm, max_tokens):
+    """
+    Returns a get_chat_history function that formats the most recent turns of the chat history
+    that fit in max_tokens tokens of the llm, so condense prompts stop growing with the session
+    """
+    def get_chat_history(chat_history):
+        turns = []
+        used = 0
+        for question, answer in reversed(chat_history):
+            turn = f"\nHuman: {question}\nAssistant: {answer}"
+            tokens = llm.get_num_tokens(turn)
+            if used + tokens > max_tokens:
+                if not turns:
+                    # Keep at least the last question, the follow up most likely refers to it
+                    turns.append(f"\nHuman: {question}")
+                break
+            turns.append(turn)
+            used += tokens
+        return "".join(reversed(turns))
+    return get_chat_history
+
 
-def get_chain(retriever):
+class CondenseQuestionChain(LLMChain):
+    """
+    Question generator that only calls the LLM when it has to: standalone questions are searched
+    as they are, and condensed questions are memoized by (chat history window, question).
+    """
+
+    skip_standalone: bool = True
+    memo_size: int = 256
+    memo: Any = None
+
+    def _call(self, inputs: Dict[str, Any], run_manager: Optional[Any] = None) -> Dict[str, str]:
+        question = inputs["question"]
+        if self.skip_standalone and is_standalone(question):
+            return {self.output_key: question}
+        if self.memo is None:
+            self.memo = OrderedDict()
+        key = (inputs["chat_history"], question)
+        try:
+            self.memo.move_to_end(key)
+            return {self.output_key: self.memo[key]}
+        except KeyError:
+            # Not memoized yet, or evicted by a concurrent call
+            pass
+        condensed = super()._call(inputs, run_manager=run_manager)[self.output_key].strip()
+        self.memo[key] = condensed
+        if len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
+        return {self.output_key: condensed}
+
+
+def get_llm():
     load_dotenv()
-    llm = ChatOpenAI(model="gpt-3.5-turbo", 
-                     openai_api_key= os.environ.get('OPENAI_API_KEY'),
-                     temperature=0)
-    
-    doc_chain = load_qa_chain(
+    return ChatOpenAI(model="gpt-3.5-turbo", 
+                      openai_api_key= os.environ.get('OPENAI_API_KEY'),
+                      temperature=0)
+
+
+def get_doc_chain(llm):
+    return load_qa_chain(
         llm,
         chain_type="stuff",
         prompt=QA_PROMPT
     )
-    question_chain = LLMChain(
+
+
+def get_question_chain(llm):
+    return CondenseQuestionChain(
         llm=llm,
         prompt=CONDENSE_QUESTION_PROMPT,
+        skip_standalone=os.environ.get('CONDENSE_SKIP_STANDALONE', 'True').lower() == 'true',
     )
+
+
+def get_history_formatter(llm):
+    return budgeted_chat_history(llm, int(os.environ.get('CONDENSE_HISTORY_MAX_TOKENS', 1000)))
+
+
+def get_context_packer(llm):
+    return create_context_packer(llm.get_num_tokens, QA_PROMPT, int(os.environ.get('OPENAI_CONTEXT_TOKENS', 4096)))
+
+
+def get_chain(retriever, reranker=None):
+    llm = get_llm()
+    if reranker is not None:
+        retriever = RerankingRetriever(retriever=retriever, reranker=reranker)
+    packer = get_context_packer(llm)
+    if packer is not None:
+        retriever = PackingRetriever(retriever=retriever, packer=packer)
     return ConversationalRetrievalChain(
         retriever=retriever,
-        combine_docs_chain=doc_chain,
-        question_generator=question_chain,
+        combine_docs_chain=get_doc_chain(llm),
+        question_generator=get_question_chain(llm),
+        get_chat_history=get_history_formatter(llm),
         return_source_documents=True
-    )
\ No newline at end of file
+    )
+
+
+def get_query_pipeline(vectorstore, embeddings, k, concurrency, answer_cache=None, keyword_index=None, reranker=None):
+    """
+    Same steps as get_chain on the async query pipeline. The OpenAI client is safe to share
+    between threads, so every concurrent call goes through the same chains.
+    """
+    from retrieval.pipeline import create_query_pipeline
+    llm = get_llm()
+    doc_chain, question_chain = get_doc_chain(llm), get_question_chain(llm)
+    return create_query_pipeline(vectorstore, embeddings, [doc_chain] * concurrency, k,
+                                 question_generators=[question_chain] * concurrency, answer_cache=answer_cache,
+                                 get_chat_history=get_history_formatter(llm), context_packer=get_context_packer(llm),
+                                 keyword_index=keyword_index, reranker=reranker)
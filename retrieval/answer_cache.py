@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+from langchain.docstore.document import Document
+
+from ingestion.manifest import MANIFEST_FILE_NAME, STREAMED_SOURCES_FILE_NAME, read_streamed_versions
+
+
+class SourceVersions:
+    """
+    Content hash of every ingested source, read from the ingestion manifest of a vectorstore,
+    and version of every page the crawler streamed into it, read again whenever ingest.py or
+    the crawler rewrite them
+    """
+
+    def __init__(self, persist_directory: str):
+        self.persist_directory = persist_directory
+        self.paths = [os.path.join(persist_directory, MANIFEST_FILE_NAME), os.path.join(persist_directory, STREAMED_SOURCES_FILE_NAME)]
+        self.mtimes = None
+        self.versions: Dict[str, str] = {}
+
+    def current(self) -> Dict[str, str]:
+        mtimes = []
+        for path in self.paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        if mtimes != self.mtimes:
+            self.mtimes = mtimes
+            try:
+                with open(self.paths[0], 'r', encoding='utf-8') as f:
+                    entries = json.load(f).get('files', {})
+            except (OSError, ValueError):
+                entries = {}
+            self.versions = {source: entry.get('sha256') for source, entry in entries.items()}
+            self.versions.update(read_streamed_versions(self.persist_directory))
+        return self.versions
+
+
+class CachedAnswer(NamedTuple):
+    answer: str
+    source_documents: List[Document]
+    # Content hash of every source of the answer when it was generated
+    source_versions: Dict[str, Optional[str]]
+    created: float
+
+
+class SemanticAnswerCache:
+    """
+    In-memory cache of answers keyed by the embedding of their question.
+
+    A question is answered from the cache when the cosine similarity between its embedding and
+    the one of a cached question reaches threshold. An answer expires after ttl seconds, and as
+    soon as one of its sources is re-ingested with a different content hash or removed. Beyond
+    max_entries, the least recently used answers are evicted. Answers are only shared between
+    questions of the same scope, such as the partition the search was restricted to.
+    """
+
+    def __init__(self, source_versions: SourceVersions, threshold: float = 0.95, max_entries: int = 1000, ttl: float = 86400):
+        self.source_versions = source_versions
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: 'OrderedDict[int, CachedAnswer]' = OrderedDict()
+        self.vectors: Dict[int, np.ndarray] = {}
+        self.scopes: Dict[int, str] = {}
+        self.next_id = 0
+        # Normalized vectors of the entries stacked in entry order, rebuilt after every change
+        self._matrix = None
+        self._ids: List[int] = []
+        self._scopes = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    @staticmethod
+    def normalize(vector: List[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id: int):
+        del self.entries[entry_id]
+        del self.vectors[entry_id]
+        del self.scopes[entry_id]
+        self._matrix = None
+
+    def _is_stale(self, entry: CachedAnswer, versions: Dict[str, str]) -> bool:
+        if time.time() - entry.created > self.ttl:
+            return True
+        return any(versions.get(source) != version for source, version in entry.source_versions.items())
+
+    def lookup(self, query_vector: List[float], scope: str = '') -> Optional[CachedAnswer]:
+        with self._lock:
+            if self.entries:
+                if self._matrix is None:
+                    self._ids = list(self.entries)
+                    self._matrix = np.stack([self.vectors[entry_id] for entry_id in self._ids])
+                    self._scopes = np.array([self.scopes[entry_id] for entry_id in self._ids])
+                similarities = self._matrix @ self.normalize(query_vector)
+                similarities[self._scopes != scope] = -np.inf
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entry_id = self._ids[best]
+                    entry = self.entries[entry_id]
+                    if not self._is_stale(entry, self.source_versions.current()):
+                        self.entries.move_to_end(entry_id)
+                        self.hits += 1
+                        return entry
+                    self._remove(entry_id)
+                    self.invalidations += 1
+            self.misses += 1
+            return None
+
+    def store(self, query_vector: List[float], answer: str, source_documents: List[Document], scope: str = ''):
+        versions = self.source_versions.current()
+        sources = {document.metadata.get('source') for document in source_documents}
+        entry = CachedAnswer(answer, source_documents, {source: versions.get(source) for source in sources}, time.time())
+        with self._lock:
+            self.entries[self.next_id] = entry
+            self.vectors[self.next_id] = self.normalize(query_vector)
+            self.scopes[self.next_id] = scope
+            self.next_id += 1
+            self._matrix = None
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                    'invalidations': self.invalidations, 'evictions': self.evictions}
+
+    def stats_report(self) -> str:
+        stats = self.stats()
+        return (f"Answer cache: {stats['hits']} hits, {stats['misses']} misses ({round(100 * stats['hit_rate'], 1)}% hit rate), "
+                f"{stats['invalidations']} invalidated, {stats['evictions']} evicted, {stats['entries']} answers stored")
+
+
+def create_answer_cache(persist_directory: str) -> Optional[SemanticAnswerCache]:
+    """
+    Builds the cache configured through the ANSWER_CACHE_* environment variables, for answers
+    from the vectorstore in persist_directory. Setting ANSWER_CACHE_SIZE to 0 disables it.
+    """
+    max_entries = int(os.environ.get('ANSWER_CACHE_SIZE', 1000))
+    if not max_entries:
+        return None
+    return SemanticAnswerCache(SourceVersions(persist_directory),
+                               threshold=float(os.environ.get('ANSWER_CACHE_THRESHOLD', 0.95)),
+                               max_entries=max_entries,
+                               ttl=float(os.environ.get('ANSWER_CACHE_TTL', 86400)))
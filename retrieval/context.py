@@ -0,0 +1,136 @@
+import os
+import re
+from typing import Callable, List, Optional, Set
+
+from langchain.docstore.document import Document
+from langchain.prompts import PromptTemplate
+
+from retrieval.retrievers import WrappingRetriever
+
+
+def word_shingles(text: str, size: int = 3) -> Set[str]:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= size:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def merge_overlapping(documents: List[Document]) -> List[Document]:
+    """
+    Merges chunks of the same source and page whose character ranges overlap or touch into a
+    single document, placed at the rank of its most relevant chunk. Chunks without
+    start_index/end_index offsets are kept as they are.
+    """
+    merged: List[Document] = []
+    # (source, page) -> positions in merged of the documents built from that part of the source
+    spans = {}
+    for document in documents:
+        metadata = document.metadata
+        start, end = metadata.get('start_index'), metadata.get('end_index')
+        if start is None or end is None:
+            merged.append(document)
+            continue
+        key = (metadata.get('source'), metadata.get('page'))
+        position = next((position for position in spans.get(key, [])
+                         if start <= merged[position].metadata['end_index'] and merged[position].metadata['start_index'] <= end), None)
+        if position is None:
+            spans.setdefault(key, []).append(len(merged))
+            merged.append(Document(page_content=document.page_content, metadata=dict(metadata)))
+            continue
+        target = merged[position]
+        first, last = (target, document) if target.metadata['start_index'] <= start else (document, target)
+        first_start, first_end = first.metadata['start_index'], first.metadata['end_index']
+        last_start, last_end = last.metadata['start_index'], last.metadata['end_index']
+        if last_end <= first_end:
+            text = first.page_content
+        else:
+            text = first.page_content + last.page_content[max(0, first_end - last_start):]
+        target.page_content = text
+        target.metadata['start_index'] = first_start
+        target.metadata['end_index'] = max(first_end, last_end)
+    return merged
+
+
+class ContextPacker:
+    """
+    Assembles the context of a "stuff" prompt within the model's context window.
+
+    Overlapping and adjacent chunks of the same source are merged, chunks whose word 3-grams are
+    contained in a more relevant chunk for at least dedup_threshold of them are dropped, and the rest
+    are added in relevance order while they fit in the tokens left by the prompt, the question
+    and answer_tokens reserved for the answer. The first chunk that does not fit is cut to the
+    remaining budget when at least min_chunk_tokens are left.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], prompt: PromptTemplate, context_tokens: int,
+                 answer_tokens: int = 256, dedup_threshold: float = 0.8, min_chunk_tokens: int = 32):
+        self.count_tokens = count_tokens
+        self.prompt = prompt
+        self.context_tokens = context_tokens
+        self.answer_tokens = answer_tokens
+        self.dedup_threshold = dedup_threshold
+        self.min_chunk_tokens = min_chunk_tokens
+        self.separator_tokens = count_tokens("\n\n")
+
+    def budget(self, question: str) -> int:
+        inputs = {name: '' for name in self.prompt.input_variables}
+        inputs['question'] = question
+        return self.context_tokens - self.answer_tokens - self.count_tokens(self.prompt.format(**inputs))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """
+        Longest prefix of whole words of text that fits in max_tokens
+        """
+        words = text.split(' ')
+        low, high = 0, len(words)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count_tokens(' '.join(words[:middle])) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return ' '.join(words[:low])
+
+    def pack(self, question: str, documents: List[Document]) -> List[Document]:
+        remaining = self.budget(question)
+        packed, shingles = [], []
+        for document in merge_overlapping(documents):
+            document_shingles = word_shingles(document.page_content)
+            if any(len(document_shingles & other) / len(document_shingles) >= self.dedup_threshold for other in shingles):
+                continue
+            tokens = self.count_tokens(document.page_content) + (self.separator_tokens if packed else 0)
+            if tokens <= remaining:
+                packed.append(document)
+                shingles.append(document_shingles)
+                remaining -= tokens
+                continue
+            if remaining >= self.min_chunk_tokens:
+                text = self.truncate(document.page_content, remaining - (self.separator_tokens if packed else 0))
+                if text:
+                    packed.append(Document(page_content=text, metadata=dict(document.metadata, truncated=True)))
+            break
+        return packed
+
+
+class PackingRetriever(WrappingRetriever):
+    """
+    Retriever returning the documents of another retriever packed by a ContextPacker
+    """
+
+    packer: ContextPacker
+
+    def transform(self, query: str, documents: List[Document]) -> List[Document]:
+        return self.packer.pack(query, documents)
+
+
+def create_context_packer(count_tokens: Callable[[str], int], prompt: PromptTemplate,
+                          context_tokens: int) -> Optional[ContextPacker]:
+    """
+    Builds the packer configured through the CONTEXT_* environment variables for a model with a
+    context window of context_tokens tokens. Setting CONTEXT_PACKING to False disables it.
+    """
+    if os.environ.get('CONTEXT_PACKING', 'True').lower() != 'true':
+        return None
+    return ContextPacker(count_tokens, prompt, context_tokens,
+                         answer_tokens=int(os.environ.get('CONTEXT_ANSWER_TOKENS', 256)),
+                         dedup_threshold=float(os.environ.get('CONTEXT_DEDUP_THRESHOLD', 0.8)))
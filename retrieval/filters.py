@@ -0,0 +1,74 @@
+import json
+import sqlite3
+from typing import Any, Dict, List, Optional, Tuple
+
+# Chunk metadata kept in indexed columns by the local vectorstore and the keyword index, so a
+# search restricted on them only reads the matching chunks
+FILTER_FIELDS = ['source', 'page', 'title', 'domain', 'doc_type']
+# Partition metadata columns of the chunks tables
+PARTITION_COLUMNS = ['title', 'domain', 'doc_type']
+# Field a partition given without a field name restricts
+DEFAULT_PARTITION_FIELD = 'title'
+
+
+def parse_partition(partition: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Parses a partition such as "elden-ring" or "title=elden-ring,domain=ign.com" into a metadata
+    filter in the format of Chroma's where clauses, or returns None for an empty partition
+    """
+    conditions = {}
+    for condition in (partition or '').split(','):
+        if not condition.strip():
+            continue
+        field, _, value = condition.rpartition('=')
+        field = field.strip() or DEFAULT_PARTITION_FIELD
+        if field not in FILTER_FIELDS:
+            raise Exception(f"Cannot restrict a search on {field}. Please choose one of the following: {', '.join(FILTER_FIELDS)}")
+        conditions[field] = int(value) if field == 'page' else value.strip()
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions
+    return {"$and": [{field: value} for field, value in conditions.items()]}
+
+
+def filter_conditions(where: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Flattens a filter of equality conditions, joined with $and or not, into {field: value}
+    """
+    conditions = {}
+    for field, value in (where or {}).items():
+        if field == '$and':
+            for condition in value:
+                conditions.update(filter_conditions(condition))
+        elif field not in FILTER_FIELDS or isinstance(value, dict):
+            raise Exception(f"Unsupported filter {field}: {value}. Only equality on {', '.join(FILTER_FIELDS)} is supported.")
+        else:
+            conditions[field] = value
+    return conditions
+
+
+def filter_clause(where: Optional[Dict[str, Any]], table: str = 'chunks') -> Tuple[str, List[Any]]:
+    """
+    SQL conditions, starting with AND, and their parameters matching the chunks of a filter
+    """
+    conditions = filter_conditions(where)
+    return ''.join(f' AND {table}.{field} = ?' for field in conditions), list(conditions.values())
+
+
+def ensure_partition_columns(conn: sqlite3.Connection, table: str = 'chunks'):
+    """
+    Adds the indexed partition columns to a chunks table, created before they existed or not
+    """
+    columns = {column[1] for column in conn.execute(f'PRAGMA table_info({table})')}
+    for column in PARTITION_COLUMNS:
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} TEXT')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_{column} ON {table} ({column})')
+
+
+def filter_scope(where: Optional[Dict[str, Any]]) -> str:
+    """
+    Key of a filter, for the caches whose entries are only valid under the same filter
+    """
+    return json.dumps(filter_conditions(where), sort_keys=True) if where else ''
@@ -0,0 +1,162 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+from langchain.callbacks.manager import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain.docstore.document import Document
+from langchain.schema import BaseRetriever
+from langchain.vectorstores.base import VectorStore
+
+from retrieval.filters import ensure_partition_columns, filter_clause
+
+INDEX_FILE_NAME = 'keyword_index.sqlite'
+# Too common to tell chunks apart, left out of keyword queries
+STOPWORDS = {"a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i",
+             "in", "is", "it", "of", "on", "or", "that", "the", "this", "to", "was", "what", "when", "where",
+             "which", "who", "why", "with", "you"}
+
+
+class KeywordIndex:
+    """
+    Local BM25 inverted index of chunks, backed by an SQLite FTS5 table with Porter stemming.
+
+    Chunks live in a plain table indexed by source and page, so the chunks of a file or of a
+    few pages are deleted without a scan, and the FTS5 table indexes their text as an external
+    content table kept in sync by triggers.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, INDEX_FILE_NAME), check_same_thread=False)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, source TEXT NOT NULL, page INTEGER,
+                                               text TEXT NOT NULL, metadata TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS chunks_source_page ON chunks (source, page);
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(text, content='chunks', content_rowid='id',
+                                                                     tokenize='porter unicode61 remove_diacritics 2');
+            CREATE TRIGGER IF NOT EXISTS chunks_insert AFTER INSERT ON chunks BEGIN
+                INSERT INTO chunks_fts (rowid, text) VALUES (new.id, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS chunks_delete AFTER DELETE ON chunks BEGIN
+                INSERT INTO chunks_fts (chunks_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            END;
+        ''')
+        ensure_partition_columns(self._conn)
+
+    def add(self, texts: List[str], metadatas: List[dict]):
+        rows = [(metadata['source'], metadata.get('page'), text, json.dumps(metadata),
+                 metadata.get('title'), metadata.get('domain'), metadata.get('doc_type')) for text, metadata in zip(texts, metadatas)]
+        with self._lock:
+            self._conn.executemany('INSERT INTO chunks (source, page, text, metadata, title, domain, doc_type) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def delete_sources(self, sources: List[str]):
+        with self._lock:
+            self._conn.executemany('DELETE FROM chunks WHERE source = ?', [(source,) for source in sources])
+
+    def delete_pages(self, source: str, pages: List[int]):
+        with self._lock:
+            self._conn.executemany('DELETE FROM chunks WHERE source = ? AND page = ?', [(source, page) for page in pages])
+
+    def sources(self) -> Set[str]:
+        with self._lock:
+            return {row[0] for row in self._conn.execute('SELECT DISTINCT source FROM chunks')}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM chunks').fetchone()[0]
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+    def search(self, query: str, k: int, filter: Optional[Dict[str, Any]] = None) -> List[Document]:
+        """
+        Returns the k chunks that rank best by BM25 for any of the query's words, among the chunks
+        matching filter when given
+        """
+        words = [word for word in dict.fromkeys(re.findall(r"\w+", query.lower())) if word not in STOPWORDS]
+        if not words:
+            return []
+        match = ' OR '.join(f'"{word}"' for word in words)
+        where, params = filter_clause(filter)
+        with self._lock:
+            rows = self._conn.execute('SELECT chunks.text, chunks.metadata FROM chunks_fts JOIN chunks ON chunks.id = chunks_fts.rowid '
+                                      f'WHERE chunks_fts MATCH ?{where} ORDER BY bm25(chunks_fts) LIMIT ?', [match, *params, k]).fetchall()
+        return [Document(page_content=text, metadata=json.loads(metadata)) for text, metadata in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+def document_key(document: Document) -> tuple:
+    metadata = document.metadata
+    return metadata.get('source'), metadata.get('page'), metadata.get('start_index'), document.page_content
+
+
+def reciprocal_rank_fusion(rankings: Sequence[List[Document]], k: int, rrf_k: int = 60) -> List[Document]:
+    """
+    Fuses ranked lists of documents, scoring each document by the sum of 1 / (rrf_k + rank)
+    over the lists it appears in, and returns the k best
+    """
+    scores: Dict[tuple, float] = {}
+    documents: Dict[tuple, Document] = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = document_key(document)
+            documents.setdefault(key, document)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [documents[key] for key in best]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retriever fusing the vector search of a vectorstore with the keyword search of a
+    KeywordIndex by reciprocal rank fusion. Each search returns fetch_k candidates, twice k by
+    default, restricted to the chunks matching filter when given.
+    """
+
+    vectorstore: VectorStore
+    keyword_index: KeywordIndex
+    k: int = 4
+    fetch_k: Optional[int] = None
+    rrf_k: int = 60
+    filter: Optional[Dict[str, Any]] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def search(self, query: str) -> List[Document]:
+        fetch_k = self.fetch_k or 2 * self.k
+        if self.filter:
+            vector_hits = self.vectorstore.similarity_search(query, k=fetch_k, filter=self.filter)
+        else:
+            vector_hits = self.vectorstore.similarity_search(query, k=fetch_k)
+        keyword_hits = self.keyword_index.search(query, fetch_k, self.filter)
+        return reciprocal_rank_fusion([vector_hits, keyword_hits], self.k, self.rrf_k)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.search(query)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        return self.search(query)
+
+
+def open_keyword_index() -> Optional[KeywordIndex]:
+    """
+    Opens the index in KEYWORD_INDEX_DIRECTORY for hybrid search, or returns None when hybrid
+    search is disabled through HYBRID_SEARCH or the index was never built
+    """
+    directory = os.environ.get('KEYWORD_INDEX_DIRECTORY', 'keyword_index')
+    if os.environ.get('HYBRID_SEARCH', 'True').lower() != 'true':
+        return None
+    if not os.path.exists(os.path.join(directory, INDEX_FILE_NAME)):
+        print(f"No keyword index found in {directory}, using vector search only. Ingest with --vectorstore chroma keyword to build it.")
+        return None
+    return KeywordIndex(directory)
@@ -0,0 +1,488 @@
+import os
+import json
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+
+from retrieval.filters import ensure_partition_columns, filter_clause
+from retrieval.quantization import Quantizer
+
+META_FILE_NAME = 'meta.json'
+VECTORS_FILE_NAME = 'vectors.f32'
+CHUNKS_FILE_NAME = 'chunks.sqlite'
+IVF_FILE_NAME = 'ivf.npz'
+QUANTIZER_FILE_NAME = 'quantizer.npz'
+CODES_FILE_NAME = 'codes.bin'
+IDS_FILE_NAME = 'ids.i64'
+# Rewrite the matrix without its deleted rows once they make up this share of it
+COMPACT_DEAD_RATIO = 0.25
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Positions of the k highest scores, best first, without sorting the whole array
+    """
+    if k >= len(scores):
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, k)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def kmeans(vectors: np.ndarray, clusters: int, iterations: int = 10, seed: int = 42) -> np.ndarray:
+    """
+    Spherical k-means over normalized vectors, returns the normalized centroids
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for cluster in range(clusters):
+            members = vectors[assignment == cluster]
+            if len(members):
+                centroids[cluster] = members.sum(axis=0)
+        centroids = normalize_rows(centroids)
+    return centroids
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Vectorstore keeping every chunk embedding in one float32 matrix memory-mapped from disk,
+    with the chunk texts and metadata in a sidecar SQLite file keyed by matrix row.
+
+    Opening the store maps the matrix without reading it, so startup does not depend on the
+    size of the corpus. Vectors are normalized when added and searched by cosine similarity,
+    either exactly with one matrix product over the rows, or through an optional IVF index
+    (k-means lists over the rows) that only scores the rows of the nprobe closest lists.
+    Deleted rows are masked out until enough of them pile up to compact the matrix.
+
+    Chunks keep the id they were added with in the sidecar, and a separate array maps the rows of
+    the matrix to those ids. Compacting writes the matrix of the next generation to new files and
+    switches to them with the metadata, which is rewritten last on every persist with a new version.
+    Searches reload the store when the version changed, so processes reading the store while
+    another one ingests never mix the rows of one generation with the chunks of another.
+
+    In compact mode, the rows are also kept as int8 or binary codes, optionally of a PCA
+    projection, and searches score the codes instead of the matrix. The rescore * k best rows by
+    code are then scored again with their float32 vectors, read from the matrix for those rows only.
+
+    The partition metadata of the chunks (title, domain, doc_type) is indexed in the sidecar, and a
+    search with a filter on it scores only the rows of that partition, exactly.
+    """
+
+    def __init__(self, directory: str, embedding_function: Optional[Embeddings] = None, nprobe: int = 8, rescore: int = 4):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.embedding_function = embedding_function
+        self.nprobe = nprobe
+        self.rescore = rescore
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(directory, CHUNKS_FILE_NAME), check_same_thread=False)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS chunks (row INTEGER PRIMARY KEY, source TEXT NOT NULL, page INTEGER,
+                                               text TEXT NOT NULL, metadata TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS chunks_source_page ON chunks (source, page);
+        ''')
+        ensure_partition_columns(self._conn)
+        # Rows of the partitions searched so far, dropped whenever rows are added, deleted or moved
+        self._partition_rows: Dict[str, np.ndarray] = {}
+        self._load()
+
+    def _load(self):
+        meta = self._read_meta()
+        self.version = meta.get('version', 0)
+        self.generation = meta.get('generation', 0)
+        self.dim = meta.get('dim')
+        self.rows = meta.get('rows', 0)
+        # Chunk id of every row of the matrix, ascending, the row itself for stores never compacted
+        if os.path.exists(self._path(IDS_FILE_NAME)):
+            self.ids = np.fromfile(self._path(IDS_FILE_NAME), dtype=np.int64, count=self.rows)
+        else:
+            self.ids = np.arange(self.rows, dtype=np.int64)
+        # Chunks committed by a run interrupted before writing the metadata keep their ids
+        last_id, = self._conn.execute('SELECT MAX(row) FROM chunks').fetchone()
+        self.next_id = max(meta.get('next_id', self.rows), last_id + 1 if last_id is not None else 0)
+        self.alive = np.zeros(self.rows, dtype=bool)
+        self.alive[self.positions([row for row, in self._conn.execute('SELECT row FROM chunks')])] = True
+        self._partition_rows.clear()
+        self._matrix = None
+        self.ivf_centroids = None
+        self.ivf_assignment = None
+        self.ivf_trained_rows = 0
+        self._ivf_order = None
+        self._ivf_bounds = None
+        self._load_ivf()
+        self.quantizer = None
+        self._codes = None
+        if os.path.exists(self._path(QUANTIZER_FILE_NAME)):
+            self.quantizer = Quantizer.load(self._path(QUANTIZER_FILE_NAME))
+        # Mapped right away, so the files of this generation stay readable once the next one replaces them
+        if self.rows:
+            self.matrix()
+            if self.quantizer is not None:
+                self.codes()
+
+    def refresh(self) -> bool:
+        """
+        Reloads the store when another process persisted it since it was opened or last refreshed
+        """
+        with self._lock:
+            while self._read_meta().get('version', 0) != self.version:
+                try:
+                    self._load()
+                    return True
+                except FileNotFoundError:
+                    # Compacted again between reading the metadata and mapping the files
+                    continue
+            return False
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        return os.path.exists(os.path.join(directory, META_FILE_NAME))
+
+    def _path(self, name: str, generation: Optional[int] = None) -> str:
+        """
+        Path of a file of the current generation, or of the given one; generation 0 uses the bare names
+        """
+        if name not in (VECTORS_FILE_NAME, CODES_FILE_NAME, IDS_FILE_NAME):
+            return os.path.join(self.directory, name)
+        generation = self.generation if generation is None else generation
+        if generation:
+            base, extension = os.path.splitext(name)
+            name = f'{base}.{generation}{extension}'
+        return os.path.join(self.directory, name)
+
+    def _read_meta(self) -> dict:
+        try:
+            with open(self._path(META_FILE_NAME), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_meta(self):
+        tmp_path = self._path(META_FILE_NAME) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'dim': self.dim, 'rows': self.rows, 'dtype': 'float32', 'version': self.version,
+                       'generation': self.generation, 'next_id': self.next_id}, f)
+        os.replace(tmp_path, self._path(META_FILE_NAME))
+
+    def matrix(self) -> np.ndarray:
+        """
+        The memory-mapped (rows, dim) matrix of normalized vectors
+        """
+        if self._matrix is None or len(self._matrix) != self.rows:
+            if not self.rows:
+                return np.zeros((0, self.dim or 0), dtype=np.float32)
+            self._matrix = np.memmap(self._path(VECTORS_FILE_NAME), dtype=np.float32, mode='r', shape=(self.rows, self.dim))
+        return self._matrix
+
+    def codes(self) -> np.ndarray:
+        """
+        The memory-mapped (rows, width) matrix of compact codes of the quantizer
+        """
+        if self._codes is None or len(self._codes) != self.rows:
+            if not self.rows:
+                return np.zeros((0, self.quantizer.width), dtype=self.quantizer.dtype)
+            self._codes = np.memmap(self._path(CODES_FILE_NAME), dtype=self.quantizer.dtype, mode='r', shape=(self.rows, self.quantizer.width))
+        return self._codes
+
+    def _append(self, name: str, array: np.ndarray):
+        # Rows past self.rows were written by an interrupted run and never recorded, they are overwritten
+        with open(self._path(name), 'ab') as f:
+            f.truncate(self.rows * array.shape[1] * array.itemsize)
+            f.write(np.ascontiguousarray(array).tobytes())
+
+    def _rewrite(self, name: str, blocks: Iterable[np.ndarray], generation: Optional[int] = None):
+        tmp_path = self._path(name, generation) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for block in blocks:
+                f.write(np.ascontiguousarray(block).tobytes())
+        os.replace(tmp_path, self._path(name, generation))
+
+    def positions(self, ids: Iterable[int]) -> np.ndarray:
+        """
+        Rows of the matrix holding the given chunk ids, leaving out the ids it does not hold
+        """
+        ids = np.fromiter(ids, dtype=np.int64)
+        positions = np.searchsorted(self.ids, ids)
+        found = positions < len(self.ids)
+        found[found] = self.ids[positions[found]] == ids[found]
+        return positions[found]
+
+    def _load_ivf(self):
+        try:
+            with np.load(self._path(IVF_FILE_NAME)) as ivf:
+                self.ivf_centroids = ivf['centroids']
+                self.ivf_assignment = ivf['assignment']
+                self.ivf_trained_rows = int(ivf['trained_rows'])
+                generation = int(ivf['generation']) if 'generation' in ivf else 0
+        except FileNotFoundError:
+            return
+        if generation != self.generation:
+            # Written for a generation this process has not switched to yet
+            self.ivf_centroids, self.ivf_assignment, self.ivf_trained_rows = None, None, 0
+            return
+        self._index_ivf_lists()
+
+    def _index_ivf_lists(self):
+        # Rows sorted by list, with the boundaries of every list in that order
+        self._ivf_order = np.argsort(self.ivf_assignment, kind='stable')
+        self._ivf_bounds = np.searchsorted(self.ivf_assignment[self._ivf_order], np.arange(len(self.ivf_centroids) + 1))
+
+    def add_vectors(self, texts: List[str], vectors: List[List[float]], metadatas: List[dict]) -> List[int]:
+        vectors = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            ids = np.arange(self.next_id, self.next_id + len(vectors), dtype=np.int64)
+            if not os.path.exists(self._path(IDS_FILE_NAME)):
+                self._rewrite(IDS_FILE_NAME, [self.ids])
+            self._append(IDS_FILE_NAME, ids[:, None])
+            self._append(VECTORS_FILE_NAME, vectors)
+            if self.quantizer is not None:
+                self._append(CODES_FILE_NAME, self.quantizer.encode(vectors))
+            rows = ids.tolist()
+            self._conn.executemany('INSERT INTO chunks (row, source, page, text, metadata, title, domain, doc_type) '
+                                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                   [(row, metadata['source'], metadata.get('page'), text, json.dumps(metadata),
+                                     metadata.get('title'), metadata.get('domain'), metadata.get('doc_type'))
+                                    for row, text, metadata in zip(rows, texts, metadatas)])
+            self._partition_rows.clear()
+            self.rows += len(vectors)
+            self.ids = np.concatenate([self.ids, ids])
+            self.next_id += len(vectors)
+            self.alive = np.concatenate([self.alive, np.ones(len(vectors), dtype=bool)])
+            if self.ivf_centroids is not None:
+                self.ivf_assignment = np.concatenate([self.ivf_assignment, np.argmax(vectors @ self.ivf_centroids.T, axis=1)])
+                self._index_ivf_lists()
+        return rows
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        rows = self.add_vectors(texts, self.embedding_function.embed_documents(texts), metadatas)
+        return [str(row) for row in rows]
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   directory: str = 'localdb', **kwargs: Any) -> 'LocalVectorStore':
+        store = cls(directory, embedding)
+        store.add_texts(texts, metadatas)
+        store.persist()
+        return store
+
+    def _delete_where(self, where: str, params: List[tuple]):
+        with self._lock:
+            self._partition_rows.clear()
+            for param in params:
+                ids = [row for row, in self._conn.execute(f'SELECT row FROM chunks WHERE {where}', param)]
+                self.alive[self.positions(ids)] = False
+                self._conn.execute(f'DELETE FROM chunks WHERE {where}', param)
+
+    def delete_sources(self, sources: List[str]):
+        self._delete_where('source = ?', [(source,) for source in sources])
+
+    def delete_pages(self, source: str, pages: List[int]):
+        self._delete_where('source = ? AND page = ?', [(source, page) for page in pages])
+
+    def sources(self) -> Set[str]:
+        with self._lock:
+            return {source for source, in self._conn.execute('SELECT DISTINCT source FROM chunks')}
+
+    def compact(self):
+        """
+        Writes the matrix, the codes and the chunk ids of the next generation without the deleted
+        rows. The files of the previous generation are removed once the metadata points to the new ones.
+        """
+        keep = np.flatnonzero(self.alive)
+        generation = self.generation + 1
+        matrix = self.matrix()
+        self._rewrite(VECTORS_FILE_NAME, (matrix[keep[pos:pos + 65536]] for pos in range(0, len(keep), 65536)), generation)
+        if self.quantizer is not None:
+            codes = self.codes()
+            self._rewrite(CODES_FILE_NAME, (codes[keep[pos:pos + 65536]] for pos in range(0, len(keep), 65536)), generation)
+        self.ids = self.ids[keep]
+        self._rewrite(IDS_FILE_NAME, [self.ids], generation)
+        self.generation = generation
+        self._matrix = None
+        self._codes = None
+        self._partition_rows.clear()
+        self.rows = len(keep)
+        self.alive = np.ones(self.rows, dtype=bool)
+        if self.ivf_assignment is not None:
+            self.ivf_assignment = self.ivf_assignment[keep]
+            self._index_ivf_lists()
+
+    def build_ivf(self, lists: Optional[int] = None, sample_size: int = 100000):
+        """
+        Trains the IVF lists with k-means on a sample of the rows and assigns every row to a list
+        """
+        matrix = self.matrix()
+        lists = lists or max(1, int(np.sqrt(self.rows)))
+        sample = self.sample(sample_size)
+        self.ivf_centroids = kmeans(sample, min(lists, len(sample)))
+        self.ivf_assignment = np.concatenate([np.argmax(np.asarray(matrix[pos:pos + 65536]) @ self.ivf_centroids.T, axis=1)
+                                              for pos in range(0, self.rows, 65536)])
+        self.ivf_trained_rows = self.rows
+        self._index_ivf_lists()
+
+    def sample(self, size: int = 100000) -> np.ndarray:
+        rng = np.random.default_rng(42)
+        return np.asarray(self.matrix()[np.sort(rng.choice(self.rows, min(size, self.rows), replace=False))])
+
+    def build_quantizer(self, mode: str, dimensions: int = 0):
+        """
+        Fits the quantizer, with its PCA projection, on a sample of the rows and encodes every row
+        """
+        self.quantizer = Quantizer.fit(self.sample(), mode, dimensions, trained_rows=self.rows)
+        self._rewrite(CODES_FILE_NAME, self.quantizer.encode_blocks(self.matrix()))
+        self._codes = None
+        self.quantizer.save(self._path(QUANTIZER_FILE_NAME))
+
+    def drop_quantizer(self):
+        self.quantizer = None
+        self._codes = None
+        for name in (QUANTIZER_FILE_NAME, CODES_FILE_NAME):
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+
+    def persist(self, ivf_min_rows: int = 0, quantization: str = 'none', pca_dimensions: int = 0):
+        """
+        Commits the chunks and the matrix size, compacting the matrix when too many rows were
+        deleted. With ivf_min_rows, the IVF index is trained once the store holds that many rows,
+        and trained again whenever the store doubled in size since. The quantizer of the int8 or
+        binary codes is fitted again on the same schedule, or when its settings changed.
+        """
+        with self._lock:
+            generation = self.generation
+            if self.rows and (~self.alive).sum() > COMPACT_DEAD_RATIO * self.rows:
+                self.compact()
+            if ivf_min_rows and self.rows >= ivf_min_rows and self.rows >= 2 * self.ivf_trained_rows:
+                self.build_ivf()
+            if quantization == 'none':
+                if self.quantizer is not None:
+                    self.drop_quantizer()
+            elif self.rows and (self.quantizer is None or (self.quantizer.mode, self.quantizer.dimensions) != (quantization, pca_dimensions)
+                                or self.rows >= 2 * self.quantizer.trained_rows):
+                self.build_quantizer(quantization, pca_dimensions)
+            self._conn.commit()
+            if self.ivf_centroids is not None:
+                np.savez(self._path(IVF_FILE_NAME), centroids=self.ivf_centroids, assignment=self.ivf_assignment,
+                         trained_rows=self.ivf_trained_rows, generation=self.generation)
+            # Readers switch to everything written above when they see the new version
+            self.version += 1
+            self._write_meta()
+            if generation != self.generation:
+                for name in (VECTORS_FILE_NAME, CODES_FILE_NAME, IDS_FILE_NAME):
+                    if os.path.exists(self._path(name, generation)):
+                        os.remove(self._path(name, generation))
+
+    def candidate_rows(self, query: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Rows of the nprobe IVF lists closest to the query, or None to search every row
+        """
+        if self.ivf_centroids is None or len(self.ivf_assignment) != self.rows:
+            return None
+        lists = top_k(self.ivf_centroids @ query, self.nprobe)
+        return np.concatenate([self._ivf_order[self._ivf_bounds[i]:self._ivf_bounds[i + 1]] for i in lists])
+
+    def search_rows(self, query: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the k best live rows for a normalized query, among rows when given, with their scores
+        """
+        # A partition is scanned exactly, the IVF lists nearest to the query may not hold any of its rows
+        candidates = self.candidate_rows(query) if rows is None else rows
+        rescoring = self.quantizer is not None and self.rescore > 0
+        fetch = k * self.rescore if rescoring else k
+        if candidates is None:
+            scores = self.score_rows(query)
+            scores[~self.alive] = -np.inf
+            best = top_k(scores, fetch)
+            best = best[np.isfinite(scores[best])]
+            scores = scores[best]
+        else:
+            # Sorted rows read the memory map sequentially
+            candidates = np.sort(candidates[self.alive[candidates]])
+            scores = self.score_rows(query, candidates)
+            order = top_k(scores, fetch)
+            best, scores = candidates[order], scores[order]
+        if rescoring:
+            best = np.sort(best)
+            scores = np.asarray(self.matrix()[best] @ query)
+            order = top_k(scores, k)
+            best, scores = best[order], scores[order]
+        return best, scores
+
+    def score_rows(self, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Similarity of a normalized query to the given rows, or to every row, computed from the
+        codes when the store has a quantizer
+        """
+        if self.quantizer is None:
+            matrix = self.matrix()
+            return np.asarray((matrix if rows is None else matrix[rows]) @ query)
+        codes = self.codes()
+        return self.quantizer.score(codes if rows is None else codes[rows], self.quantizer.prepare_query(query))
+
+    def documents(self, rows: np.ndarray) -> List[Tuple[int, Document]]:
+        """
+        (row, document) pairs of the given rows of the matrix, leaving out the rows whose chunk was deleted since
+        """
+        with self._lock:
+            ids = self.ids[rows].tolist()
+            placeholders = ','.join('?' * len(ids))
+            found = {row: (text, metadata) for row, text, metadata in
+                     self._conn.execute(f'SELECT row, text, metadata FROM chunks WHERE row IN ({placeholders})', ids)}
+        return [(int(row), Document(page_content=found[chunk_id][0], metadata=json.loads(found[chunk_id][1])))
+                for row, chunk_id in zip(rows, ids) if chunk_id in found]
+
+    def partition_rows(self, filter: Dict[str, Any]) -> np.ndarray:
+        """
+        Rows of the chunks matching a filter in the format of Chroma's where clauses, read from the sidecar indexes
+        """
+        key = json.dumps(filter, sort_keys=True)
+        with self._lock:
+            if key not in self._partition_rows:
+                where, params = filter_clause(filter)
+                self._partition_rows[key] = self.positions(row for row, in self._conn.execute(f'SELECT row FROM chunks WHERE 1{where}', params))
+            return self._partition_rows[key]
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               filter: Optional[Dict[str, Any]] = None) -> List[Tuple[Document, float]]:
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        # Held for the whole search, so a reload never swaps the matrix under it
+        with self._lock:
+            self.refresh()
+            if not self.rows or not self.alive.any():
+                return []
+            rows, scores = self.search_rows(query, k, self.partition_rows(filter) if filter else None)
+            documents = self.documents(rows)
+        scores_by_row = dict(zip(rows.tolist(), scores.tolist()))
+        return [(document, scores_by_row[row]) for row, document in documents]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, filter: Optional[Dict[str, Any]] = None,
+                                    **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score_by_vector(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None,
+                                     **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embedding_function.embed_query(query), k, filter)
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self.embedding_function.embed_query(query), k, filter)
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
@@ -0,0 +1,271 @@
+import os
+import time
+import asyncio
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.chains.base import Chain
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+
+from retrieval.answer_cache import SemanticAnswerCache
+from retrieval.context import ContextPacker
+from retrieval.filters import filter_scope
+from retrieval.keyword_index import KeywordIndex, reciprocal_rank_fusion
+from retrieval.rerank import CrossEncoderReranker
+
+
+def format_chat_history(chat_history: Sequence[Tuple[str, str]]) -> str:
+    """
+    Formats (question, answer) pairs the way ConversationalRetrievalChain does
+    """
+    return "".join(f"\nHuman: {question}\nAssistant: {answer}" for question, answer in chat_history)
+
+
+class EmbeddingMicroBatcher:
+    """
+    Gathers the query embeddings requested by concurrent queries into a single model call.
+
+    A batch is sent as soon as max_batch queries are waiting, or max_wait seconds after its
+    first query, so a lone query only pays max_wait on top of its own embedding.
+    """
+
+    def __init__(self, embeddings: Embeddings, executor: ThreadPoolExecutor, max_batch: int = 32, max_wait: float = 0.005):
+        self.embeddings = embeddings
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending: Optional[asyncio.Queue] = None
+        self.batches = 0
+        self.texts = 0
+
+    async def embed(self, text: str) -> List[float]:
+        future = asyncio.get_running_loop().create_future()
+        await self.pending.put((text, future))
+        return await future
+
+    async def run(self):
+        self.pending = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.pending.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.pending.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            texts = [text for text, _ in batch]
+            try:
+                vectors = await loop.run_in_executor(self.executor, self.embeddings.embed_documents, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.texts += len(texts)
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+
+
+class AsyncQueryPipeline:
+    """
+    Answers queries on an asyncio event loop, overlapping the steps of concurrent queries
+    instead of running each query from start to end on its own thread.
+
+    Query embeddings of concurrent queries are micro-batched into one model call, vector
+    searches run on a pool of search_threads threads, and question condensing and answer
+    generation run on the chains given, one query per chain at a time. Each chain should hold
+    its own LLM unless the LLM is safe to share between threads, as API clients are.
+    question_generators, when given, condense a follow up question and its chat history into the
+    question that is searched, question_generators[i] sharing the LLM of combine_chains[i].
+
+    With a keyword_index, vector and keyword searches both return 2 * k candidates, fused by
+    reciprocal rank fusion. With a reranker, the search returns its number of candidates instead
+    of k, and the reranker keeps the best of them on the search threads. With a context_packer, the documents found are merged, deduplicated and cut to the token
+    budget of the prompt before generation. With an answer_cache, a question similar enough to one answered before gets the cached
+    answer right after its embedding, without search or generation.
+
+    The loop runs on its own thread, so threaded callers such as the HTTP server use query().
+    """
+
+    def __init__(self, vectorstore: VectorStore, embeddings: Embeddings, combine_chains: List[Chain], k: int = 4,
+                 question_generators: Optional[List[Chain]] = None, search_threads: int = 1,
+                 embed_batch_size: int = 32, embed_max_wait: float = 0.005,
+                 get_chat_history: Callable[[Sequence[Tuple[str, str]]], str] = format_chat_history,
+                 answer_cache: Optional[SemanticAnswerCache] = None, context_packer: Optional[ContextPacker] = None,
+                 keyword_index: Optional[KeywordIndex] = None, reranker: Optional[CrossEncoderReranker] = None):
+        self.vectorstore = vectorstore
+        self.keyword_index = keyword_index
+        self.reranker = reranker
+        self.answer_cache = answer_cache
+        self.context_packer = context_packer
+        # Number of chunks searched, re-ranking keeps fewer of them
+        self.k = reranker.candidates if reranker is not None else k
+        self.combine_chains = combine_chains
+        self.question_generators = question_generators
+        self.get_chat_history = get_chat_history
+        self.llm_concurrency = len(combine_chains)
+        self.llm_executor = ThreadPoolExecutor(max_workers=self.llm_concurrency, thread_name_prefix='llm')
+        self.search_executor = ThreadPoolExecutor(max_workers=search_threads, thread_name_prefix='search')
+        self.embed_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='embed')
+        self.batcher = EmbeddingMicroBatcher(embeddings, self.embed_executor, max_batch=embed_batch_size, max_wait=embed_max_wait)
+        self.latencies = deque(maxlen=1000)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.slots: Optional[asyncio.Queue] = None
+
+    def start(self):
+        """
+        Starts the event loop thread, the micro-batcher and the pool of chain slots
+        """
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='query-pipeline', daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start_tasks(), self.loop).result()
+
+    async def _start_tasks(self):
+        self.slots = asyncio.Queue()
+        for slot in range(self.llm_concurrency):
+            self.slots.put_nowait(slot)
+        self.batcher_task = asyncio.ensure_future(self.batcher.run())
+
+    async def run_llm(self, chains: List[Chain], queue_timeout: Optional[float], **kwargs: Any) -> Any:
+        """
+        Runs one of the chains on the LLM threads as soon as a chain slot is free. Only the LLM
+        steps hold a slot, so other queries embed and search while answers are generated.
+        """
+        slot = await asyncio.wait_for(self.slots.get(), queue_timeout)
+        try:
+            return await self.loop.run_in_executor(self.llm_executor, functools.partial(chains[slot].run, **kwargs))
+        finally:
+            self.slots.put_nowait(slot)
+
+    async def search(self, question: str, vector: List[float], filter: Optional[Dict[str, Any]] = None) -> List[Document]:
+        search_kwargs = {'filter': filter} if filter else {}
+        vector_search = functools.partial(self.vectorstore.similarity_search_by_vector, vector, **search_kwargs)
+        if self.keyword_index is None:
+            return await self.loop.run_in_executor(self.search_executor, vector_search, self.k)
+        vector_hits, keyword_hits = await asyncio.gather(
+            self.loop.run_in_executor(self.search_executor, vector_search, 2 * self.k),
+            self.loop.run_in_executor(self.search_executor, self.keyword_index.search, question, 2 * self.k, filter))
+        return reciprocal_rank_fusion([vector_hits, keyword_hits], self.k)
+
+    async def answer(self, question: str, chat_history: Sequence[Tuple[str, str]] = (),
+                     callbacks: Optional[List[BaseCallbackHandler]] = None, queue_timeout: Optional[float] = None,
+                     filter: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Returns the answer with its source documents, the standalone question that was searched,
+        whether the answer came from the cache and the time spent in each step, waiting for a chain included. Raises asyncio.TimeoutError
+        when no chain frees up within queue_timeout seconds. With a filter, only the chunks of that partition are searched.
+        Callbacks only receive the tokens of generated answers, a cached answer is left to the caller to send.
+        """
+        start = time.time()
+        timings = {}
+        search_question = question
+        if chat_history and self.question_generators:
+            search_question = await self.run_llm(self.question_generators, queue_timeout, question=question,
+                                                 chat_history=self.get_chat_history(chat_history))
+            timings['condense'] = time.time() - start
+
+        step = time.time()
+        vector = await self.batcher.embed(search_question)
+        timings['embed'] = time.time() - step
+
+        if self.answer_cache is not None:
+            cached = self.answer_cache.lookup(vector, filter_scope(filter))
+            if cached is not None:
+                return self.result(start, timings, cached.answer, cached.source_documents, search_question, True)
+
+        step = time.time()
+        documents = await self.search(search_question, vector, filter)
+        timings['search'] = time.time() - step
+
+        if self.reranker is not None:
+            step = time.time()
+            documents = await self.loop.run_in_executor(self.search_executor, self.reranker.rerank, search_question, documents)
+            timings['rerank'] = time.time() - step
+
+        if self.context_packer is not None:
+            step = time.time()
+            documents = await self.loop.run_in_executor(self.search_executor, self.context_packer.pack, search_question, documents)
+            timings['pack'] = time.time() - step
+
+        step = time.time()
+        answer = await self.run_llm(self.combine_chains, queue_timeout, input_documents=documents,
+                                    question=search_question, callbacks=callbacks)
+        timings['generate'] = time.time() - step
+
+        if self.answer_cache is not None:
+            self.answer_cache.store(vector, answer, documents, filter_scope(filter))
+        return self.result(start, timings, answer, documents, search_question, False)
+
+    def result(self, start: float, timings: Dict[str, float], answer: str, documents: List[Document],
+               search_question: str, cached: bool) -> Dict[str, Any]:
+        seconds = time.time() - start
+        self.latencies.append(seconds)
+        return {'answer': answer, 'source_documents': documents, 'generated_question': search_question,
+                'cached': cached, 'seconds': seconds, 'timings': {name: round(value, 3) for name, value in timings.items()}}
+
+    def query(self, question: str, chat_history: Sequence[Tuple[str, str]] = (),
+              callbacks: Optional[List[BaseCallbackHandler]] = None, queue_timeout: Optional[float] = None,
+              filter: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Thread-safe blocking wrapper around answer() for callers outside the event loop. A cached
+        answer is sent to the callbacks from the calling thread, so a slow client never blocks the loop.
+        """
+        result = asyncio.run_coroutine_threadsafe(self.answer(question, chat_history, callbacks, queue_timeout, filter), self.loop).result()
+        if result['cached']:
+            for callback in callbacks or []:
+                callback.on_llm_new_token(result['answer'])
+        return result
+
+    def latency_report(self) -> Dict[str, float]:
+        """
+        Median and 95th percentile latency in seconds over the last 1000 queries
+        """
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {'queries': 0}
+        return {'queries': len(latencies),
+                'p50': round(latencies[len(latencies) // 2], 3),
+                'p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+                'embedding_batches': self.batcher.batches,
+                'embedded_queries': self.batcher.texts}
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.llm_executor.shutdown(wait=False)
+        self.search_executor.shutdown(wait=False)
+        self.embed_executor.shutdown(wait=False)
+
+
+def create_query_pipeline(vectorstore: VectorStore, embeddings: Embeddings, combine_chains: List[Chain], k: int,
+                          question_generators: Optional[List[Chain]] = None,
+                          answer_cache: Optional[SemanticAnswerCache] = None,
+                          get_chat_history: Callable[[Sequence[Tuple[str, str]]], str] = format_chat_history,
+                          context_packer: Optional[ContextPacker] = None,
+                          keyword_index: Optional[KeywordIndex] = None,
+                          reranker: Optional[CrossEncoderReranker] = None) -> AsyncQueryPipeline:
+    """
+    Builds the query pipeline configured through the QUERY_* environment variables
+    """
+    return AsyncQueryPipeline(vectorstore, embeddings, combine_chains, k=k,
+                              question_generators=question_generators,
+                              search_threads=int(os.environ.get('QUERY_SEARCH_THREADS', 1)),
+                              embed_batch_size=int(os.environ.get('QUERY_EMBED_BATCH_SIZE', 32)),
+                              embed_max_wait=float(os.environ.get('QUERY_EMBED_MAX_WAIT_MS', 5)) / 1000,
+                              answer_cache=answer_cache,
+                              get_chat_history=get_chat_history,
+                              context_packer=context_packer,
+                              keyword_index=keyword_index,
+                              reranker=reranker)
@@ -0,0 +1,103 @@
+from typing import Iterator, Optional
+
+import numpy as np
+
+QUANTIZATION_TYPES = ['none', 'int8', 'binary']
+# Rows encoded or scored at a time, bounds the float32 copies made along the way
+BLOCK_ROWS = 65536
+# Number of set bits of every byte value
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+class Quantizer:
+    """
+    Compact codes of normalized embeddings, searched instead of the float32 vectors.
+
+    Vectors are centered on the mean of the fitted vectors and, when dimensions is set, projected
+    on their first principal components. int8 codes then keep every projected coordinate as a
+    byte with a scale per dimension, and score a query by inner product. binary codes keep one
+    sign bit per dimension, and score a query by the opposite of their Hamming distance.
+    """
+
+    def __init__(self, mode: str, mean: np.ndarray, components: Optional[np.ndarray], scale: np.ndarray,
+                 dimensions: int, trained_rows: int):
+        self.mode = mode
+        self.mean = mean
+        self.components = components
+        self.scale = scale
+        # Requested number of PCA dimensions, 0 when the vectors are not reduced
+        self.dimensions = dimensions
+        self.trained_rows = trained_rows
+
+    @classmethod
+    def fit(cls, vectors: np.ndarray, mode: str, dimensions: int = 0, trained_rows: Optional[int] = None) -> 'Quantizer':
+        vectors = np.asarray(vectors, dtype=np.float32)
+        mean = vectors.mean(axis=0)
+        components = None
+        if dimensions and dimensions < vectors.shape[1]:
+            _, _, directions = np.linalg.svd(vectors - mean, full_matrices=False)
+            components = np.ascontiguousarray(directions[:dimensions])
+        quantizer = cls(mode, mean, components, np.ones(1, dtype=np.float32), dimensions, trained_rows or len(vectors))
+        quantizer.scale = np.abs(quantizer.project(vectors)).max(axis=0) / 127
+        quantizer.scale[quantizer.scale == 0] = 1.0
+        return quantizer
+
+    @classmethod
+    def load(cls, path: str) -> 'Quantizer':
+        with np.load(path) as saved:
+            components = saved['components'] if saved['components'].size else None
+            return cls(str(saved['mode']), saved['mean'], components, saved['scale'], int(saved['dimensions']), int(saved['trained_rows']))
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            np.savez(f, mode=self.mode, mean=self.mean, scale=self.scale, dimensions=self.dimensions, trained_rows=self.trained_rows,
+                     components=self.components if self.components is not None else np.zeros(0, dtype=np.float32))
+
+    @property
+    def width(self) -> int:
+        """
+        Number of code bytes per vector
+        """
+        dimensions = len(self.components) if self.components is not None else len(self.mean)
+        return dimensions if self.mode == 'int8' else (dimensions + 7) // 8
+
+    @property
+    def dtype(self):
+        return np.int8 if self.mode == 'int8' else np.uint8
+
+    def project(self, vectors: np.ndarray, center: bool = True) -> np.ndarray:
+        vectors = vectors - self.mean if center else vectors
+        return vectors @ self.components.T if self.components is not None else vectors
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        projected = self.project(np.asarray(vectors, dtype=np.float32))
+        match self.mode:
+            case "int8":
+                return np.clip(np.rint(projected / self.scale), -127, 127).astype(np.int8)
+            case "binary":
+                return np.packbits(projected > 0, axis=1)
+            case _default:
+                raise Exception(f"Quantization {self.mode} is not supported. Please choose one of the following: int8, binary")
+
+    def encode_blocks(self, matrix: np.ndarray) -> Iterator[np.ndarray]:
+        for position in range(0, len(matrix), BLOCK_ROWS):
+            yield self.encode(np.asarray(matrix[position:position + BLOCK_ROWS]))
+
+    def prepare_query(self, query: np.ndarray) -> np.ndarray:
+        if self.mode == 'int8':
+            # The mean only shifts every inner product by the same amount, the query is left uncentered
+            return (self.project(query[None, :], center=False)[0] * self.scale).astype(np.float32)
+        return np.packbits(self.project(query[None, :]) > 0, axis=1)[0]
+
+    def score(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """
+        Approximate similarity of a query prepared by prepare_query to every row of codes
+        """
+        scores = np.empty(len(codes), dtype=np.float32)
+        for position in range(0, len(codes), BLOCK_ROWS):
+            block = np.asarray(codes[position:position + BLOCK_ROWS])
+            if self.mode == 'int8':
+                scores[position:position + len(block)] = block.astype(np.float32) @ query
+            else:
+                scores[position:position + len(block)] = -POPCOUNT[np.bitwise_xor(block, query)].sum(axis=1, dtype=np.int32)
+        return scores
@@ -0,0 +1,96 @@
+import os
+import time
+import threading
+from typing import Any, Dict, List, Optional
+
+from langchain.docstore.document import Document
+
+from retrieval.retrievers import WrappingRetriever
+
+
+class CrossEncoderReranker:
+    """
+    Re-scores retrieved chunks against the question with a small cross-encoder on CPU, and keeps
+    the top_n best. All the (question, chunk) pairs of a query go through the model in a single
+    batch. The model is loaded on first use, and the time spent re-ranking is kept for reports.
+    """
+
+    def __init__(self, model_name: str, candidates: int = 20, top_n: int = 4, max_length: int = 256):
+        self.model_name = model_name
+        # Number of chunks the retriever should return for re-ranking
+        self.candidates = candidates
+        self.top_n = top_n
+        self.max_length = max_length
+        self.tokenizer = None
+        self.model = None
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.seconds = 0.0
+        self.last_seconds = 0.0
+
+    def load(self):
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(self.model_name)
+        self.model.eval()
+
+    def scores(self, question: str, documents: List[Document]) -> List[float]:
+        import torch
+        with self._lock:
+            if self.model is None:
+                self.load()
+            inputs = self.tokenizer([question] * len(documents), [document.page_content for document in documents],
+                                    padding=True, truncation='only_second', max_length=self.max_length, return_tensors='pt')
+            with torch.inference_mode():
+                logits = self.model(**inputs).logits
+        # Relevance models have a single output, classifiers put the relevant class last
+        return logits[:, -1].tolist()
+
+    def rerank(self, question: str, documents: List[Document]) -> List[Document]:
+        if not documents:
+            return documents
+        start = time.time()
+        scores = self.scores(question, documents)
+        ranked = sorted(zip(scores, range(len(documents))), reverse=True)[:self.top_n]
+        reranked = [Document(page_content=documents[i].page_content, metadata=dict(documents[i].metadata, rerank_score=round(score, 3)))
+                    for score, i in ranked]
+        seconds = time.time() - start
+        with self._lock:
+            self.queries += 1
+            self.seconds += seconds
+            self.last_seconds = seconds
+        return reranked
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'queries': self.queries, 'candidates': self.candidates, 'top_n': self.top_n,
+                    'mean_ms': round(1000 * self.seconds / self.queries, 1) if self.queries else 0.0}
+
+    def stats_report(self) -> str:
+        stats = self.stats()
+        return (f"Re-ranking: {stats['queries']} queries, {stats['mean_ms']} ms per query on average "
+                f"for {self.candidates} candidates, keeping the best {self.top_n}")
+
+
+class RerankingRetriever(WrappingRetriever):
+    """
+    Retriever returning the documents of another retriever re-ranked by a CrossEncoderReranker
+    """
+
+    reranker: CrossEncoderReranker
+
+    def transform(self, query: str, documents: List[Document]) -> List[Document]:
+        return self.reranker.rerank(query, documents)
+
+
+def create_reranker(top_n: int) -> Optional[CrossEncoderReranker]:
+    """
+    Builds the re-ranker configured through the RERANK_* environment variables, keeping the top_n
+    best chunks, or returns None unless RERANK is True
+    """
+    if os.environ.get('RERANK', 'False').lower() != 'true':
+        return None
+    return CrossEncoderReranker(os.environ.get('RERANK_MODEL', 'cross-encoder/ms-marco-MiniLM-L-6-v2'),
+                                candidates=int(os.environ.get('RERANK_CANDIDATES', 20)),
+                                top_n=int(os.environ.get('RERANK_TOP_N', top_n)),
+                                max_length=int(os.environ.get('RERANK_MAX_LENGTH', 256)))
@@ -0,0 +1,26 @@
+from typing import List
+
+from langchain.callbacks.manager import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain.docstore.document import Document
+from langchain.schema import BaseRetriever
+
+
+class WrappingRetriever(BaseRetriever):
+    """
+    Retriever passing the documents of another retriever through transform. Subclasses declare
+    what transform needs as fields, BaseRetriever being a pydantic model.
+    """
+
+    retriever: BaseRetriever
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def transform(self, query: str, documents: List[Document]) -> List[Document]:
+        raise NotImplementedError
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.transform(query, self.retriever.get_relevant_documents(query, callbacks=run_manager.get_child()))
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        return self.transform(query, await self.retriever.aget_relevant_documents(query, callbacks=run_manager.get_child()))
@@ -0,0 +1,195 @@
+import json
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.docstore.document import Document
+
+from retrieval.filters import parse_partition
+from retrieval.pipeline import AsyncQueryPipeline
+
+
+class TokenStreamHandler(BaseCallbackHandler):
+    """
+    Writes every token the LLM generates to an HTTP response as a line of NDJSON.
+    A client that disconnects stops the writes, the generation itself runs to its end.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.disconnected = False
+
+    def write(self, data: dict):
+        if self.disconnected:
+            return
+        try:
+            self.wfile.write(json.dumps(data).encode('utf-8') + b'\n')
+            self.wfile.flush()
+        except OSError:
+            self.disconnected = True
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.write({'token': token})
+
+
+def source_to_dict(document: Document) -> dict:
+    return {'content': document.page_content, 'metadata': document.metadata}
+
+
+class QueryServer(ThreadingHTTPServer):
+    """
+    HTTP server answering questions with models and vectorstore loaded once at startup.
+
+    Each connection is handled on its own thread and hands its query to the shared asyncio
+    pipeline, which overlaps the steps of concurrent queries and bounds the number of concurrent
+    generations by its number of chains. At most max_queued queries wait on top of the ones
+    being generated, later ones are turned away with 503 instead of piling up. Queries that do not
+    name a partition search default_partition, the whole collection when it is empty.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, pipeline: AsyncQueryPipeline, max_queued: int = 32, queue_timeout: Optional[float] = None,
+                 default_partition: Optional[str] = None):
+        super().__init__(address, QueryRequestHandler)
+        self.pipeline = pipeline
+        self.queue_timeout = queue_timeout
+        self.default_partition = default_partition
+        # Admission of the queries being answered or waiting for a chain
+        self.admission = threading.BoundedSemaphore(pipeline.llm_concurrency + max_queued)
+        self.stats_lock = threading.Lock()
+        self.active = 0
+        self.served = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def health(self) -> Dict[str, Any]:
+        with self.stats_lock:
+            health = {'llm_concurrency': self.pipeline.llm_concurrency, 'active': self.active,
+                      'served': self.served, 'rejected': self.rejected, 'failed': self.failed, 'latency': self.pipeline.latency_report()}
+        if self.pipeline.answer_cache is not None:
+            health['answer_cache'] = self.pipeline.answer_cache.stats()
+        if self.pipeline.reranker is not None:
+            health['rerank'] = self.pipeline.reranker.stats()
+        return health
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /query with {"query": "...", "chat_history": [["question", "answer"], ...], "stream": true, "hide_source": false,
+    "partition": "elden-ring"}.
+    Streamed answers are sent as NDJSON: one {"token": ...} line per generated token, then a
+    final line with the answer, its sources and the time it took, or with the error that stopped
+    the query. GET /health reports the load.
+    """
+
+    server: QueryServer
+
+    def send_json(self, status: int, data: dict):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_json(404, {'error': f"Unknown path {self.path}"})
+            return
+        self.send_json(200, dict(self.server.health(), status='ok'))
+
+    def do_POST(self):
+        if self.path != '/query':
+            self.send_json(404, {'error': f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            query = request['query'].strip()
+            chat_history = [(question, answer) for question, answer in request.get('chat_history', [])]
+            partition = request.get('partition', self.server.default_partition)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send_json(400, {'error': 'Expected a JSON body with a "query" string and an optional "chat_history" list of [question, answer] pairs'})
+            return
+        try:
+            filter = parse_partition(partition)
+        except Exception as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        if not query:
+            self.send_json(400, {'error': 'The query is empty'})
+            return
+
+        server = self.server
+        if not server.admission.acquire(blocking=False):
+            with server.stats_lock:
+                server.rejected += 1
+            self.send_json(503, {'error': 'Too many queries waiting, try again later'})
+            return
+        with server.stats_lock:
+            server.active += 1
+        try:
+            self.answer_query(query, chat_history, request.get('stream', True), request.get('hide_source', False), filter)
+        finally:
+            with server.stats_lock:
+                server.active -= 1
+            server.admission.release()
+
+    def answer_query(self, query: str, chat_history: List[Tuple[str, str]], stream: bool, hide_source: bool,
+                     filter: Optional[Dict[str, Any]] = None):
+        callbacks = []
+        if stream:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            callbacks.append(TokenStreamHandler(self.wfile))
+
+        try:
+            result = self.server.pipeline.query(query, chat_history, callbacks, self.server.queue_timeout, filter)
+        except asyncio.TimeoutError:
+            with self.server.stats_lock:
+                self.server.rejected += 1
+            error = {'error': f"No LLM became available within {self.server.queue_timeout} s."}
+            if stream:
+                callbacks[0].write(error)
+            else:
+                self.send_json(503, error)
+            return
+        except Exception as error:
+            with self.server.stats_lock:
+                self.server.failed += 1
+            print(f"Query {query!r} failed: {error!r}")
+            if stream:
+                callbacks[0].write({'error': str(error)})
+            else:
+                self.send_json(500, {'error': str(error)})
+            return
+
+        with self.server.stats_lock:
+            self.server.served += 1
+        response = {'query': query, 'answer': result['answer'], 'generated_question': result['generated_question'],
+                    'cached': result['cached'], 'seconds': round(result['seconds'], 2), 'timings': result['timings'],
+                    'sources': [] if hide_source else [source_to_dict(document) for document in result['source_documents']]}
+        if stream:
+            callbacks[0].write(response)
+        else:
+            self.send_json(200, response)
+
+    def log_message(self, format: str, *args: Any):
+        print(f"{self.address_string()} - {format % args}")
+
+
+def serve(pipeline: AsyncQueryPipeline, host: str, port: int, max_queued: int = 32, queue_timeout: Optional[float] = None,
+          default_partition: Optional[str] = None):
+    pipeline.start()
+    server = QueryServer((host, port), pipeline, max_queued=max_queued, queue_timeout=queue_timeout, default_partition=default_partition)
+    print(f"Serving queries on http://{host}:{port} with {pipeline.llm_concurrency} LLM instance(s), up to {max_queued} queued queries")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pipeline.close()
@@ -0,0 +1,30 @@
+import os
+from typing import Tuple
+
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+
+QUERY_VECTORSTORE_TYPES = ['chroma', 'local']
+
+
+def open_vectorstore(embeddings: Embeddings) -> Tuple[VectorStore, str]:
+    """
+    Opens the vectorstore chosen through QUERY_VECTORSTORE for answering questions, and returns
+    it with its directory, where its ingestion manifest lives
+    """
+    vectorstore_type = os.environ.get('QUERY_VECTORSTORE', 'chroma')
+    match vectorstore_type:
+        case "chroma":
+            from langchain.vectorstores import Chroma
+            from constants import CHROMA_SETTINGS
+            persist_directory = os.environ.get('PERSIST_DIRECTORY')
+            return Chroma(persist_directory=persist_directory, embedding_function=embeddings, client_settings=CHROMA_SETTINGS), persist_directory
+        case "local":
+            from retrieval.localstore import LocalVectorStore
+            directory = os.environ.get('LOCAL_STORE_DIRECTORY', 'localdb')
+            if not LocalVectorStore.exists(directory):
+                raise Exception(f"No local vectorstore found in {directory}. Ingest with --vectorstore local to build it.")
+            return LocalVectorStore(directory, embeddings, nprobe=int(os.environ.get('LOCAL_STORE_NPROBE', 8)),
+                                   rescore=int(os.environ.get('LOCAL_STORE_RESCORE', 4))), directory
+        case _default:
+            raise Exception(f"Vectorstore {vectorstore_type} is not supported for queries. Please choose one of the following: {', '.join(QUERY_VECTORSTORE_TYPES)}")
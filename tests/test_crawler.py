@@ -0,0 +1,92 @@
+import os
+import time
+import asyncio
+import tempfile
+import threading
+import unittest
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from crawler import get_domain_hyperlinks
+from crawling.engine import AsyncCrawler
+from crawling.extract import extract_page
+
+# Linked pages of the site, by path, with links relative to the page, to the site root and to other sites
+PAGES = {
+    'wiki/index.html': '<a href="a.html">a</a> <a href="sub/b.html">b</a> <a href="./sub/c.html#top">c</a>'
+                       ' <a href="/other.html">outside the wiki</a> <a href="http://example.com/wiki/x.html">other site</a>',
+    'wiki/a.html': '<a href="index.html">home</a> <a href="/wiki/e.html">e</a> <a href="mailto:someone@example.com">mail</a>',
+    'wiki/sub/b.html': '<a href="../d.html">d</a> <a href="c.html">c</a>',
+    'wiki/sub/c.html': '<a href="../../wiki/a.html">a</a>',
+    'wiki/d.html': '<p>No links</p>',
+    'wiki/e.html': '<a href="sub/b.html">b</a>',
+    'other.html': '<a href="wiki/index.html">wiki</a>',
+}
+
+
+class RecordingHandler(SimpleHTTPRequestHandler):
+    requests = None
+
+    def do_GET(self):
+        self.requests.append((time.monotonic(), self.path))
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CrawlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        for path, body in PAGES.items():
+            os.makedirs(os.path.dirname(os.path.join(self.directory.name, path)), exist_ok=True)
+            with open(os.path.join(self.directory.name, path), 'w', encoding='utf-8') as f:
+                f.write(f'<html><body>{body}</body></html>')
+        self.requests = []
+        handler = type('Handler', (RecordingHandler,), {'requests': self.requests})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), partial(handler, directory=self.directory.name))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.domain = f'127.0.0.1:{self.server.server_address[1]}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def crawl(self, rate: float, burst: int) -> list:
+        visited = []
+
+        def handle_page(url, html):
+            visited.append(url)
+            return get_domain_hyperlinks(self.domain, url, extract_page(html).links, 'wiki')
+
+        crawler = AsyncCrawler(handle_page, concurrency=4, rate=rate, burst=burst, timeout=10)
+        asyncio.run(crawler.run([f'http://{self.domain}/wiki/index.html']))
+        return visited
+
+    def test_visits_every_linked_page_once(self):
+        visited = self.crawl(rate=0, burst=1)
+        self.assertEqual(sorted(visited), sorted(f'http://{self.domain}/{path}' for path in PAGES if path.startswith('wiki/')))
+        self.assertEqual(len(visited), len(set(visited)))
+        self.assertEqual(sorted(path for _, path in self.requests), sorted('/' + path for path in PAGES if path.startswith('wiki/')))
+
+    def test_resolves_relative_links(self):
+        links = get_domain_hyperlinks(self.domain, f'http://{self.domain}/wiki/sub/b.html',
+                                      ['../d.html', 'c.html#part', './c.html', '/wiki/e.html', '/other.html', '#top'], 'wiki')
+        self.assertEqual(sorted(links), [f'http://{self.domain}/wiki/d.html', f'http://{self.domain}/wiki/e.html',
+                                         f'http://{self.domain}/wiki/sub/c.html'])
+
+    def test_rate_limits_requests_per_host(self):
+        rate, burst = 20, 2
+        self.crawl(rate=rate, burst=burst)
+        times = sorted(request_time for request_time, _ in self.requests)
+        self.assertEqual(len(times), 6)
+        # The burst goes out at once, every later request waits for a token
+        self.assertGreaterEqual(times[-1] - times[0], (len(times) - burst) / rate * 0.9)
+        for first, later in zip(times, times[burst:]):
+            self.assertGreaterEqual(later - first, 1 / rate * 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()